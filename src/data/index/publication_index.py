@@ -0,0 +1,188 @@
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+import numpy as np
+
+from models.models import YearSample
+
+CURRENT_FILE = "CURRENT"
+INT8_SCALE = 127
+
+
+def export_publication_index(objects: Iterable, directory: str, quantization: str = "float32") -> str:
+    """Writes a snapshot of all publication vectors grouped by year and returns its directory.
+
+    Vectors are normalised, so cosine similarity becomes a dot product. Snapshots are written next to
+    the current one and only become visible once complete."""
+    snapshot = os.path.join(directory, str(int(time.time())))
+    os.makedirs(snapshot)
+
+    dtype = np.int8 if quantization == "int8" else np.float32
+    vector_files, type_files = {}, {}
+    counts: dict[int, int] = {}
+    types: dict[str, int] = {}
+    dimensions = None
+
+    try:
+        for obj in objects:
+            year = int(obj.properties["year"])
+            pub_type = obj.properties["type"].lower()
+            vector = np.asarray(obj.vector, dtype=np.float32)
+            vector /= max(np.linalg.norm(vector), 1e-12)
+            dimensions = len(vector)
+
+            if year not in vector_files:
+                vector_files[year] = open(os.path.join(snapshot, f"{year}.vectors"), "wb")
+                type_files[year] = open(os.path.join(snapshot, f"{year}.types"), "wb")
+                counts[year] = 0
+
+            if dtype == np.int8:
+                vector = np.round(vector * INT8_SCALE)
+            vector_files[year].write(vector.astype(dtype).tobytes())
+            type_files[year].write(np.int16(types.setdefault(pub_type, len(types))).tobytes())
+            counts[year] += 1
+    finally:
+        for file in [*vector_files.values(), *type_files.values()]:
+            file.close()
+
+    with open(os.path.join(snapshot, "meta.json"), "w") as f:
+        json.dump({
+            "dimensions": dimensions,
+            "dtype": "int8" if dtype == np.int8 else "float32",
+            "types": sorted(types, key=types.get),
+            "counts": counts,
+            "first_year": min(counts.keys(), default=0),
+            "last_year": max(counts.keys(), default=0)
+        }, f)
+
+    with open(os.path.join(directory, CURRENT_FILE + ".tmp"), "w") as f:
+        f.write(os.path.basename(snapshot))
+    os.replace(os.path.join(directory, CURRENT_FILE + ".tmp"),
+               os.path.join(directory, CURRENT_FILE))
+
+    # Older snapshots may still be mapped by running queries, keep the previous one around
+    snapshots = sorted(name for name in os.listdir(directory) if name.isdigit())
+    for name in snapshots[:-2]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    return snapshot
+
+
+class LocalPublicationIndex:
+    """Memory-mapped snapshot of publication vectors, years and types for per-year similarity aggregation.
+
+    A refreshed snapshot should take over the executor of the previous one, queries still running on the
+    previous snapshot keep using it."""
+
+    def __init__(self, snapshot: str, block_size: int = 65536, max_workers: int | None = None,
+                 executor: ThreadPoolExecutor | None = None):
+        self.snapshot = snapshot
+        self.block_size = block_size
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers or os.cpu_count())
+
+        with open(os.path.join(snapshot, "meta.json")) as f:
+            meta = json.load(f)
+
+        self.dimensions = meta["dimensions"]
+        self.dtype = np.int8 if meta["dtype"] == "int8" else np.float32
+        self.types = meta["types"]
+        self.counts = {int(year): count for year, count in meta["counts"].items()}
+        self.first_year = meta.get("first_year", min(self.counts.keys(), default=0))
+        self.last_year = meta["last_year"]
+
+        self.__vectors: dict[int, np.memmap] = {}
+        self.__types: dict[int, np.memmap] = {}
+
+    @staticmethod
+    def open(directory: str, **kwargs):
+        current = os.path.join(directory, CURRENT_FILE)
+        if not os.path.exists(current):
+            return None
+        with open(current) as f:
+            return LocalPublicationIndex(os.path.join(directory, f.read().strip()), **kwargs)
+
+    def covers(self, start_year: int, end_year: int) -> bool:
+        return self.first_year <= start_year and end_year <= self.last_year
+
+    def count_per_year(self, vector: list[float], cutoff: float, start_year: int, end_year: int) -> dict[int, int]:
+        query = self.__prepare_query(vector)
+        years = list(range(start_year, end_year + 1))
+        counts = self.executor.map(
+            lambda year: int(np.count_nonzero(self.__similarities(year, query) >= cutoff)), years)
+        return dict(zip(years, counts))
+
+    def sample_per_year(self, vector: list[float], limits: dict[int, int]) -> dict[int, YearSample]:
+        query = self.__prepare_query(vector)
+        years = list(limits.keys())
+        samples = self.executor.map(
+            lambda year: self.__sample(year, query, limits[year]), years)
+        return dict(zip(years, samples))
+
+    def sample_ranks(self, vector: list[float], ranks: dict[int, list[int]]) -> dict[int, YearSample]:
+        query = self.__prepare_query(vector)
+        years = list(ranks.keys())
+        samples = self.executor.map(
+            lambda year: self.__ranked(year, query, ranks[year]), years)
+        return dict(zip(years, samples))
+
+    def __prepare_query(self, vector: list[float]) -> np.ndarray:
+        query = np.asarray(vector, dtype=np.float32)
+        return query / max(np.linalg.norm(query), 1e-12)
+
+    def __sample(self, year: int, query: np.ndarray, limit: int) -> YearSample:
+        similarities = self.__similarities(year, query)
+        if limit <= 0 or len(similarities) == 0:
+            return YearSample(similarities=[], types=[])
+        return self.__year_sample(year, similarities, self.__nearest(similarities, limit))
+
+    def __ranked(self, year: int, query: np.ndarray, ranks: list[int]) -> YearSample:
+        # The publications at the given positions of a near vector search, the closest one has rank 0
+        similarities = self.__similarities(year, query)
+        ranks = [rank for rank in ranks if rank < len(similarities)]
+        if len(ranks) == 0:
+            return YearSample(similarities=[], types=[])
+        return self.__year_sample(year, similarities, self.__nearest(similarities, max(ranks) + 1)[ranks])
+
+    def __nearest(self, similarities: np.ndarray, limit: int) -> np.ndarray:
+        # Same as a near vector search with a limit, the closest publications of the year
+        limit = min(limit, len(similarities))
+        top = np.argpartition(-similarities, limit - 1)[:limit]
+        return top[np.argsort(-similarities[top])]
+
+    def __year_sample(self, year: int, similarities: np.ndarray, indices: np.ndarray) -> YearSample:
+        type_codes = self.__year_types(year)[indices]
+        return YearSample(
+            similarities=similarities[indices].tolist(),
+            types=[self.types[code] for code in type_codes]
+        )
+
+    def __similarities(self, year: int, query: np.ndarray) -> np.ndarray:
+        vectors = self.__year_vectors(year)
+        similarities = np.empty(len(vectors), dtype=np.float32)
+
+        # Blocked so int8 snapshots are only widened one block at a time
+        for start in range(0, len(vectors), self.block_size):
+            block = vectors[start:start + self.block_size].astype(np.float32)
+            similarities[start:start + len(block)] = block @ query
+
+        if self.dtype == np.int8:
+            similarities /= INT8_SCALE
+        return similarities
+
+    def __year_vectors(self, year: int) -> np.ndarray:
+        if year not in self.counts:
+            return np.empty((0, self.dimensions), dtype=self.dtype)
+        if year not in self.__vectors:
+            self.__vectors[year] = np.memmap(os.path.join(self.snapshot, f"{year}.vectors"), dtype=self.dtype,
+                                             mode="r", shape=(self.counts[year], self.dimensions))
+        return self.__vectors[year]
+
+    def __year_types(self, year: int) -> np.ndarray:
+        if year not in self.__types:
+            self.__types[year] = np.memmap(os.path.join(self.snapshot, f"{year}.types"), dtype=np.int16,
+                                           mode="r", shape=(self.counts[year],))
+        return self.__types[year]
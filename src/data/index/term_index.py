@@ -0,0 +1,144 @@
+import json
+import os
+import re
+import shutil
+import time
+from typing import Callable, Iterable
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer
+
+CURRENT_FILE = "CURRENT"
+
+
+def export_term_index(objects: Iterable, directory: str, stop_words: list[str], min_df: int = 2,
+                      ngram_range: tuple[int, int] = (1, 2), max_features: int | None = None) -> str:
+    """Tokenizes the titles and abstracts of all publications once and writes a snapshot of the
+    corpus-wide vocabulary and document-term matrix, rows keyed by publication id."""
+    snapshot = os.path.join(directory, str(int(time.time())))
+    os.makedirs(snapshot)
+
+    ids = []
+
+    def texts():
+        for obj in objects:
+            ids.append(str(obj.uuid))
+            yield publication_text(obj.properties)
+
+    vectorizer = CountVectorizer(stop_words=stop_words, min_df=min_df, ngram_range=ngram_range,
+                                 max_features=max_features, dtype=np.int32)
+    matrix = vectorizer.fit_transform(texts()).tocsr()
+    matrix.sort_indices()
+
+    np.save(os.path.join(snapshot, "indptr.npy"), matrix.indptr.astype(np.int64))
+    np.save(os.path.join(snapshot, "indices.npy"), matrix.indices.astype(np.int32))
+    np.save(os.path.join(snapshot, "data.npy"), matrix.data.astype(np.int32))
+
+    # Sorted ids with their row, looked up with a binary search on the memory map
+    ids = np.array(ids, dtype="S36")
+    order = np.argsort(ids)
+    np.save(os.path.join(snapshot, "ids.npy"), ids[order])
+    np.save(os.path.join(snapshot, "rows.npy"), order.astype(np.int64))
+
+    with open(os.path.join(snapshot, "vocabulary.txt"), "w") as f:
+        f.write("\n".join(vectorizer.get_feature_names_out()))
+
+    with open(os.path.join(snapshot, "meta.json"), "w") as f:
+        json.dump({
+            "documents": matrix.shape[0],
+            "terms": matrix.shape[1],
+            "stop_words": stop_words,
+            "ngram_range": list(ngram_range)
+        }, f)
+
+    with open(os.path.join(directory, CURRENT_FILE + ".tmp"), "w") as f:
+        f.write(os.path.basename(snapshot))
+    os.replace(os.path.join(directory, CURRENT_FILE + ".tmp"),
+               os.path.join(directory, CURRENT_FILE))
+
+    snapshots = sorted(name for name in os.listdir(directory) if name.isdigit())
+    for name in snapshots[:-2]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    return snapshot
+
+
+def publication_text(properties: dict) -> str:
+    # Cleaned like BERTopic does before tokenizing, so the vocabulary matches a fit on the raw text
+    text = f"{properties['title']}: {properties['abstract']}".replace("\n", " ").replace("\t", " ")
+    return re.sub(r"[^A-Za-z0-9 ]+", "", text)
+
+
+class TermIndex:
+    """Memory-mapped corpus-wide document-term matrix, rows are sliced per query instead of tokenizing."""
+
+    def __init__(self, snapshot: str):
+        self.snapshot = snapshot
+
+        with open(os.path.join(snapshot, "meta.json")) as f:
+            meta = json.load(f)
+        with open(os.path.join(snapshot, "vocabulary.txt")) as f:
+            self.vocabulary = np.array(f.read().split("\n"), dtype=object)
+
+        self.stop_words = meta["stop_words"]
+        self.ngram_range = tuple(meta["ngram_range"])
+
+        self.indptr = np.load(os.path.join(snapshot, "indptr.npy"), mmap_mode="r")
+        self.indices = np.load(os.path.join(snapshot, "indices.npy"), mmap_mode="r")
+        self.data = np.load(os.path.join(snapshot, "data.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(snapshot, "ids.npy"), mmap_mode="r")
+        self.rows = np.load(os.path.join(snapshot, "rows.npy"), mmap_mode="r")
+
+        self.__vectorizer = None
+
+    @staticmethod
+    def current(directory: str) -> str | None:
+        current = os.path.join(directory, CURRENT_FILE)
+        if not os.path.exists(current):
+            return None
+        with open(current) as f:
+            return os.path.join(directory, f.read().strip())
+
+    @staticmethod
+    def open(directory: str):
+        snapshot = TermIndex.current(directory)
+        return TermIndex(snapshot) if snapshot is not None else None
+
+    def lookup(self, ids: list[str]) -> np.ndarray:
+        # Row per id, -1 for publications added after the snapshot
+        keys = np.array(ids, dtype="S36")
+        positions = np.minimum(np.searchsorted(self.ids, keys), len(self.ids) - 1)
+        found = self.ids[positions] == keys
+        return np.where(found, self.rows[positions], -1)
+
+    def document_terms(self, rows: np.ndarray) -> sp.csr_matrix:
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+        lengths = ends - starts
+        spans = [np.arange(start, end) for start, end in zip(starts, ends)]
+        positions = np.concatenate(spans) if len(spans) > 0 else np.empty(0, dtype=np.int64)
+
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        return sp.csr_matrix((self.data[positions], self.indices[positions], indptr),
+                             shape=(len(rows), len(self.vocabulary)))
+
+    def document_terms_for(self, ids: list[str], fetch_properties: Callable[[list[str]], list[dict]]) -> sp.csr_matrix:
+        rows = self.lookup(ids)
+        found, missing = np.where(rows >= 0)[0], np.where(rows < 0)[0]
+        if len(missing) == 0:
+            return self.document_terms(rows)
+
+        # Publications newer than the snapshot are tokenized on the fly
+        matrix = sp.vstack([
+            self.document_terms(rows[found]),
+            self.tokenize([publication_text(properties)
+                          for properties in fetch_properties([ids[i] for i in missing])])
+        ]).tocsr()
+        return matrix[np.argsort(np.concatenate([found, missing]))]
+
+    def tokenize(self, texts: list[str]) -> sp.csr_matrix:
+        # Same analyzer as the export, restricted to the snapshot vocabulary
+        if self.__vectorizer is None:
+            self.__vectorizer = CountVectorizer(stop_words=self.stop_words, ngram_range=self.ngram_range, dtype=np.int32,
+                                                vocabulary={word: i for i, word in enumerate(self.vocabulary)})
+        return self.__vectorizer.transform(texts)
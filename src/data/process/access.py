@@ -3,6 +3,7 @@ import asyncpg
 
 async def prepare_database(conn: asyncpg.Connection):
     await create_table(conn)
+    await migrate_table(conn)
 
 
 async def create_table(conn: asyncpg.Connection):
@@ -20,3 +21,62 @@ async def create_table(conn: asyncpg.Connection):
         );
     """
     await conn.execute(create_table_query)
+
+
+async def migrate_table(conn: asyncpg.Connection):
+    migrate_table_query = """
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS batch_id TEXT;
+        CREATE INDEX IF NOT EXISTS queries_batch_id_idx ON queries (batch_id);
+
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS finished_at TIMESTAMPTZ;
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS results_compressed BYTEA;
+        CREATE INDEX IF NOT EXISTS queries_type_finished_at_idx ON queries (type, finished_at);
+        CREATE INDEX IF NOT EXISTS queries_uncompressed_finished_at_idx ON queries (finished_at) WHERE results IS NOT NULL;
+
+        CREATE INDEX IF NOT EXISTS queries_created_at_idx ON queries (created_at DESC, uuid DESC);
+        CREATE INDEX IF NOT EXISTS queries_progress_created_at_idx ON queries (progress, created_at DESC, uuid DESC);
+        CREATE INDEX IF NOT EXISTS queries_type_created_at_idx ON queries (type, created_at DESC, uuid DESC);
+        CREATE INDEX IF NOT EXISTS queries_topics_idx ON queries USING GIN (topics);
+
+        CREATE TABLE IF NOT EXISTS queries_archive (
+            uuid TEXT PRIMARY KEY,
+            type INTEGER NOT NULL,
+            progress INTEGER NOT NULL,
+            topics TEXT[],
+            start_year INTEGER NOT NULL,
+            end_year INTEGER NOT NULL,
+            cutoff NUMERIC(4, 3) NOT NULL,
+            min_citations INTEGER,
+            batch_id TEXT,
+            created_at TIMESTAMPTZ NOT NULL,
+            finished_at TIMESTAMPTZ,
+            results_compressed BYTEA,
+            archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE queries_archive ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0;
+
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS parent_uuid TEXT;
+        ALTER TABLE queries_archive ADD COLUMN IF NOT EXISTS parent_uuid TEXT;
+
+        -- Precomputed results of popular queries, matched by their normalized topic set
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS warm BOOLEAN NOT NULL DEFAULT FALSE;
+        CREATE OR REPLACE FUNCTION query_topic_key(topics TEXT[]) RETURNS TEXT LANGUAGE SQL IMMUTABLE AS $$
+            SELECT array_to_string(ARRAY(SELECT DISTINCT btrim(topic) FROM unnest(topics) AS topic ORDER BY 1), chr(31))
+        $$;
+        CREATE INDEX IF NOT EXISTS queries_warm_idx ON queries (query_topic_key(topics), type, start_year, end_year) WHERE warm;
+        -- Entries that reuse warm results point at the warm entry instead of holding a copy
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS source_uuid TEXT;
+        ALTER TABLE queries_archive ADD COLUMN IF NOT EXISTS source_uuid TEXT;
+        CREATE INDEX IF NOT EXISTS queries_source_uuid_idx ON queries (source_uuid) WHERE source_uuid IS NOT NULL;
+        CREATE INDEX IF NOT EXISTS queries_archive_source_uuid_idx ON queries_archive (source_uuid) WHERE source_uuid IS NOT NULL;
+
+        -- Bitmask of the stages whose results are stored, interrupted queries resume after them
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS completed_stages INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE queries_archive ADD COLUMN IF NOT EXISTS completed_stages INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE queries_archive ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+    """
+    await conn.execute(migrate_table_query)
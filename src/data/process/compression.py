@@ -0,0 +1,12 @@
+import zstandard
+
+compressor = zstandard.ZstdCompressor(level=10)
+decompressor = zstandard.ZstdDecompressor()
+
+
+def compress_results(results: str) -> bytes:
+    return compressor.compress(results.encode())
+
+
+def decompress_results(results_compressed: bytes) -> bytes:
+    return decompressor.decompress(results_compressed)
@@ -1,62 +1,368 @@
+import base64
 import dataclasses
+import datetime
 import json
+import re
 import uuid
 
 from asyncpg import Connection
-from models.models import QueryEntry, QueryProgress, QueryRequest
+from data.process.compression import decompress_results
+from data.process.serialization import dumps, dumps_entry
+from models.models import AnalysisResults, QueryBatchStatus, QueryDeriveRequest, QueryEntry, QueryProgress, QueryRequest, QueryStage, QueryType
 
 
-class EnhancedJSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)
-        return super().default(o)
+def encode_listing_cursor(created_at: datetime.datetime, uuid: str) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{uuid}".encode()).decode()
+
+
+def decode_listing_cursor(cursor: str) -> tuple[datetime.datetime, str]:
+    try:
+        created_at, uuid = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split("|")
+        return datetime.datetime.fromisoformat(created_at), uuid
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+RESULT_FIELDS = [field.name for field in dataclasses.fields(AnalysisResults)]
+FIELD_SEGMENT = re.compile(r"^\w+$")
+
+
+def parse_fields(fields: str) -> list[list[str]]:
+    # Comma separated, dotted paths into the results, e.g. "trend_results,search_results.adjusted"
+    paths = [field.strip().split(".") for field in fields.split(",") if field.strip() != ""]
+    for path in paths:
+        if path[0] not in RESULT_FIELDS or not all(FIELD_SEGMENT.match(segment) for segment in path):
+            raise ValueError("Unknown field {}".format(".".join(path)))
+    return paths
+
+
+def fields_tree(paths: list[list[str]]) -> dict:
+    # Leaves are None, a path that is a prefix of another one selects the whole subtree
+    tree = {}
+    for path in sorted(paths, key=len):
+        node = tree
+        for segment in path[:-1]:
+            if segment in node and node[segment] is None:
+                break
+            node = node.setdefault(segment, {})
+        else:
+            node[path[-1]] = None
+    return tree
+
+
+def project_results(results, tree: dict):
+    if results is None:
+        return None
+    # Like json_build_object in Postgres, a missing subtree still becomes an object with null leaves
+    node = results if isinstance(results, dict) else {}
+    return {key: node.get(key) if sub is None else project_results(node.get(key) or {}, sub)
+            for key, sub in tree.items()}
 
 
 class QueryRepository:
     def __init__(self, conn: Connection):
         self.conn = conn
 
+    insert_columns = ["uuid", "type", "progress", "topics", "start_year",
+                      "end_year", "cutoff", "min_citations", "results", "batch_id", "parent_uuid"]
+
     async def create_query_entry(self, entry: QueryRequest) -> QueryEntry:
-        entry = QueryEntry(uuid=str(uuid.uuid4()), type=entry.query_type, progress=QueryProgress.QUEUED, topics=entry.topics,
-                           start_year=entry.start_year, end_year=entry.end_year, cutoff=entry.cutoff, min_citations=entry.min_citations, results=None)
-        insert_query = "INSERT INTO queries (uuid, type, progress, topics, start_year, end_year, cutoff, min_citations, results) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9);"
-        await self.conn.execute(insert_query, *dataclasses.astuple(entry))
+        entry = self.__new_entry(entry)
+        insert_query = "INSERT INTO queries ({}) VALUES {};".format(
+            ", ".join(self.insert_columns), self.__values_placeholders(1))
+        await self.conn.execute(insert_query, *self.__insert_values(entry))
+        return entry
+
+    async def create_derived_query_entry(self, parent: QueryEntry, request: QueryDeriveRequest) -> QueryEntry:
+        entry = self.__new_entry(QueryRequest(query_type=parent.type, topics=parent.topics, start_year=request.start_year,
+                                              end_year=request.end_year, cutoff=request.cutoff or parent.cutoff,
+                                              min_citations=parent.min_citations))
+        entry.parent_uuid = parent.uuid
+        insert_query = "INSERT INTO queries ({}) VALUES {};".format(
+            ", ".join(self.insert_columns), self.__values_placeholders(1))
+        await self.conn.execute(insert_query, *self.__insert_values(entry))
         return entry
 
+    async def create_warm_query_entry(self, request: QueryRequest) -> QueryEntry:
+        entry = self.__new_entry(request)
+        insert_query = "INSERT INTO queries ({}, warm) VALUES ({}, TRUE);".format(
+            ", ".join(self.insert_columns), self.__values_placeholders(1)[1:-1])
+        await self.conn.execute(insert_query, *self.__insert_values(entry))
+        return entry
+
+    async def reuse_warm_query_entry(self, request: QueryRequest) -> QueryEntry | None:
+        # Finished entry pointing at the latest precomputed results of the same query, whose results and artifacts it reads
+        new_uuid = str(uuid.uuid4())
+        insert_query = f"""
+            WITH source AS (
+                SELECT uuid FROM queries
+                WHERE warm AND progress = {int(QueryProgress.FINISHED)}
+                    AND query_topic_key(topics) = query_topic_key($2::text[])
+                    AND type = $3 AND start_year = $4 AND end_year = $5
+                    AND cutoff = round($6::numeric, 3) AND min_citations IS NOT DISTINCT FROM $7
+                ORDER BY finished_at DESC
+                LIMIT 1
+            )
+            INSERT INTO queries (uuid, type, progress, topics, start_year, end_year, cutoff, min_citations,
+                                 finished_at, version, source_uuid)
+            SELECT $1, $3, {int(QueryProgress.FINISHED)}, $2, $4, $5, $6, $7, now(), 1, uuid
+            FROM source;
+        """
+        status = await self.conn.execute(insert_query, new_uuid, request.topics, request.query_type, request.start_year,
+                                         request.end_year, request.cutoff, request.min_citations)
+        if status.split(" ")[-1] == "0":
+            return None
+        return await self.get_query_summary(new_uuid)
+
+    async def get_popular_queries(self, since: datetime.datetime, limit: int, min_requests: int) -> list[QueryRequest]:
+        select_query = f"""
+            SELECT type, query_topic_key(topics) AS topic_key, start_year, end_year, cutoff, min_citations, count(*) AS requests
+            FROM queries
+            WHERE NOT warm AND created_at >= $1 AND progress <> {int(QueryProgress.FAILED)}
+            GROUP BY type, query_topic_key(topics), start_year, end_year, cutoff, min_citations
+            HAVING count(*) >= $3
+            ORDER BY requests DESC
+            LIMIT $2;
+        """
+        rows = await self.conn.fetch(select_query, since, limit, min_requests)
+        return [QueryRequest(query_type=row["type"], topics=row["topic_key"].split("\x1f"), start_year=row["start_year"],
+                             end_year=row["end_year"], cutoff=float(row["cutoff"]), min_citations=row["min_citations"] or 0)
+                for row in rows]
+
+    async def delete_warm_query_entries(self, keep: list[str]) -> list[str]:
+        # Entries still referenced by reusing ones stay until those are gone, they are no longer reused as newer ones exist
+        delete_query = """
+            DELETE FROM queries WHERE warm AND NOT (uuid = ANY($1::text[]))
+                AND NOT EXISTS (SELECT 1 FROM queries AS reusing WHERE reusing.source_uuid = queries.uuid)
+                AND NOT EXISTS (SELECT 1 FROM queries_archive AS reusing WHERE reusing.source_uuid = queries.uuid)
+            RETURNING uuid;
+        """
+        return [row["uuid"] for row in await self.conn.fetch(delete_query, keep)]
+
+    async def create_query_entries(self, requests: list[QueryRequest], batch_id: str) -> list[QueryEntry]:
+        entries = [self.__new_entry(request, batch_id) for request in requests]
+        insert_query = "INSERT INTO queries ({}) VALUES {};".format(
+            ", ".join(self.insert_columns), self.__values_placeholders(len(entries)))
+        async with self.conn.transaction():
+            await self.conn.execute(insert_query, *[value for entry in entries for value in self.__insert_values(entry)])
+        return entries
+
+    async def get_batch_status(self, batch_id: str) -> QueryBatchStatus:
+        select_query = "SELECT uuid, progress FROM queries WHERE batch_id = $1;"
+        rows = await self.conn.fetch(select_query, batch_id)
+        if len(rows) == 0:
+            return None
+        progress = [row["progress"] for row in rows]
+        return QueryBatchStatus(
+            batch_id=batch_id,
+            total=len(rows),
+            finished=progress.count(QueryProgress.FINISHED),
+            failed=progress.count(QueryProgress.FAILED),
+            cancelled=progress.count(QueryProgress.CANCELLED),
+            queries={row["uuid"]: QueryProgress(row["progress"]) for row in rows}
+        )
+
+    summary_columns = "uuid, type, progress, topics, start_year, end_year, cutoff, min_citations, batch_id, created_at, finished_at, version, parent_uuid, completed_stages, attempts, source_uuid"
+
     async def get_query_entry(self, uuid: str) -> QueryEntry:
-        select_query = "SELECT * FROM queries WHERE uuid = $1;"
+        row = await self.__fetch_entry_row(uuid)
+        if row == None:
+            return None
+        results = self.__results_text(row)
+        return self.__entry_from_row(row, json.loads(results) if results != None else None)
+
+    async def get_query_entry_json(self, uuid: str) -> tuple[QueryEntry, bytes] | None:
+        row = await self.__fetch_entry_row(uuid)
+        if row == None:
+            return None
+        entry = self.__entry_from_row(row, None)
+        return entry, dumps_entry(entry, self.__results_text(row))
+
+    async def get_query_fields(self, uuid: str, paths: list[list[str]]) -> QueryEntry:
+        row, results = await self.__fetch_fields(uuid, paths)
+        if row == None:
+            return None
+        return self.__entry_from_row(row, json.loads(results) if results != None else None)
+
+    async def get_query_fields_json(self, uuid: str, paths: list[list[str]]) -> tuple[QueryEntry, bytes] | None:
+        row, results = await self.__fetch_fields(uuid, paths)
+        if row == None:
+            return None
+        entry = self.__entry_from_row(row, None)
+        return entry, dumps_entry(entry, results)
+
+    async def get_query_version(self, uuid: str) -> tuple[int, QueryProgress] | None:
+        select_query = """
+            SELECT version, progress FROM queries WHERE uuid = $1
+            UNION ALL
+            SELECT version, progress FROM queries_archive WHERE uuid = $1
+            LIMIT 1;
+        """
         row = await self.conn.fetchrow(select_query, uuid)
         if row == None:
             return None
-        results_map = {**{i: row[i] for i in row.keys() if i != 'results'},
-                       "cutoff": float(row["cutoff"]),
-                       "results": json.loads(row["results"]) if row["results"] != None else None}
-        return QueryEntry(**results_map)
+        return row["version"], QueryProgress(row["progress"])
 
     async def get_query_summary(self, uuid: str) -> QueryEntry:
-        select_query = "SELECT uuid, type, progress, topics, start_year, end_year, cutoff, min_citations FROM queries WHERE uuid = $1;"
+        select_query = f"""
+            SELECT {self.summary_columns} FROM queries WHERE uuid = $1
+            UNION ALL
+            SELECT {self.summary_columns} FROM queries_archive WHERE uuid = $1
+            LIMIT 1;
+        """
         row = await self.conn.fetchrow(select_query, uuid)
         if row == None:
             return None
-        results_map = {**{i: row[i] for i in row.keys() if i != 'results'},
-                       "cutoff": float(row["cutoff"]),
-                       "results":  None}
-        return QueryEntry(**results_map)
+        return self.__entry_from_row(row, None)
+
+    # Cancelled queries are final, a pipeline that has not noticed the cancellation yet must not revive them
+    async def update_query_entry(self, entry: QueryEntry, completed_stage: QueryStage | None = None):
+        # The stage is marked in the same statement that stores its results
+        update_query = f"""
+            UPDATE queries SET progress = $1, results = $2, finished_at = {self.__finished_at_expression}, version = version + 1,
+                completed_stages = completed_stages | $5
+            WHERE uuid = $3 AND progress <> $4;
+        """
+        await self.conn.execute(update_query, entry.progress, dumps(entry.results).decode(), entry.uuid,
+                                QueryProgress.CANCELLED, int(completed_stage or 0))
 
-    async def update_query_entry(self, entry: QueryEntry):
-        update_query = "UPDATE queries SET progress = $1, results = $2 WHERE uuid = $3;"
-        await self.conn.execute(update_query, entry.progress, json.dumps(entry.results, cls=EnhancedJSONEncoder), entry.uuid)
+    async def start_query_attempt(self, uuid: str):
+        update_query = "UPDATE queries SET attempts = attempts + 1 WHERE uuid = $1;"
+        await self.conn.execute(update_query, uuid)
+
+    async def recover_unfinished_queries(self, max_attempts: int) -> tuple[list[QueryEntry], int]:
+        # Fails the queries that ran out of attempts and warm ones, which are recomputed anyway, returns the rest oldest first
+        unfinished = "progress <> ALL($1::int[])"
+        terminal = [int(p) for p in (QueryProgress.FINISHED, QueryProgress.FAILED, QueryProgress.CANCELLED)]
+        fail_query = f"""
+            UPDATE queries SET progress = {int(QueryProgress.FAILED)}, finished_at = now(), version = version + 1
+            WHERE {unfinished} AND (warm OR attempts >= $2);
+        """
+        select_query = f"""
+            SELECT {self.summary_columns} FROM queries WHERE {unfinished}
+            ORDER BY created_at, uuid;
+        """
+        async with self.conn.transaction():
+            status = await self.conn.execute(fail_query, terminal, max_attempts)
+            rows = await self.conn.fetch(select_query, terminal)
+        return [self.__entry_from_row(row, None) for row in rows], int(status.split(" ")[-1])
 
     async def update_query_progress(self, uuid: str, progress: QueryProgress):
-        update_query = "UPDATE queries SET progress = $1 WHERE uuid = $2;"
-        await self.conn.execute(update_query, progress, uuid)
+        update_query = f"""
+            UPDATE queries SET progress = $1, finished_at = {self.__finished_at_expression}, version = version + 1
+            WHERE uuid = $2 AND progress <> $3;
+        """
+        await self.conn.execute(update_query, progress, uuid, QueryProgress.CANCELLED)
+
+    async def list_query_summaries(self, progress: QueryProgress | None, query_type: QueryType | None, topic: str | None,
+                                   cursor: str | None, limit: int) -> tuple[list[QueryEntry], str | None]:
+        # Keyset pagination over (created_at, uuid), newest first
+        after_created_at, after_uuid = decode_listing_cursor(
+            cursor) if cursor is not None else (None, None)
+        select_query = f"""
+            SELECT {self.summary_columns} FROM queries
+            WHERE NOT warm
+                AND ($1::int IS NULL OR progress = $1)
+                AND ($2::int IS NULL OR type = $2)
+                AND ($3::text IS NULL OR topics @> ARRAY[$3::text])
+                AND ($4::timestamptz IS NULL OR (created_at, uuid) < ($4, $5))
+            ORDER BY created_at DESC, uuid DESC
+            LIMIT $6;
+        """
+        rows = await self.conn.fetch(select_query, progress, query_type, topic, after_created_at, after_uuid, limit + 1)
+
+        entries = [self.__entry_from_row(row, None) for row in rows[:limit]]
+        next_cursor = encode_listing_cursor(
+            rows[limit - 1]["created_at"], rows[limit - 1]["uuid"]) if len(rows) > limit else None
+        return entries, next_cursor
 
-    async def get_all_query_entries(self) -> list[QueryEntry]:
-        select_query = "SELECT * FROM queries;"
-        rows = await self.conn.fetch(select_query)
-        return [QueryEntry(**row) for row in rows]
+    async def is_warm_query_entry(self, uuid: str) -> bool:
+        select_query = "SELECT warm FROM queries WHERE uuid = $1;"
+        return await self.conn.fetchval(select_query, uuid) == True
 
     async def delete_query_entry(self, uuid: str):
-        delete_query = "DELETE FROM queries WHERE uuid = $1;"
+        # Warm entries are only replaced by the warming job, which keeps them while other entries reuse them
+        delete_query = "DELETE FROM queries WHERE uuid = $1 AND NOT warm;"
         await self.conn.execute(delete_query, uuid)
+        delete_archive_query = "DELETE FROM queries_archive WHERE uuid = $1;"
+        await self.conn.execute(delete_archive_query, uuid)
+
+    def __new_entry(self, request: QueryRequest, batch_id: str | None = None) -> QueryEntry:
+        return QueryEntry(uuid=str(uuid.uuid4()), type=request.query_type, progress=QueryProgress.QUEUED, topics=request.topics,
+                          start_year=request.start_year, end_year=request.end_year, cutoff=request.cutoff,
+                          min_citations=request.min_citations, results=None, batch_id=batch_id)
+
+    def __insert_values(self, entry: QueryEntry) -> list:
+        return [entry.uuid, entry.type, entry.progress, entry.topics, entry.start_year,
+                entry.end_year, entry.cutoff, entry.min_citations, entry.results, entry.batch_id, entry.parent_uuid]
+
+    def __values_placeholders(self, rows: int) -> str:
+        columns = len(self.insert_columns)
+        return ", ".join(
+            "({})".format(", ".join(f"${row * columns + i + 1}" for i in range(columns))) for row in range(rows)
+        )
+
+    __finished_at_expression = "CASE WHEN $1 IN ({}) THEN now() ELSE NULL END".format(
+        ", ".join(str(int(p)) for p in (QueryProgress.FINISHED, QueryProgress.FAILED, QueryProgress.CANCELLED)))
+
+    async def __fetch_entry_row(self, uuid: str, results_expression: str = "results::text", *params):
+        # Archived queries only keep their compressed results
+        select_query = f"""
+            SELECT {self.summary_columns}, {results_expression} AS results, results_compressed FROM queries WHERE uuid = $1
+            UNION ALL
+            SELECT {self.summary_columns}, NULL AS results, results_compressed FROM queries_archive WHERE uuid = $1
+            LIMIT 1;
+        """
+        row = await self.conn.fetchrow(select_query, uuid, *params)
+        if row == None or row["source_uuid"] == None:
+            return row
+
+        source = await self.conn.fetchrow(select_query, row["source_uuid"], *params)
+        if source == None:
+            return row
+        return {**dict(row), "results": source["results"], "results_compressed": source["results_compressed"]}
+
+    async def __fetch_fields(self, uuid: str, paths: list[list[str]]) -> tuple:
+        # Postgres extracts the requested paths, so the rest of the document is never sent over
+        tree = fields_tree(paths)
+        params = []
+        projection = self.__projection(tree, [], params)
+        row = await self.__fetch_entry_row(
+            uuid, f"CASE WHEN results IS NULL THEN NULL ELSE {projection}::text END", *params)
+        if row == None:
+            return None, None
+        if row["results"] != None or row["results_compressed"] == None:
+            return row, row["results"].encode() if row["results"] != None else None
+
+        # Compressed rows have to be decoded here instead
+        results = json.loads(decompress_results(row["results_compressed"]))
+        return row, dumps(project_results(results, tree))
+
+    def __projection(self, tree: dict, prefix: list[str], params: list) -> str:
+        pairs = []
+        for key, sub in tree.items():
+            params.append(key)
+            key_placeholder = f"${len(params) + 1}::text"
+            if sub is None:
+                params.append(prefix + [key])
+                pairs.append(f"{key_placeholder}, results #> ${len(params) + 1}::text[]")
+            else:
+                pairs.append(f"{key_placeholder}, {self.__projection(sub, prefix + [key], params)}")
+        return "json_build_object({})".format(", ".join(pairs))
+
+    def __results_text(self, row) -> bytes | None:
+        if row["results"] != None:
+            return row["results"].encode()
+        if row["results_compressed"] != None:
+            return decompress_results(row["results_compressed"])
+        return None
+
+    def __entry_from_row(self, row, results) -> QueryEntry:
+        return QueryEntry(uuid=row["uuid"], type=row["type"], progress=row["progress"], topics=row["topics"],
+                          start_year=row["start_year"], end_year=row["end_year"], cutoff=float(row["cutoff"]),
+                          min_citations=row["min_citations"], results=results, batch_id=row["batch_id"],
+                          created_at=row["created_at"].isoformat(),
+                          finished_at=row["finished_at"].isoformat() if row["finished_at"] != None else None,
+                          version=row["version"], parent_uuid=row["parent_uuid"],
+                          completed_stages=row["completed_stages"], attempts=row["attempts"], source_uuid=row["source_uuid"])
@@ -0,0 +1,75 @@
+import datetime
+
+from asyncpg import Connection
+
+from data.process.compression import compress_results
+from models.models import QueryProgress, QueryType
+from trend.discovery.topic_artifacts import TopicArtifactStore
+
+TERMINAL_PROGRESS = [QueryProgress.FINISHED,
+                     QueryProgress.FAILED, QueryProgress.CANCELLED]
+
+ARCHIVE_COLUMNS = ["uuid", "type", "progress", "topics", "start_year", "end_year", "cutoff",
+                   "min_citations", "batch_id", "created_at", "finished_at", "results_compressed", "version", "parent_uuid",
+                   "completed_stages", "attempts", "source_uuid"]
+
+
+class QueryRetention:
+    def __init__(self, conn: Connection, compact_after: datetime.timedelta,
+                 ttl_per_type: dict[QueryType, datetime.timedelta | None], batch_size: int = 500,
+                 artifact_store: TopicArtifactStore | None = None):
+        self.conn = conn
+        self.compact_after = compact_after
+        self.ttl_per_type = ttl_per_type
+        self.batch_size = batch_size
+        self.artifact_store = artifact_store
+
+    async def run(self) -> tuple[int, int]:
+        compacted = await self.compact_results(self.compact_after)
+        archived = 0
+        for query_type, ttl in self.ttl_per_type.items():
+            if ttl is not None:
+                archived += await self.archive_expired(query_type, ttl)
+        return compacted, archived
+
+    async def compact_results(self, older_than: datetime.timedelta, query_type: QueryType | None = None) -> int:
+        select_query = """
+            SELECT uuid, results::text AS results FROM queries
+            WHERE results IS NOT NULL AND progress = ANY($1::int[]) AND finished_at < now() - $2::interval
+                AND ($3::int IS NULL OR type = $3)
+            LIMIT $4;
+        """
+        update_query = "UPDATE queries SET results_compressed = $1, results = NULL WHERE uuid = $2;"
+
+        compacted = 0
+        while True:
+            rows = await self.conn.fetch(select_query, TERMINAL_PROGRESS, older_than, query_type, self.batch_size)
+            if len(rows) == 0:
+                return compacted
+
+            await self.conn.executemany(update_query, [
+                (compress_results(row["results"]), row["uuid"]) for row in rows])
+            compacted += len(rows)
+
+    async def archive_expired(self, query_type: QueryType, ttl: datetime.timedelta) -> int:
+        # Archived rows only keep compressed results, so compress whatever is still plain first.
+        # Warm entries are replaced by the warming job instead
+        await self.compact_results(ttl, query_type)
+
+        columns = ", ".join(ARCHIVE_COLUMNS)
+        move_query = f"""
+            WITH moved AS (
+                DELETE FROM queries
+                WHERE type = $1 AND progress = ANY($2::int[]) AND finished_at < now() - $3::interval AND NOT warm
+                RETURNING {columns}
+            )
+            INSERT INTO queries_archive ({columns}) SELECT {columns} FROM moved
+            RETURNING uuid;
+        """
+        rows = await self.conn.fetch(move_query, query_type, TERMINAL_PROGRESS, ttl)
+
+        # Archived queries are no longer drilled into, their topic models go with them
+        if self.artifact_store is not None:
+            for row in rows:
+                self.artifact_store.delete(row["uuid"])
+        return len(rows)
@@ -0,0 +1,64 @@
+import dataclasses
+
+import orjson
+
+from models.models import AnalysisResults, CitationRecommendationResults, ClusteringResults, DiscoveredTopic, Publication, QueryEntry, SearchResults, Trend, TrendResults, TrendType, TopicDiscoveryResults
+
+OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+SUMMARY_FIELDS = [field.name for field in dataclasses.fields(
+    QueryEntry) if field.name != "results"]
+
+
+def dumps(obj) -> bytes:
+    # Dataclasses, enums and NumPy values are serialised natively, NaN becomes null
+    return orjson.dumps(obj, option=OPTIONS)
+
+
+def dumps_entry(entry: QueryEntry, results: bytes | None) -> bytes:
+    # Splices the stored results text into the body instead of decoding and encoding it again
+    summary = dumps({name: getattr(entry, name) for name in SUMMARY_FIELDS})
+    return summary[:-1] + b',"results":' + (results if results is not None else b"null") + b"}"
+
+
+def results_from_dict(results: dict | None) -> AnalysisResults:
+    # Stored results of an interrupted query, back as dataclasses so the remaining stages can continue on them
+    if results is None:
+        return AnalysisResults()
+
+    search_results = results.get("search_results")
+    if search_results is not None:
+        search_results = SearchResults(**search_results)
+        if search_results.pub_types_per_year is not None:
+            search_results.pub_types_per_year = {
+                int(year): types for year, types in search_results.pub_types_per_year.items()}
+
+    trend_results = results.get("trend_results")
+    if trend_results is not None:
+        trend_results = TrendResults(
+            breakpoints=trend_results["breakpoints"],
+            global_trend=trend_from_dict(trend_results["global_trend"]),
+            sub_trends=[trend_from_dict(trend) for trend in trend_results["sub_trends"]],
+            trend_description=trend_results.get("trend_description")
+        )
+
+    topic_discovery_results = results.get("topic_discovery_results")
+    if topic_discovery_results is not None:
+        clusters = topic_discovery_results.get("clusters")
+        topics_over_time = topic_discovery_results.get("topics_over_time")
+        topic_discovery_results = TopicDiscoveryResults(
+            topics=topic_discovery_results["topics"],
+            clusters=ClusteringResults(**clusters) if clusters is not None else None,
+            topics_over_time=[DiscoveredTopic(**topic) for topic in topics_over_time] if topics_over_time is not None else None
+        )
+
+    citation_results = results.get("citation_results")
+    if citation_results is not None:
+        citation_results = CitationRecommendationResults(
+            publications=[Publication(**publication) for publication in citation_results["publications"]])
+
+    return AnalysisResults(search_results, trend_results, topic_discovery_results, citation_results)
+
+
+def trend_from_dict(trend: dict) -> Trend:
+    return Trend(**{**trend, "type": TrendType(trend["type"])})
@@ -0,0 +1,91 @@
+import math
+from typing import Callable
+
+import numpy as np
+
+from models.models import YearSample
+
+
+def estimate_mean(head: list[float], draws: list[float], size: int, z: float = 1.96) -> tuple[float, float | None]:
+    """Mean similarity of a year's nearest size publications and its confidence half-width.
+
+    The nearest len(head) are known completely, the draws are a simple random sample without replacement from the
+    remaining ranks, so only those contribute to the error."""
+    tail = size - len(head)
+    if tail <= 0 or len(draws) >= tail:
+        return float(np.mean(head + draws)), 0.0
+    mean = float((np.sum(head) + tail * np.mean(draws)) / size)
+    if len(draws) < 2:
+        return mean, None
+
+    # Finite population correction, the error vanishes once every rank is drawn
+    standard_error = tail / size * math.sqrt((1 - len(draws) / tail) * np.var(draws, ddof=1) / len(draws))
+    return mean, float(z * standard_error)
+
+
+class AdaptiveSampler:
+    """Estimates the mean similarity of the publications the fixed heuristic samples per year, from part of them.
+
+    Every year keeps the fixed mode's size, only its nearest head_size publications and a random draw of the remaining
+    ranks are fetched. The budget grows the draws of the years with the widest confidence interval, fetching only the
+    new ranks, until every interval is narrower than the tolerance or the budget is spent."""
+
+    def __init__(self, budget: int = 0, tolerance: float = 0.005, head_size: int = 10, pilot_draws: int = 5,
+                 z: float = 1.96):
+        self.budget = budget
+        self.tolerance = tolerance
+        self.head_size = head_size
+        self.pilot_draws = pilot_draws
+        self.z = z
+
+    def sample(self, fetch_nearest: Callable[[dict[int, int]], dict[int, YearSample]],
+               fetch_ranks: Callable[[dict[int, list[int]]], dict[int, YearSample]],
+               sizes: dict[int, int], seed: int = 0) -> dict[int, YearSample]:
+        # Without an explicit budget at most half of what the fixed heuristic fetches
+        budget = self.budget or sum(sizes.values()) // 2
+
+        # Small years are fetched completely, there is nothing to estimate
+        heads = {year: size if size <= self.head_size + self.pilot_draws else self.head_size
+                 for year, size in sizes.items()}
+        samples = fetch_nearest(heads)
+
+        # Ranks are drawn in a fixed random order per year, so repeated queries draw the same publications
+        orders = {year: self.head_size + np.random.default_rng([seed, year]).permutation(sizes[year] - self.head_size)
+                  for year, head in heads.items() if head < sizes[year]}
+        draws = {year: YearSample(similarities=[], types=[]) for year in orders}
+        drawn = {year: 0 for year in orders}
+        requests = {year: min(self.pilot_draws, len(order)) for year, order in orders.items()}
+        spent = sum(heads.values())
+
+        while len(requests) > 0:
+            fetched = fetch_ranks({year: orders[year][drawn[year]:drawn[year] + count].tolist()
+                                   for year, count in requests.items()})
+            for year, sample in fetched.items():
+                draws[year].similarities.extend(sample.similarities)
+                draws[year].types.extend(sample.types)
+                drawn[year] += requests[year]
+            spent += sum(requests.values())
+
+            errors = {year: estimate_mean(samples[year].similarities, draws[year].similarities, sizes[year], self.z)[1]
+                      for year in orders}
+            requests = {}
+            remaining = budget - spent
+            for year in sorted(orders, key=lambda y: -errors[y] if errors[y] is not None else -math.inf):
+                if remaining <= 0 or drawn[year] >= len(orders[year]):
+                    continue
+                if errors[year] is not None and errors[year] <= self.tolerance:
+                    continue
+                # The draws double, so the number of rounds stays logarithmic in the tail size
+                requests[year] = min(max(drawn[year], 1), len(orders[year]) - drawn[year], remaining)
+                remaining -= requests[year]
+
+        results = {}
+        for year, head in samples.items():
+            if len(head.similarities) == 0:
+                results[year] = head
+                continue
+            sample = draws.get(year, YearSample(similarities=[], types=[]))
+            mean, error = estimate_mean(head.similarities, sample.similarities, sizes[year], self.z)
+            results[year] = YearSample(similarities=head.similarities + sample.similarities,
+                                       types=head.types + sample.types, mean=mean, error=error)
+        return results
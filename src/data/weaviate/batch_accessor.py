@@ -0,0 +1,52 @@
+import threading
+from concurrent.futures import Future
+
+from data.weaviate.topic_vectorizer import topic_key
+from data.weaviate.weaviate_data_provider import WeaviateAccessor
+
+
+class BatchRetrievalAccessor:
+    """Shares the per-year retrieval between the queries of one batch, so identical topic sets are only fetched once."""
+
+    def __init__(self, accessor: WeaviateAccessor):
+        self.accessor = accessor
+
+        self.__lock = threading.Lock()
+        self.__results: dict[tuple, Future] = {}
+
+    def __getattr__(self, name):
+        return getattr(self.accessor, name)
+
+    def get_publications_per_year(self, concepts: list[str], cutoff: float, start_year: int, end_year: int):
+        return self.__shared(
+            ("per_year", topic_key(concepts), cutoff, start_year, end_year),
+            lambda: self.accessor.get_publications_per_year(
+                concepts, cutoff, start_year, end_year)
+        )
+
+    def get_publications_per_year_adjusted(self, concepts: list[str], year_stats: dict[int, int],
+                                           start_year: int, end_year: int):
+        # All queries of a batch share one data statistics snapshot, so it is not part of the key
+        return self.__shared(
+            ("per_year_adjusted", topic_key(concepts), start_year, end_year),
+            lambda: self.accessor.get_publications_per_year_adjusted(
+                concepts, year_stats, start_year, end_year)
+        )
+
+    def __shared(self, key: tuple, fetch):
+        with self.__lock:
+            future = self.__results.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.__results[key] = future
+
+        if is_owner:
+            try:
+                future.set_result(fetch())
+            except Exception as e:
+                with self.__lock:
+                    del self.__results[key]
+                future.set_exception(e)
+
+        return future.result()
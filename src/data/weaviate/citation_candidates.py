@@ -0,0 +1,63 @@
+import base64
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+
+SORT_ORDERS = ["relevance", "citations", "year"]
+
+
+@dataclass
+class CitationCandidates:
+    ids: list[str]
+    distances: np.ndarray
+    years: np.ndarray
+    citations: np.ndarray
+
+    def order(self, sort: str) -> np.ndarray:
+        # Candidates arrive ordered by distance, which also breaks ties for the other orders
+        if sort == "citations":
+            return np.lexsort((self.distances, -self.citations))
+        if sort == "year":
+            return np.lexsort((self.distances, -self.years))
+        return np.arange(len(self.ids))
+
+
+class CitationCandidateCache:
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[tuple, CitationCandidates] = OrderedDict()
+
+    def get(self, key: tuple, fetch: Callable[[], CitationCandidates]) -> CitationCandidates:
+        with self.__lock:
+            if key in self.__entries:
+                self.__entries.move_to_end(key)
+                return self.__entries[key]
+
+        candidates = fetch()
+
+        with self.__lock:
+            self.__entries[key] = candidates
+            if len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+        return candidates
+
+
+def encode_cursor(sort: str, offset: int) -> str:
+    return base64.urlsafe_b64encode(f"{sort}:{offset}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        sort, offset = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split(":")
+        if sort not in SORT_ORDERS or int(offset) < 0:
+            raise ValueError()
+        return sort, int(offset)
+    except Exception:
+        raise ValueError("Invalid cursor")
@@ -0,0 +1,189 @@
+import gzip
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Iterator
+
+from weaviate.classes import DataObject
+from weaviate.exceptions import WeaviateInsertManyAllFailedError
+from weaviate.util import generate_uuid5
+
+from data.weaviate.resilience import ResilientCaller
+
+
+@dataclass
+class IngestionCheckpoint:
+    source: str
+    offset: int = 0
+    inserted: int = 0
+    failed: int = 0
+    skipped: int = 0
+
+    @staticmethod
+    def load(path: str, source: str):
+        if path is None or not os.path.exists(path):
+            return IngestionCheckpoint(source)
+        with open(path) as f:
+            checkpoint = IngestionCheckpoint(**json.load(f))
+        if checkpoint.source != source:
+            raise ValueError("Checkpoint {} belongs to {}".format(path, checkpoint.source))
+        return checkpoint
+
+    def save(self, path: str):
+        with open(path + ".tmp", "w") as f:
+            json.dump(asdict(self), f)
+        os.replace(path + ".tmp", path)
+
+
+def read_records(path: str) -> Iterator[dict]:
+    if path.endswith(".parquet"):
+        # Only needed for Parquet dumps, so not imported with the module
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=1024):
+            yield from batch.to_pylist()
+        return
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        for line in f:
+            if line.strip() != "":
+                yield json.loads(line)
+
+
+def publication_uuid(doi: str):
+    # Deterministic, so loading the same DOI again replaces the object
+    return generate_uuid5(doi.strip().lower())
+
+
+def publication_object(record: dict, with_vectors: bool = True) -> DataObject | None:
+    if not record.get("doi") or not record.get("title") or record.get("year") is None:
+        return None
+
+    authors = record.get("authors") or []
+    vector = record.get("vector") if with_vectors else None
+    return DataObject(
+        properties={
+            "title": record["title"],
+            "abstract": record.get("abstract") or "",
+            "year": int(record["year"]),
+            "type": record.get("type") or "unknown",
+            "doi": record["doi"],
+            "authors": authors if isinstance(authors, list) else [author.strip() for author in authors.split(",")],
+            "n_citations": int(record.get("n_citations") or 0)
+        },
+        uuid=publication_uuid(record["doi"]),
+        vector=[float(x) for x in vector] if vector is not None else None
+    )
+
+
+@dataclass
+class StubBatchReturn:
+    errors: dict = field(default_factory=dict)
+
+
+class StubPublications:
+    """Stands in for the Publication collection when trying out dumps locally."""
+
+    def __init__(self):
+        self.data = self
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def insert_many(self, objects: list[DataObject]) -> StubBatchReturn:
+        with self.lock:
+            for obj in objects:
+                self.objects[str(obj.uuid)] = obj
+        return StubBatchReturn()
+
+
+class PublicationIngestion:
+    """Streams records into the collection in parallel batches, at most max_in_flight batches are pending.
+
+    The checkpoint offset only advances past batches that finished along with all batches before them,
+    so a resumed run repeats at most the batches that were in flight."""
+
+    def __init__(self, publications, batch_size: int = 200, workers: int = 4, max_in_flight: int = 8,
+                 with_vectors: bool = True, resilience: ResilientCaller | None = None):
+        self.publications = publications
+        self.batch_size = batch_size
+        self.workers = workers
+        self.with_vectors = with_vectors
+        self.resilience = resilience or ResilientCaller(deadline=120, retries=5, backoff=1)
+
+        self.__in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.__lock = threading.Lock()
+        self.__pending: set[int] = set()
+        self.__submitted = 0
+        self.__error = None
+
+    def run(self, source: str, checkpoint_path: str | None = None) -> IngestionCheckpoint:
+        checkpoint = IngestionCheckpoint.load(checkpoint_path, os.path.abspath(source))
+        if checkpoint.offset > 0:
+            print("Resuming {} at record {}".format(source, checkpoint.offset))
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            batch, start = [], checkpoint.offset
+            for i, record in enumerate(read_records(source)):
+                if i < checkpoint.offset:
+                    continue
+                if self.__error is not None:
+                    break
+
+                batch.append(record)
+                if len(batch) == self.batch_size:
+                    self.__submit(executor, batch, start, i + 1, checkpoint, checkpoint_path)
+                    batch, start = [], i + 1
+
+            if len(batch) > 0 and self.__error is None:
+                self.__submit(executor, batch, start, start + len(batch), checkpoint, checkpoint_path)
+
+        if self.__error is not None:
+            print("Ingestion stopped at record {}, rerun to resume".format(checkpoint.offset))
+            raise self.__error
+        return checkpoint
+
+    def __submit(self, executor: ThreadPoolExecutor, batch: list[dict], start: int, end: int,
+                 checkpoint: IngestionCheckpoint, checkpoint_path: str | None):
+        # Blocks the reader while the inserts are behind
+        self.__in_flight.acquire()
+        with self.__lock:
+            self.__pending.add(start)
+            self.__submitted = end
+        executor.submit(self.__insert, batch, start, checkpoint, checkpoint_path)
+
+    def __insert(self, batch: list[dict], start: int, checkpoint: IngestionCheckpoint,
+                 checkpoint_path: str | None):
+        try:
+            objects = [publication_object(record, self.with_vectors) for record in batch]
+            valid = [obj for obj in objects if obj is not None]
+
+            try:
+                results = self.resilience.call(
+                    "insert_many", lambda: self.publications.data.insert_many(valid)) if len(valid) > 0 else None
+                errors = results.errors if results is not None else {}
+                for index, error in list(errors.items())[:3]:
+                    print("Failed to insert {}: {}".format(valid[index].properties["doi"], error.message))
+            except WeaviateInsertManyAllFailedError as e:
+                # Rejected objects would be rejected again, so they do not stop the ingestion
+                print("Failed to insert batch at record {}: {}".format(start, e))
+                errors = valid
+
+            with self.__lock:
+                self.__pending.discard(start)
+                checkpoint.inserted += len(valid) - len(errors)
+                checkpoint.failed += len(errors)
+                checkpoint.skipped += len(objects) - len(valid)
+
+                # Everything before the oldest pending batch is done
+                watermark = min(self.__pending) if len(self.__pending) > 0 else self.__submitted
+                if watermark > checkpoint.offset:
+                    checkpoint.offset = watermark
+                    if checkpoint_path is not None:
+                        checkpoint.save(checkpoint_path)
+        except Exception as e:
+            self.__error = self.__error or e
+        finally:
+            self.__in_flight.release()
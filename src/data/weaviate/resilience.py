@@ -0,0 +1,190 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable
+
+import grpc
+import numpy as np
+import requests
+from weaviate.exceptions import UnexpectedStatusCodeException, WeaviateGrpcUnavailable, WeaviateQueryException
+
+from models.models import MethodMetrics
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Weaviate circuit is open")
+        self.retry_after = retry_after
+
+
+def is_transient(e: Exception) -> bool:
+    if isinstance(e, UnexpectedStatusCodeException):
+        return e.status_code >= 500 or e.status_code == 429
+    return isinstance(e, (TimeoutError, ConnectionError, requests.exceptions.RequestException, grpc.RpcError,
+                          WeaviateQueryException, WeaviateGrpcUnavailable))
+
+
+class CircuitBreaker:
+    """Opens after consecutive transient failures, after reset_after seconds a single trial call is let through."""
+
+    def __init__(self, failure_threshold: int = 5, reset_after: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_after else "open"
+
+    def before_call(self) -> bool:
+        # True if this call is the trial, which has to be ended with end_trial
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            remaining = self.reset_after - (time.monotonic() - self.opened_at)
+            if remaining > 0 or self.trial_running:
+                raise CircuitOpenError(max(1, int(np.ceil(remaining))))
+            self.trial_running = True
+            return True
+
+    def end_trial(self):
+        # Frees the trial slot of a call that ended without recording a result, e.g. when it was interrupted
+        with self.lock:
+            self.trial_running = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial_running:
+                    print("Weaviate circuit opened after {} failures".format(self.failures))
+                self.opened_at = time.monotonic()
+                self.trial_running = False
+
+
+class LatencyMetrics:
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self.methods: dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def record(self, method: str, latency: float | None = None, **counters: int):
+        with self.lock:
+            metrics = self.methods.setdefault(method, {
+                "latencies": deque(maxlen=self.window), "calls": 0, "errors": 0, "retries": 0, "hedges": 0, "timeouts": 0
+            })
+            if latency is not None:
+                metrics["latencies"].append(latency)
+            for name, count in counters.items():
+                metrics[name] += count
+
+    def snapshot(self) -> dict[str, MethodMetrics]:
+        with self.lock:
+            snapshot = {}
+            for method, metrics in self.methods.items():
+                p50, p95, p99 = np.percentile(metrics["latencies"], [50, 95, 99]) * 1000 \
+                    if len(metrics["latencies"]) > 0 else (None, None, None)
+                snapshot[method] = MethodMetrics(
+                    calls=metrics["calls"], errors=metrics["errors"], retries=metrics["retries"],
+                    hedges=metrics["hedges"], timeouts=metrics["timeouts"],
+                    p50_ms=None if p50 is None else float(p50),
+                    p95_ms=None if p95 is None else float(p95),
+                    p99_ms=None if p99 is None else float(p99)
+                )
+            return snapshot
+
+
+class ResilientCaller:
+    """Runs Weaviate calls with a deadline per attempt, retries with jittered backoff and optional hedging.
+
+    The gRPC queries of the client have no deadline of their own, so attempts run on a dedicated pool and
+    the caller stops waiting after the deadline. A stuck call keeps its thread, but not the query."""
+
+    def __init__(self, deadline: float = 30, retries: int = 2, backoff: float = 0.2, max_backoff: float = 5,
+                 hedge_after: float = 0, breaker: CircuitBreaker | None = None, max_concurrency: int = 32):
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = LatencyMetrics()
+        self.executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix="weaviate")
+
+    def call(self, method: str, fn: Callable, idempotent: bool = True, hedge: bool = False):
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            trial = self.breaker.before_call()
+            start = time.monotonic()
+            try:
+                result = self.__attempt(method, fn, hedge and idempotent and self.hedge_after > 0)
+            except Exception as e:
+                self.metrics.record(method, calls=1, errors=1, timeouts=int(isinstance(e, TimeoutError)))
+                if not is_transient(e):
+                    # Weaviate answered, so the call says nothing against its availability
+                    self.breaker.record_success()
+                    raise e
+                self.breaker.record_failure()
+                if attempt == attempts - 1:
+                    raise e
+
+                # Full jitter, so retries of concurrent queries do not arrive in lockstep
+                self.metrics.record(method, retries=1)
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+                continue
+            finally:
+                if trial:
+                    self.breaker.end_trial()
+
+            self.breaker.record_success()
+            self.metrics.record(method, time.monotonic() - start, calls=1)
+            return result
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def __attempt(self, method: str, fn: Callable, hedge: bool):
+        deadline = time.monotonic() + self.deadline
+        futures = [self.executor.submit(fn)]
+
+        if hedge:
+            done, _ = wait(futures, timeout=min(self.hedge_after, self.deadline))
+            if len(done) == 0:
+                # Slow primary, whichever of the two answers first wins
+                self.metrics.record(method, hedges=1)
+                futures.append(self.executor.submit(fn))
+
+        error = None
+        pending = set(futures)
+        while len(pending) > 0:
+            done, pending = wait(pending, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if len(done) == 0:
+                break
+            for future in done:
+                if future.exception() is None:
+                    self.__discard(pending)
+                    return future.result()
+                error = error or future.exception()
+
+        if error is not None and len(pending) == 0:
+            raise error
+        self.__discard(pending)
+        raise TimeoutError("Weaviate call {} exceeded its deadline of {}s".format(method, self.deadline))
+
+    def __discard(self, futures: set[Future]):
+        for future in futures:
+            future.cancel()
@@ -0,0 +1,42 @@
+import threading
+from collections import OrderedDict
+
+import httpx
+import numpy as np
+
+
+def topic_key(concepts: list[str]) -> tuple[str, ...]:
+    # Concept order does not matter, their vectors are averaged
+    return tuple(sorted(concept.strip() for concept in concepts))
+
+
+class TopicVectorizer:
+    def __init__(self, endpoint: str, timeout: float = 10, max_cached: int = 10000):
+        self.endpoint = endpoint.rstrip("/")
+        self.client = httpx.Client(timeout=timeout)
+        self.max_cached = max_cached
+
+        self.__lock = threading.Lock()
+        self.__cache: OrderedDict[str, np.ndarray] = OrderedDict()
+
+    def vectorize_concept(self, concept: str) -> np.ndarray:
+        with self.__lock:
+            if concept in self.__cache:
+                self.__cache.move_to_end(concept)
+                return self.__cache[concept]
+
+        response = self.client.post(
+            f"{self.endpoint}/vectors", json={"text": concept})
+        response.raise_for_status()
+        vector = np.array(response.json()["vector"], dtype=np.float32)
+
+        with self.__lock:
+            self.__cache[concept] = vector
+            if len(self.__cache) > self.max_cached:
+                self.__cache.popitem(last=False)
+
+        return vector
+
+    def vectorize(self, concepts: list[str]) -> list[float]:
+        # Same as Weaviate's near_text, which averages the vectors of all concepts
+        return np.mean([self.vectorize_concept(concept) for concept in concepts], axis=0).tolist()
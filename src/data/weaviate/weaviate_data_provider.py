@@ -1,21 +1,76 @@
 import weaviate
 from weaviate.classes import Filter, MetadataQuery
+from weaviate.classes.query import FilterMetadata
 
 import datetime
+import json
+import zlib
 import numpy as np
 
+from data.index.publication_index import LocalPublicationIndex
+from data.sampling.adaptive_sampler import AdaptiveSampler
+from data.weaviate.citation_candidates import CitationCandidateCache, CitationCandidates
+from data.weaviate.resilience import ResilientCaller
+from data.weaviate.topic_vectorizer import TopicVectorizer, topic_key
+from data.weaviate.year_sample_cache import YearSampleCache
+from models.models import Publication, YearSample
+
+PUBLICATION_PROPERTIES = ["title", "doi", "authors",
+                          "year", "type", "abstract", "n_citations"]
+
+# Aliased single publication searches per GraphQL request when drawing ranks
+RANK_BATCH_SIZE = 50
+
+
+def publication_from_object(obj, distance: float) -> Publication:
+    return Publication(
+        title=obj.properties["title"],
+        doi=obj.properties["doi"],
+        authors=obj.properties["authors"],
+        year=obj.properties["year"],
+        type=obj.properties["type"],
+        abstract=obj.properties["abstract"],
+        similarity=1-distance,
+        citations=obj.properties["n_citations"] if "n_citations" in obj.properties else None
+    )
+
 
 class WeaviateAccessor:
-    def __init__(self, client: weaviate.WeaviateClient):
+    def __init__(self, client: weaviate.WeaviateClient, vectorizer: TopicVectorizer | None = None,
+                 local_index: LocalPublicationIndex | None = None, sampler: AdaptiveSampler | None = None,
+                 citation_cache: CitationCandidateCache | None = None, citation_candidates: int = 500,
+                 resilience: ResilientCaller | None = None, year_cache: YearSampleCache | None = None):
         self.client = client
+        self.vectorizer = vectorizer
+        self.local_index = local_index
+        self.sampler = sampler
+        self.citation_cache = citation_cache
+        self.citation_candidates = citation_candidates
+        self.resilience = resilience or ResilientCaller()
+        self.year_cache = year_cache
+        # Bumped with every data statistics update, so cached years and citation candidates are not served across ingestions
+        self.data_version = 0
         self.publications = self.client.collections.get("Publication")
 
+    def __use_local_index(self, start_year: int, end_year: int) -> bool:
+        # The local index needs the topic vector, which only the vectorizer can provide
+        return self.local_index is not None and self.vectorizer is not None and self.local_index.covers(start_year, end_year)
+
+    def __near(self, search, concepts: list[str], method: str, hedge: bool = False, **kwargs):
+        # Vectorize locally when possible so repeated topics are only embedded once
+        if self.vectorizer is not None:
+            vector = self.vectorizer.vectorize(concepts)
+            return self.resilience.call(method, lambda: search.near_vector(near_vector=vector, **kwargs), hedge=hedge)
+        return self.resilience.call(method, lambda: search.near_text(query=concepts, **kwargs), hedge=hedge)
+
     def get_grouped_per_year(self, concepts: list[str],
                              cutoff: float, group_prop: str, start_year: int = 1000,
                              end_year: int = datetime.datetime.now().year):
 
-        return self.publications.aggregate_group_by.near_text(
-            query=concepts,
+        return self.__near(
+            self.publications.aggregate_group_by,
+            concepts,
+            "get_grouped_per_year",
             distance=1 - cutoff,
             filters=Filter("year").greater_or_equal(
                 start_year) & Filter("year").less_or_equal(end_year),
@@ -23,8 +78,10 @@ class WeaviateAccessor:
         )
 
     def get_publications_in_year(self, concepts: list[str], year: int, limit: int = 2000):
-        results = self.publications.query.near_text(
-            query=concepts,
+        results = self.__near(
+            self.publications.query,
+            concepts,
+            "get_publications_in_year",
             filters=Filter("year").equal(year),
             include_vector=True,
             return_properties=["title", "abstract", "year"],
@@ -36,6 +93,16 @@ class WeaviateAccessor:
     def get_publications_per_year(self, concepts: list[str],
                                   cutoff: float, start_year: int = 1000,
                                   end_year: int = datetime.datetime.now().year):
+        if self.year_cache is not None:
+            return self.year_cache.get_counts(
+                topic_key(concepts), self.data_version, cutoff, start_year, end_year,
+                lambda start, end: self.__count_per_year(concepts, cutoff, start, end))
+        return self.__count_per_year(concepts, cutoff, start_year, end_year)
+
+    def __count_per_year(self, concepts: list[str], cutoff: float, start_year: int, end_year: int) -> dict[int, int]:
+        if self.__use_local_index(start_year, end_year):
+            return self.local_index.count_per_year(self.vectorizer.vectorize(concepts), cutoff, start_year, end_year)
+
         query_results = self.get_grouped_per_year(
             concepts, cutoff, "year", start_year, end_year)
 
@@ -52,19 +119,86 @@ class WeaviateAccessor:
         return {**results_default, **results_query}
 
     def get_publications_per_year_adjusted(self, concepts: list[str], year_stats: dict[int, int],
-                                           start_year: int = 1000, end_year: int = datetime.datetime.now().year):
-        objects = []
-        for i in range(start_year, end_year + 1):
-            year_result = self.publications.query.near_text(
-                query=concepts,
-                filters=Filter("year").equal(i),
+                                           start_year: int = 1000, end_year: int = datetime.datetime.now().year) -> dict[int, YearSample]:
+        limits = {i: int(np.log10(year_stats[i])*10)
+                  for i in range(start_year, end_year + 1)}
+
+        if self.__use_local_index(start_year, end_year):
+            vector = self.vectorizer.vectorize(concepts)
+
+            def fetch(sizes):
+                return self.local_index.sample_per_year(vector, sizes)
+
+            def fetch_ranks(ranks):
+                return self.local_index.sample_ranks(vector, ranks)
+        else:
+            def fetch(sizes):
+                return self.__sample_per_year(concepts, sizes)
+
+            def fetch_ranks(ranks):
+                return self.__sample_ranks(concepts, ranks)
+
+        if self.year_cache is not None:
+            uncached = fetch
+
+            def fetch(sizes):
+                return self.year_cache.get_samples(topic_key(concepts), self.data_version, sizes, uncached)
+
+        if self.sampler is not None:
+            # Seeded by the topics, so the same query draws the same ranks
+            seed = zlib.crc32("\n".join(topic_key(concepts)).encode())
+            return self.sampler.sample(fetch, fetch_ranks, limits, seed)
+        return fetch(limits)
+
+    def __sample_per_year(self, concepts: list[str], limits: dict[int, int]) -> dict[int, YearSample]:
+        samples = {}
+        for year, limit in limits.items():
+            year_result = self.__near(
+                self.publications.query,
+                concepts,
+                "sample_per_year",
+                hedge=True,
+                filters=Filter("year").equal(year),
                 return_properties=["year", "type"],
                 return_metadata=MetadataQuery(distance=True),
-                limit=int(np.log10(year_stats[i])*10)
+                limit=limit
             )
-            objects += year_result.objects
+            samples[year] = YearSample(
+                similarities=[1 - x.metadata.distance for x in year_result.objects],
+                types=[x.properties["type"].lower()
+                       for x in year_result.objects]
+            )
+
+        return samples
+
+    def __sample_ranks(self, concepts: list[str], ranks: dict[int, list[int]]) -> dict[int, YearSample]:
+        # The client's near searches cannot skip results, a GraphQL search can with an offset. Every drawn rank is an
+        # aliased search for a single publication, so only the drawn publications are transferred
+        if self.vectorizer is not None:
+            near = "nearVector: {{vector: {}}}".format(json.dumps(self.vectorizer.vectorize(concepts)))
+        else:
+            near = "nearText: {{concepts: {}}}".format(json.dumps(concepts))
 
-        return objects
+        searches = [(year, rank) for year, year_ranks in ranks.items() for rank in year_ranks]
+        samples = {year: YearSample(similarities=[], types=[]) for year in ranks}
+        for start in range(0, len(searches), RANK_BATCH_SIZE):
+            batch = searches[start:start + RANK_BATCH_SIZE]
+            query = "{ Get { " + " ".join(
+                f'rank{i}: Publication({near}, where: {{path: ["year"], operator: Equal, valueInt: {year}}}, '
+                f'limit: 1, offset: {rank}) {{ type _additional {{ distance }} }}'
+                for i, (year, rank) in enumerate(batch)) + " } }"
+
+            result = self.resilience.call(
+                "sample_ranks", lambda: self.client.graphql_raw_query(query), hedge=True)
+            if result.errors:
+                raise RuntimeError("Drawing ranks failed: {}".format(result.errors))
+
+            for i, (year, _) in enumerate(batch):
+                for obj in result.get.get(f"rank{i}") or []:
+                    samples[year].similarities.append(1 - obj["_additional"]["distance"])
+                    samples[year].types.append(obj["type"].lower())
+
+        return samples
 
     def get_count_per_pub_type(self, concepts: list[str],
                                cutoff: float, start_year: int = 1000,
@@ -80,6 +214,74 @@ class WeaviateAccessor:
     def get_matching_publications(self, concepts: list[str], start_year: int,
                                   end_year: int, limit: int = 3000, min_citation_count: int | None = None):
 
+        results = self.__near(
+            self.publications.query,
+            concepts,
+            "get_matching_publications",
+            filters=self.__citation_filters(
+                start_year, end_year, min_citation_count),
+            return_properties=PUBLICATION_PROPERTIES,
+            return_metadata=MetadataQuery(distance=True),
+            limit=limit
+        )
+
+        return results.objects
+
+    def get_citation_page(self, concepts: list[str], start_year: int, end_year: int, min_citation_count: int | None,
+                          offset: int = 0, limit: int = 20, sort: str = "relevance") -> tuple[list[Publication], int]:
+        def fetch():
+            return self.__fetch_citation_candidates(concepts, start_year, end_year, min_citation_count)
+
+        key = (topic_key(concepts), self.data_version, start_year, end_year, min_citation_count)
+        candidates = self.citation_cache.get(
+            key, fetch) if self.citation_cache is not None else fetch()
+
+        page = candidates.order(sort)[offset:offset + limit]
+        objects = self.get_publications_by_ids(
+            [candidates.ids[i] for i in page])
+
+        publications = [publication_from_object(objects[candidates.ids[i]], float(candidates.distances[i]))
+                        for i in page if candidates.ids[i] in objects]
+        return publications, len(candidates.ids)
+
+    def get_publications_by_ids(self, ids: list[str]) -> dict:
+        if len(ids) == 0:
+            return {}
+
+        results = self.resilience.call("get_publications_by_ids", lambda: self.publications.query.fetch_objects(
+            filters=FilterMetadata.ById.contains_any(ids),
+            return_properties=PUBLICATION_PROPERTIES,
+            limit=len(ids)
+        ), hedge=True)
+
+        return {str(x.uuid): x for x in results.objects}
+
+    def __fetch_citation_candidates(self, concepts: list[str], start_year: int, end_year: int,
+                                    min_citation_count: int | None) -> CitationCandidates:
+        # Only what is needed for ranking, the full properties are fetched per page
+        results = self.__near(
+            self.publications.query,
+            concepts,
+            "citation_candidates",
+            hedge=True,
+            filters=self.__citation_filters(
+                start_year, end_year, min_citation_count),
+            return_properties=["year", "n_citations"],
+            return_metadata=MetadataQuery(distance=True),
+            limit=self.citation_candidates
+        )
+
+        return CitationCandidates(
+            ids=[str(x.uuid) for x in results.objects],
+            distances=np.array(
+                [x.metadata.distance for x in results.objects], dtype=np.float32),
+            years=np.array([x.properties["year"]
+                           for x in results.objects], dtype=np.int32),
+            citations=np.array([x.properties.get("n_citations") or 0
+                               for x in results.objects], dtype=np.int64)
+        )
+
+    def __citation_filters(self, start_year: int, end_year: int, min_citation_count: int | None):
         filters = Filter("year").greater_or_equal(
             start_year) & Filter("year").less_or_equal(end_year)
 
@@ -87,38 +289,35 @@ class WeaviateAccessor:
             filters = filters & Filter(
                 "n_citations").greater_or_equal(min_citation_count)
 
-        results = self.publications.query.near_text(
-            query=concepts,
-            filters=filters,
-            return_properties=["title", "doi", "authors",
-                               "year", "type", "abstract", "n_citations"],
-            return_metadata=MetadataQuery(distance=True),
-            limit=limit
-        )
-
-        return results.objects
+        return filters
 
     def get_matching_publications_with_vector(self, concepts: list[str], start_year: int,
-                                              end_year: int, limit: int = 3000):
+                                              end_year: int, limit: int = 3000, with_text: bool = True):
 
         filters = Filter("year").greater_or_equal(
             start_year) & Filter("year").less_or_equal(end_year)
 
-        results = self.publications.query.near_text(
-            query=concepts,
+        results = self.__near(
+            self.publications.query,
+            concepts,
+            "get_matching_publications_with_vector",
             filters=filters,
             include_vector=True,
-            return_properties=["title", "abstract", "year"],
+            return_properties=["title", "abstract", "year"] if with_text else ["year"],
+            return_metadata=MetadataQuery(distance=True),
             limit=limit
         )
 
         return results.objects
 
+    def iterate_publication_vectors(self):
+        return self.publications.iterator(include_vector=True, return_properties=["year", "type"])
+
     def get_statistics_for_year(self, year: int) -> int:
-        results = self.publications.aggregate_group_by.over_all(
+        results = self.resilience.call("get_statistics_for_year", lambda: self.publications.aggregate_group_by.over_all(
             filters=Filter("year").equal(year),
             group_by="year",
             total_count=True
-        )
+        ))
 
         return results[0].total_count
@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+import numpy as np
+
+from models.models import YearSample
+
+# Rough size of a key, its tuple and the array headers, counted on top of the array contents
+ENTRY_OVERHEAD = 256
+
+
+def year_ranges(years: list[int]) -> list[tuple[int, int]]:
+    ranges = []
+    for year in sorted(years):
+        if len(ranges) > 0 and ranges[-1][1] == year - 1:
+            ranges[-1] = (ranges[-1][0], year)
+        else:
+            ranges.append((year, year))
+    return ranges
+
+
+class YearSampleCache:
+    """Per-year samples and counts shared by all queries, so overlapping year ranges only fetch the new years.
+
+    Entries are keyed by topic set, year and data statistics version, counts additionally by their cutoff. Samples are
+    nearest first, so a sample serves every size up to the one it was fetched with. They are kept as float32 distances
+    and type codes, the least recently used entries are evicted once max_bytes is exceeded."""
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self.__lock = threading.Lock()
+        self.__entries: OrderedDict[tuple, tuple[int, object]] = OrderedDict()
+        self.__type_codes: dict[str, int] = {}
+        self.__types: list[str] = []
+
+    def get_samples(self, topic: tuple[str, ...], version: int, limits: dict[int, int],
+                    fetch: Callable[[dict[int, int]], dict[int, YearSample]]) -> dict[int, YearSample]:
+        keys = {year: ("sample", topic, year, version) for year in limits}
+        cached = {year: arrays for year, (fetched_limit, arrays) in self.__get(keys).items()
+                  if fetched_limit >= limits[year]}
+
+        samples = {year: self.__decode(arrays, limits[year]) for year, arrays in cached.items()}
+        missing = {year: limit for year, limit in limits.items() if year not in cached}
+        if len(missing) > 0:
+            fetched = fetch(missing)
+            for year, sample in fetched.items():
+                self.__put(keys[year], (missing[year], self.__encode(sample)))
+            samples.update(fetched)
+        return samples
+
+    def get_counts(self, topic: tuple[str, ...], version: int, cutoff: float, start_year: int, end_year: int,
+                   fetch: Callable[[int, int], dict[int, int]]) -> dict[int, int]:
+        # Missing years are fetched in as few contiguous ranges as possible
+        keys = {year: ("count", topic, year, version, round(cutoff, 6))
+                for year in range(start_year, end_year + 1)}
+        counts = self.__get(keys)
+
+        for start, end in year_ranges([year for year in keys if year not in counts]):
+            fetched = fetch(start, end)
+            for year in range(start, end + 1):
+                counts[year] = fetched.get(year, 0)
+                self.__put(keys[year], counts[year])
+        return counts
+
+    def __get(self, keys: dict[int, tuple]) -> dict:
+        values = {}
+        with self.__lock:
+            for year, key in keys.items():
+                if key in self.__entries:
+                    self.__entries.move_to_end(key)
+                    values[year] = self.__entries[key][1]
+        return values
+
+    def __put(self, key: tuple, value):
+        size = ENTRY_OVERHEAD + (sum(array.nbytes for array in value[1]) if isinstance(value, tuple) else 0)
+        with self.__lock:
+            if key in self.__entries:
+                self.size -= self.__entries.pop(key)[0]
+            self.__entries[key] = (size, value)
+            self.size += size
+            while self.size > self.max_bytes and len(self.__entries) > 0:
+                self.size -= self.__entries.popitem(last=False)[1][0]
+
+    def __encode(self, sample: YearSample) -> tuple[np.ndarray, np.ndarray]:
+        # Weaviate returns float32 distances, so storing those instead of the similarities loses nothing
+        distances = (1 - np.array(sample.similarities, dtype=np.float64)).astype(np.float32)
+        with self.__lock:
+            for pub_type in sample.types:
+                if pub_type not in self.__type_codes:
+                    self.__type_codes[pub_type] = len(self.__types)
+                    self.__types.append(pub_type)
+            codes = np.array([self.__type_codes[pub_type] for pub_type in sample.types], dtype=np.uint16)
+        return distances, codes
+
+    def __decode(self, arrays: tuple[np.ndarray, np.ndarray], limit: int) -> YearSample:
+        distances, codes = arrays[0][:limit], arrays[1][:limit]
+        return YearSample(
+            similarities=(1 - distances.astype(np.float64)).tolist(),
+            types=[self.__types[code] for code in codes.tolist()]
+        )
@@ -0,0 +1,42 @@
+import argparse
+import os
+import time
+
+import weaviate
+
+from data.index.term_index import export_term_index
+from trend.discovery.topic_discoverer import all_stopwords
+
+WEAVIATE_HOST = os.getenv("WEAVIATE_HOST", "weaviate")
+WEAVIATE_REST_PORT = os.getenv("WEAVIATE_PORT", "8080")
+WEAVIATE_GRPC_PORT = os.getenv("WEAVIATE_GRPC_PORT", "50051")
+WEAVIATE_ENDPOINT = f"http://{WEAVIATE_HOST}:{WEAVIATE_REST_PORT}"
+
+TERM_INDEX_PATH = os.getenv("TERM_INDEX_PATH")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tokenizes all publications into a term index snapshot, the backend picks up the new snapshot on its own")
+    parser.add_argument("directory", nargs="?", default=TERM_INDEX_PATH)
+    parser.add_argument("--min-df", type=int, default=2)
+    parser.add_argument("--max-features", type=int)
+    args = parser.parse_args()
+
+    if not args.directory:
+        parser.error("directory is required when TERM_INDEX_PATH is not set")
+
+    client = weaviate.WeaviateClient(
+        weaviate.ConnectionParams.from_url(WEAVIATE_ENDPOINT, WEAVIATE_GRPC_PORT))
+    publications = client.collections.get("Publication")
+
+    start = time.monotonic()
+    os.makedirs(args.directory, exist_ok=True)
+    snapshot = export_term_index(publications.iterator(return_properties=["title", "abstract"]), args.directory,
+                                 all_stopwords, min_df=args.min_df, max_features=args.max_features)
+
+    print("Exported term index to {} in {:.0f}s".format(snapshot, time.monotonic() - start))
+
+
+if __name__ == "__main__":
+    main()
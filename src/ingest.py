@@ -0,0 +1,60 @@
+import argparse
+import os
+import time
+
+import httpx
+import weaviate
+
+from data.weaviate.ingestion import PublicationIngestion, StubPublications
+
+WEAVIATE_HOST = os.getenv("WEAVIATE_HOST", "weaviate")
+WEAVIATE_REST_PORT = os.getenv("WEAVIATE_PORT", "8080")
+WEAVIATE_GRPC_PORT = os.getenv("WEAVIATE_GRPC_PORT", "50051")
+WEAVIATE_ENDPOINT = f"http://{WEAVIATE_HOST}:{WEAVIATE_REST_PORT}"
+
+API_ENDPOINT = os.getenv("API_ENDPOINT")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Loads JSONL (optionally gzipped) or Parquet dumps into the Publication collection, upserting by DOI")
+    parser.add_argument("source")
+    parser.add_argument("--checkpoint", help="defaults to <source>.checkpoint")
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument("--no-vectors", action="store_true",
+                        help="ignore precomputed vectors and let the transformer vectorize")
+    parser.add_argument("--stub", action="store_true",
+                        help="insert into an in-memory stub instead of Weaviate")
+    parser.add_argument("--api", default=API_ENDPOINT,
+                        help="backend to refresh the per-year statistics on when done")
+    args = parser.parse_args()
+
+    if args.stub:
+        publications = StubPublications()
+    else:
+        client = weaviate.WeaviateClient(
+            weaviate.ConnectionParams.from_url(WEAVIATE_ENDPOINT, WEAVIATE_GRPC_PORT))
+        publications = client.collections.get("Publication")
+
+    ingestion = PublicationIngestion(publications, args.batch_size, args.workers, args.max_in_flight,
+                                     with_vectors=not args.no_vectors)
+
+    start = time.monotonic()
+    checkpoint = ingestion.run(
+        args.source, args.checkpoint or args.source + ".checkpoint")
+
+    duration = time.monotonic() - start
+    print("Ingested {} publications in {:.0f}s ({:.0f}/s), {} failed, {} skipped".format(
+        checkpoint.inserted, duration, checkpoint.inserted / max(duration, 1e-9), checkpoint.failed, checkpoint.skipped))
+
+    if args.api and not args.stub:
+        response = httpx.post(f"{args.api.rstrip('/')}/api/statistics/refresh", timeout=600)
+        response.raise_for_status()
+        print("Refreshed statistics, total publications: {}".format(
+            response.json()["total_publications"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,50 @@
 from contextlib import asynccontextmanager
+import asyncio
 import datetime
 import asyncpg
+import json
+import math
 import os
+import uuid
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 
 from dotenv import load_dotenv
 from dataclasses import asdict
-from fastapi import Depends, FastAPI, BackgroundTasks, Response, status
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, Header, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import weaviate
+from weaviate.config import AdditionalConfig
 
-from models.models import DataStatistics, QueryEntry, QueryRequest
+from models.models import CitationPage, DataStatistics, QueryBatch, QueryBatchRequest, QueryBatchStatus, QueryDeriveRequest, QueryEntry, QueryPage, QueryProgress, QueryRequest, QueryStage, QueryType, TopicDiscoveryResults, TopicDocuments, TopicMergeRequest, TopicReduceRequest, TopicSplitRequest, WeaviateHealth
 from query_worker import process_query
 from data.process.access import prepare_database
-from data.process.query_repository import QueryRepository
-from data.weaviate.weaviate_data_provider import WeaviateAccessor
+from data.process.query_repository import QueryRepository, parse_fields
+from data.process.retention import QueryRetention
+from data.process.serialization import dumps
+from data.index.publication_index import LocalPublicationIndex, export_publication_index
+from data.index.term_index import TermIndex
+from data.sampling.adaptive_sampler import AdaptiveSampler
+from data.weaviate.batch_accessor import BatchRetrievalAccessor
+from data.weaviate.citation_candidates import SORT_ORDERS, CitationCandidateCache, decode_cursor, encode_cursor
+from data.weaviate.resilience import CircuitBreaker, CircuitOpenError, ResilientCaller
+from data.weaviate.topic_vectorizer import TopicVectorizer, topic_key
+from data.weaviate.weaviate_data_provider import WeaviateAccessor, publication_from_object
+from data.weaviate.year_sample_cache import YearSampleCache
+from scheduling.cancellation import CancellationToken
+from scheduling.memory_budget import MemoryBudget
+from scheduling.process_pool import CpuStagePool
+from scheduling.query_scheduler import QueryScheduler, QueueFullError
 from trend.analysis.trend_analyser import TrendAnalyser, get_trend_analyser
 from trend.chart.chart_generator import generate_trend_chart
+from trend.discovery.topic_artifacts import TopicArtifactStore, TopicArtifacts, merge_topics, reduce_topics, split_topic
 
 # Trend description
 from trend.descriptor.base_descriptor import BaseTrendDescriptor
+from trend.descriptor.description_stream import description_streams
 from trend.descriptor.gpt_descriptor import get_gpt_descriptor
 from trend.descriptor.rule_based_descriptor import get_rule_based_descriptor
 
@@ -39,8 +61,78 @@ WEAVIATE_REST_PORT = os.getenv("WEAVIATE_PORT", "8080")
 WEAVIATE_GRPC_PORT = os.getenv("WEAVIATE_GRPC_PORT", "50051")
 WEAVIATE_ENDPOINT = f"http://{WEAVIATE_HOST}:{WEAVIATE_REST_PORT}"
 
+# Deadline per attempt, idempotent reads are retried and tail latency sensitive ones hedged, 0 disables hedging
+WEAVIATE_CONNECT_TIMEOUT = int(os.getenv("WEAVIATE_CONNECT_TIMEOUT", "5"))
+WEAVIATE_DEADLINE = float(os.getenv("WEAVIATE_DEADLINE", "30"))
+WEAVIATE_RETRIES = int(os.getenv("WEAVIATE_RETRIES", "2"))
+WEAVIATE_BACKOFF = float(os.getenv("WEAVIATE_BACKOFF", "0.2"))
+WEAVIATE_HEDGE_AFTER_MS = int(os.getenv("WEAVIATE_HEDGE_AFTER_MS", "0"))
+WEAVIATE_BREAKER_FAILURES = int(os.getenv("WEAVIATE_BREAKER_FAILURES", "5"))
+WEAVIATE_BREAKER_RESET = float(os.getenv("WEAVIATE_BREAKER_RESET", "30"))
+WEAVIATE_MAX_CONCURRENCY = int(os.getenv("WEAVIATE_MAX_CONCURRENCY", "32"))
+
+TRANSFORMER_INFERENCE_ENDPOINT = os.getenv("TRANSFORMER_INFERENCE_ENDPOINT")
+
+# Adaptive sampling estimates the fixed mode's per-year means from their nearest ranks plus a random draw of the rest,
+# the budget defaults to half of what the fixed mode fetches
+SAMPLING_MODE = os.getenv("SAMPLING_MODE", "fixed")
+SAMPLING_BUDGET = int(os.getenv("SAMPLING_BUDGET", "0"))
+SAMPLING_TOLERANCE = float(os.getenv("SAMPLING_TOLERANCE", "0.005"))
+
+CITATION_CANDIDATES = int(os.getenv("CITATION_CANDIDATES", "500"))
+
+# Per-year samples and counts shared across queries, 0 disables the cache
+YEAR_SAMPLE_CACHE_MB = int(os.getenv("YEAR_SAMPLE_CACHE_MB", "256"))
+
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH")
+LOCAL_INDEX_QUANTIZATION = os.getenv("LOCAL_INDEX_QUANTIZATION", "float32")
+LOCAL_INDEX_REFRESH_HOURS = int(os.getenv("LOCAL_INDEX_REFRESH_HOURS", "24"))
+
+# Exported offline with export_term_index.py, the backend only loads the latest snapshot
+TERM_INDEX_PATH = os.getenv("TERM_INDEX_PATH")
+TERM_INDEX_RELOAD_MINUTES = int(os.getenv("TERM_INDEX_RELOAD_MINUTES", "10"))
+
+TOPIC_ARTIFACTS_PATH = os.getenv("TOPIC_ARTIFACTS_PATH")
+TOPIC_ARTIFACTS_MAX_MB = int(os.getenv("TOPIC_ARTIFACTS_MAX_MB", "2048"))
+
+# Concurrent topic discoveries share this budget, 0 disables the admission control
+TOPIC_DISCOVERY_MEMORY_MB = int(os.getenv("TOPIC_DISCOVERY_MEMORY_MB", "4096"))
+TOPIC_DISCOVERY_MIN_DOCUMENTS = int(
+    os.getenv("TOPIC_DISCOVERY_MIN_DOCUMENTS", "1000"))
+VECTOR_DIMENSION = int(os.getenv("VECTOR_DIMENSION", "768"))
+
+# Trend analysis and topic discovery run in worker processes, 0 keeps them in the thread pool
+CPU_STAGE_WORKERS = int(os.getenv("CPU_STAGE_WORKERS", "2"))
+CPU_STAGE_MAX_TASKS = int(os.getenv("CPU_STAGE_MAX_TASKS", "20"))
+
+# The most requested queries of the window are recomputed in the background, 0 disables it
+WARM_QUERIES_BUDGET = int(os.getenv("WARM_QUERIES_BUDGET", "20"))
+WARM_QUERIES_REFRESH_HOURS = int(os.getenv("WARM_QUERIES_REFRESH_HOURS", "24"))
+WARM_QUERIES_WINDOW_DAYS = int(os.getenv("WARM_QUERIES_WINDOW_DAYS", "7"))
+WARM_QUERIES_MIN_REQUESTS = int(os.getenv("WARM_QUERIES_MIN_REQUESTS", "2"))
+# A run that finds no idle capacity for this long is put off by the same time
+WARM_QUERIES_MAX_WAIT_MINUTES = int(os.getenv("WARM_QUERIES_MAX_WAIT_MINUTES", "30"))
+
 TRENDDESCRIPTOR = os.getenv("TREND_DESCRIPTOR", "rule_based")
 
+QUERY_QUEUE_SIZE = int(os.getenv("QUERY_QUEUE_SIZE", "50"))
+QUERY_FAST_LANE_CONCURRENCY = int(os.getenv("QUERY_FAST_LANE_CONCURRENCY", "8"))
+QUERY_HEAVY_LANE_CONCURRENCY = int(
+    os.getenv("QUERY_HEAVY_LANE_CONCURRENCY", "2"))
+QUERY_TREND_ANALYSIS_LIMIT = int(os.getenv("QUERY_TREND_ANALYSIS_LIMIT", "2"))
+QUERY_COMPLETE_LIMIT = int(os.getenv("QUERY_COMPLETE_LIMIT", "2"))
+# Unfinished queries are resumed on startup, after this many starts they are marked as failed instead
+QUERY_MAX_ATTEMPTS = int(os.getenv("QUERY_MAX_ATTEMPTS", "3"))
+
+# Finished results are compressed after a while and moved to the archive after their TTL, 0 keeps them forever
+RETENTION_INTERVAL_HOURS = int(os.getenv("RETENTION_INTERVAL_HOURS", "6"))
+RETENTION_COMPACT_AFTER_HOURS = int(
+    os.getenv("RETENTION_COMPACT_AFTER_HOURS", "24"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+RETENTION_TTL_DAYS = {
+    query_type: int(os.getenv(f"RETENTION_TTL_DAYS_{query_type.name}", "0")) for query_type in QueryType
+}
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -48,8 +140,34 @@ async def lifespan(app: FastAPI):
     app.state.pool = await asyncpg.create_pool(CONNECTION_STRING)
     app.state.weaviate_client = weaviate.WeaviateClient(
         weaviate.ConnectionParams.from_url(
-            WEAVIATE_ENDPOINT, WEAVIATE_GRPC_PORT)
+            WEAVIATE_ENDPOINT, WEAVIATE_GRPC_PORT),
+        additional_config=AdditionalConfig(
+            timeout=(WEAVIATE_CONNECT_TIMEOUT, math.ceil(WEAVIATE_DEADLINE)))
     )
+    app.state.topic_vectorizer = TopicVectorizer(
+        TRANSFORMER_INFERENCE_ENDPOINT) if TRANSFORMER_INFERENCE_ENDPOINT else None
+    app.state.local_index = LocalPublicationIndex.open(
+        LOCAL_INDEX_PATH) if LOCAL_INDEX_PATH else None
+    app.state.term_index = TermIndex.open(
+        TERM_INDEX_PATH) if TERM_INDEX_PATH else None
+    app.state.topic_artifacts = TopicArtifactStore(
+        TOPIC_ARTIFACTS_PATH, TOPIC_ARTIFACTS_MAX_MB * 1024 * 1024) if TOPIC_ARTIFACTS_PATH else None
+    app.state.memory_budget = MemoryBudget(
+        TOPIC_DISCOVERY_MEMORY_MB * 1024 * 1024, TOPIC_DISCOVERY_MIN_DOCUMENTS, VECTOR_DIMENSION) if TOPIC_DISCOVERY_MEMORY_MB > 0 else None
+    app.state.cpu_stages = CpuStagePool(CPU_STAGE_WORKERS, CPU_STAGE_MAX_TASKS, [
+        "trend.analysis.trend_analyser", "trend.discovery.discovery_stage"])
+    app.state.citation_cache = CitationCandidateCache()
+    app.state.year_cache = YearSampleCache(
+        YEAR_SAMPLE_CACHE_MB * 1024 * 1024) if YEAR_SAMPLE_CACHE_MB > 0 else None
+    app.state.sampler = AdaptiveSampler(
+        SAMPLING_BUDGET, SAMPLING_TOLERANCE) if SAMPLING_MODE == "adaptive" else None
+    app.state.weaviate_resilience = ResilientCaller(
+        WEAVIATE_DEADLINE, WEAVIATE_RETRIES, WEAVIATE_BACKOFF, hedge_after=WEAVIATE_HEDGE_AFTER_MS / 1000,
+        breaker=CircuitBreaker(WEAVIATE_BREAKER_FAILURES, WEAVIATE_BREAKER_RESET), max_concurrency=WEAVIATE_MAX_CONCURRENCY)
+    # One accessor for all requests, the collection handle and caches are shared
+    app.state.weaviate_accessor = WeaviateAccessor(
+        app.state.weaviate_client, app.state.topic_vectorizer, app.state.local_index, app.state.sampler,
+        app.state.citation_cache, CITATION_CANDIDATES, app.state.weaviate_resilience, app.state.year_cache)
 
     async with app.state.pool.acquire() as connection:
         await prepare_database(connection)
@@ -58,18 +176,57 @@ async def lifespan(app: FastAPI):
     update_data_statistics()
 
     scheduler.add_job(
-        update_data_statistics,
+        refresh_statistics,
         trigger=IntervalTrigger(hours=10)
     )
+    if LOCAL_INDEX_PATH:
+        # Export right away if there is no snapshot yet, queries fall back to Weaviate meanwhile
+        run_now = {} if app.state.local_index else {
+            "next_run_time": datetime.datetime.now()}
+        scheduler.add_job(
+            refresh_local_index,
+            trigger=IntervalTrigger(hours=LOCAL_INDEX_REFRESH_HOURS),
+            **run_now
+        )
+    if TERM_INDEX_PATH:
+        scheduler.add_job(
+            reload_term_index,
+            trigger=IntervalTrigger(minutes=TERM_INDEX_RELOAD_MINUTES)
+        )
+    scheduler.add_job(
+        run_retention,
+        trigger=IntervalTrigger(hours=RETENTION_INTERVAL_HOURS)
+    )
+    if WARM_QUERIES_BUDGET > 0:
+        scheduler.add_job(
+            warm_popular_queries,
+            trigger=IntervalTrigger(hours=WARM_QUERIES_REFRESH_HOURS)
+        )
     scheduler.start()
 
+    await recover_queries()
+
     yield
 
     # Shutdown
+    query_scheduler.shutdown()
+    app.state.cpu_stages.shutdown()
+    if app.state.local_index is not None:
+        app.state.local_index.executor.shutdown(wait=False)
+    app.state.weaviate_resilience.shutdown()
     await app.state.pool.close()
     scheduler.shutdown()
 
 scheduler = AsyncIOScheduler()
+query_scheduler = QueryScheduler(
+    fast_concurrency=QUERY_FAST_LANE_CONCURRENCY,
+    heavy_concurrency=QUERY_HEAVY_LANE_CONCURRENCY,
+    max_queued=QUERY_QUEUE_SIZE,
+    heavy_type_limits={
+        QueryType.TREND_ANALYSIS: QUERY_TREND_ANALYSIS_LIMIT,
+        QueryType.COMPLETE: QUERY_COMPLETE_LIMIT
+    }
+)
 app = FastAPI(openapi_url="/swagger.json", lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=[
                    "*"], allow_methods=["*"], allow_headers=["*"])
@@ -92,10 +249,10 @@ def get_trend_descriptor() -> BaseTrendDescriptor:
 
 
 def get_weaviate_accessor() -> WeaviateAccessor:
-    return WeaviateAccessor(app.state.weaviate_client)
+    return app.state.weaviate_accessor
 
 
-def update_data_statistics():
+def update_data_statistics() -> bool:
     print("Fetching data statistics ...")
 
     accessor = get_weaviate_accessor()
@@ -104,61 +261,580 @@ def update_data_statistics():
     for year in range(1980, datetime.datetime.now().year + 1):
         pubs_per_year[year] = accessor.get_statistics_for_year(year)
 
+    previous = getattr(app.state, "data_statistics", None)
     app.state.data_statistics = DataStatistics(
         total_publications=sum(pubs_per_year.values()),
-        publications_per_year=pubs_per_year
+        publications_per_year=pubs_per_year,
+        version=previous.version + 1 if previous is not None else 1
     )
+    # Cached per-year samples of the previous version are no longer served and age out
+    accessor.data_version = app.state.data_statistics.version
 
     print("Done fetching data statistics, total publications: {}".format(
         app.state.data_statistics.total_publications))
 
+    return previous is None or previous.publications_per_year != pubs_per_year
+
+
+async def refresh_statistics():
+    # Warm results were computed on the old data
+    if await run_in_threadpool(update_data_statistics) and WARM_QUERIES_BUDGET > 0:
+        scheduler.add_job(warm_popular_queries)
+
+
+async def run_query(uuid: str, weaviate_accessor: WeaviateAccessor, trend_analyser: TrendAnalyser,
+                    trend_descriptor: BaseTrendDescriptor, data_statistics: DataStatistics, cancellation: CancellationToken,
+                    parent: QueryEntry | None = None):
+    # Scheduled queries outlive the request, so they need their own connection
+    try:
+        async with app.state.pool.acquire() as connection:
+            await process_query(uuid, QueryRepository(connection), weaviate_accessor,
+                                trend_analyser, trend_descriptor, data_statistics, cancellation, app.state.term_index,
+                                app.state.topic_artifacts, parent, app.state.memory_budget, app.state.cpu_stages)
+    finally:
+        # Also ends the streams of queries that never reached the description stage
+        description_streams.finish(uuid)
+
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request, e: CircuitOpenError) -> JSONResponse:
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"message": "Search backend unavailable"},
+                        headers={"Retry-After": str(e.retry_after)})
+
+
+async def recover_queries():
+    print("Recovering unfinished queries ...")
+
+    async with app.state.pool.acquire() as connection:
+        query_repo = QueryRepository(connection)
+        entries, failed = await query_repo.recover_unfinished_queries(QUERY_MAX_ATTEMPTS)
+
+        resumed = 0
+        for entry in entries:
+            # Derived queries need their parent again unless their data retrieval already finished
+            parent = await query_repo.get_query_fields(entry.parent_uuid, parse_fields("search_results")) \
+                if entry.parent_uuid is not None else None
+            try:
+                query_scheduler.submit(entry.uuid, entry.type, lambda cancellation, query_id=entry.uuid, parent=parent: run_query(
+                    query_id, get_weaviate_accessor(), get_trend_analyser(), get_trend_descriptor(),
+                    app.state.data_statistics, cancellation, parent))
+                resumed += 1
+            except QueueFullError:
+                await query_repo.update_query_progress(entry.uuid, QueryProgress.FAILED)
+                failed += 1
+
+    print("Done recovering unfinished queries, resumed: {}, failed: {}".format(
+        resumed, failed))
+
+
+def queue_full_response(e: QueueFullError) -> JSONResponse:
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"message": "Too many queries in queue"},
+                        headers={"Retry-After": str(e.retry_after)})
+
+
+def refresh_local_index():
+    print("Exporting local publication index ...")
+
+    os.makedirs(LOCAL_INDEX_PATH, exist_ok=True)
+    snapshot = export_publication_index(
+        get_weaviate_accessor().iterate_publication_vectors(), LOCAL_INDEX_PATH, LOCAL_INDEX_QUANTIZATION)
+    previous = app.state.local_index
+    app.state.local_index = LocalPublicationIndex(
+        snapshot, executor=previous.executor if previous is not None else None)
+    app.state.weaviate_accessor.local_index = app.state.local_index
+
+    print("Done exporting local publication index to {}".format(snapshot))
+
+
+def reload_term_index():
+    snapshot = TermIndex.current(TERM_INDEX_PATH)
+    if snapshot is None or (app.state.term_index is not None and app.state.term_index.snapshot == snapshot):
+        return
+
+    app.state.term_index = TermIndex(snapshot)
+    print("Loaded term index {}".format(snapshot))
+
+
+async def run_retention():
+    print("Running query retention ...")
+
+    retention = {query_type: datetime.timedelta(days=days) if days > 0 else None
+                 for query_type, days in RETENTION_TTL_DAYS.items()}
+    async with app.state.pool.acquire() as connection:
+        compacted, archived = await QueryRetention(connection, datetime.timedelta(hours=RETENTION_COMPACT_AFTER_HOURS),
+                                                   retention, RETENTION_BATCH_SIZE, app.state.topic_artifacts).run()
+
+    print("Done running query retention, compacted: {}, archived: {}".format(
+        compacted, archived))
+
+
+warming_lock = asyncio.Lock()
+
+
+async def wait_until_idle(query_type: QueryType, timeout: float) -> bool:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not query_scheduler.idle(query_type):
+        if asyncio.get_running_loop().time() >= deadline:
+            return False
+        await asyncio.sleep(5)
+    return True
+
+
+async def warm_popular_queries():
+    if warming_lock.locked():
+        return
+
+    async with warming_lock:
+        print("Warming popular queries ...")
+
+        since = datetime.datetime.now(
+            datetime.timezone.utc) - datetime.timedelta(days=WARM_QUERIES_WINDOW_DAYS)
+        async with app.state.pool.acquire() as connection:
+            popular = await QueryRepository(connection).get_popular_queries(
+                since, WARM_QUERIES_BUDGET, WARM_QUERIES_MIN_REQUESTS)
+
+        warm = []
+        for request in popular:
+            # Interactive queries go first, warming only takes otherwise idle capacity and one query at a time
+            if not await wait_until_idle(request.query_type, WARM_QUERIES_MAX_WAIT_MINUTES * 60):
+                # The previous warm results stay in place until a run gets through
+                scheduler.add_job(warm_popular_queries, "date", run_date=datetime.datetime.now() +
+                                  datetime.timedelta(minutes=WARM_QUERIES_MAX_WAIT_MINUTES))
+                print("No idle capacity for warming, warmed: {}, retrying in {} minutes".format(
+                    len(warm), WARM_QUERIES_MAX_WAIT_MINUTES))
+                return
+
+            async with app.state.pool.acquire() as connection:
+                entry = await QueryRepository(connection).create_warm_query_entry(request)
+
+            done = asyncio.Event()
+
+            async def run(cancellation: CancellationToken, query_id=entry.uuid, done=done):
+                try:
+                    await run_query(query_id, get_weaviate_accessor(), get_trend_analyser(), get_trend_descriptor(),
+                                    app.state.data_statistics, cancellation)
+                finally:
+                    done.set()
+
+            try:
+                query_scheduler.submit(entry.uuid, entry.type, run)
+            except QueueFullError:
+                done.set()
+            await done.wait()
+
+            async with app.state.pool.acquire() as connection:
+                version = await QueryRepository(connection).get_query_version(entry.uuid)
+            if version is not None and version[1] == QueryProgress.FINISHED:
+                warm.append(entry.uuid)
+
+        # Previous warm results of queries that were refreshed or are no longer popular
+        async with app.state.pool.acquire() as connection:
+            replaced = await QueryRepository(connection).delete_warm_query_entries(warm)
+        if app.state.topic_artifacts is not None:
+            for query_id in replaced:
+                app.state.topic_artifacts.delete(query_id)
+
+        print("Done warming popular queries, warmed: {}, replaced: {}".format(
+            len(warm), len(replaced)))
+
 
 @app.post("/api/queries", response_model=QueryEntry, status_code=status.HTTP_201_CREATED)
-async def create_query(query_request: QueryRequest, background_tasks: BackgroundTasks, query_repo: QueryRepository = Depends(get_query_repository),
+async def create_query(query_request: QueryRequest, query_repo: QueryRepository = Depends(get_query_repository),
                        weaviate_accessor: WeaviateAccessor = Depends(get_weaviate_accessor), trend_analyser: TrendAnalyser = Depends(get_trend_analyser),
                        trend_descriptor: BaseTrendDescriptor = Depends(get_trend_descriptor)):
 
+    try:
+        query_scheduler.check_capacity(query_request.query_type)
+    except QueueFullError as e:
+        return queue_full_response(e)
+
     query_request.cutoff = max(0.7, min(0.98, query_request.cutoff))
+
+    warm = await query_repo.reuse_warm_query_entry(query_request) if WARM_QUERIES_BUDGET > 0 else None
+    if warm is not None:
+        return JSONResponse(status_code=status.HTTP_201_CREATED, content=asdict(warm))
+
     entry: QueryEntry = await query_repo.create_query_entry(query_request)
 
-    background_tasks.add_task(
-        process_query,
-        entry.uuid,
-        query_repo,
-        weaviate_accessor,
-        trend_analyser,
-        trend_descriptor,
-        app.state.data_statistics
-    )
+    data_statistics = app.state.data_statistics
+    try:
+        query_scheduler.submit(entry.uuid, entry.type, lambda cancellation: run_query(
+            entry.uuid, weaviate_accessor, trend_analyser, trend_descriptor, data_statistics, cancellation))
+    except QueueFullError as e:
+        # Queue filled up while the entry was being created
+        await query_repo.delete_query_entry(entry.uuid)
+        return queue_full_response(e)
+
+    entry.queue_position = query_scheduler.queue_position(entry.uuid)
 
     return JSONResponse(status_code=status.HTTP_201_CREATED, content=asdict(entry))
 
 
+@app.post("/api/queries/batch", response_model=QueryBatch, status_code=status.HTTP_201_CREATED)
+async def create_query_batch(batch_request: QueryBatchRequest, query_repo: QueryRepository = Depends(get_query_repository),
+                             weaviate_accessor: WeaviateAccessor = Depends(get_weaviate_accessor), trend_analyser: TrendAnalyser = Depends(get_trend_analyser),
+                             trend_descriptor: BaseTrendDescriptor = Depends(get_trend_descriptor)):
+    if len(batch_request.queries) == 0:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "Batch contains no queries"})
+
+    try:
+        query_scheduler.check_batch_capacity(
+            [query.query_type for query in batch_request.queries])
+    except QueueFullError as e:
+        return queue_full_response(e)
+
+    for query_request in batch_request.queries:
+        query_request.cutoff = max(0.7, min(0.98, query_request.cutoff))
+
+    batch_id = str(uuid.uuid4())
+    entries = await query_repo.create_query_entries(batch_request.queries, batch_id)
+
+    # One statistics snapshot and one retrieval cache for the whole batch, identical topic sets run back to back
+    data_statistics = app.state.data_statistics
+    batch_accessor = BatchRetrievalAccessor(weaviate_accessor)
+    ordered_entries = sorted(entries, key=lambda e: (
+        topic_key(e.topics), e.start_year, e.end_year))
+
+    try:
+        query_scheduler.submit_batch([
+            (entry.uuid, entry.type, lambda cancellation, query_id=entry.uuid: run_query(
+                query_id, batch_accessor, trend_analyser, trend_descriptor, data_statistics, cancellation))
+            for entry in ordered_entries
+        ])
+    except QueueFullError as e:
+        for entry in entries:
+            await query_repo.delete_query_entry(entry.uuid)
+        return queue_full_response(e)
+
+    return JSONResponse(status_code=status.HTTP_201_CREATED, content=asdict(QueryBatch(batch_id, [entry.uuid for entry in entries])))
+
+
+@app.post("/api/queries/{query_id}/derive", response_model=QueryEntry, status_code=status.HTTP_201_CREATED)
+async def derive_query(query_id: str, derive_request: QueryDeriveRequest, query_repo: QueryRepository = Depends(get_query_repository),
+                       weaviate_accessor: WeaviateAccessor = Depends(get_weaviate_accessor), trend_analyser: TrendAnalyser = Depends(get_trend_analyser),
+                       trend_descriptor: BaseTrendDescriptor = Depends(get_trend_descriptor)):
+    # Only the search results are reused from the parent, the topic model comes from its stored artifacts
+    parent = await query_repo.get_query_fields(query_id, parse_fields("search_results"))
+    if parent is None:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Query not found"})
+    if parent.progress != QueryProgress.FINISHED or not parent.type & QueryType.TREND_ANALYSIS \
+            or parent.results is None or parent.results.get("search_results") is None:
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT, content={"message": "Only finished trend analyses can be derived"})
+    if derive_request.start_year > derive_request.end_year:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "start_year must not be after end_year"})
+
+    try:
+        query_scheduler.check_capacity(parent.type)
+    except QueueFullError as e:
+        return queue_full_response(e)
+
+    if derive_request.cutoff is not None:
+        derive_request.cutoff = max(0.7, min(0.98, derive_request.cutoff))
+    entry: QueryEntry = await query_repo.create_derived_query_entry(parent, derive_request)
+
+    data_statistics = app.state.data_statistics
+    try:
+        query_scheduler.submit(entry.uuid, entry.type, lambda cancellation: run_query(
+            entry.uuid, weaviate_accessor, trend_analyser, trend_descriptor, data_statistics, cancellation, parent))
+    except QueueFullError as e:
+        await query_repo.delete_query_entry(entry.uuid)
+        return queue_full_response(e)
+
+    entry.queue_position = query_scheduler.queue_position(entry.uuid)
+
+    return JSONResponse(status_code=status.HTTP_201_CREATED, content=asdict(entry))
+
+
+@app.get("/api/queries/batch/{batch_id}", response_model=QueryBatchStatus)
+async def get_query_batch(batch_id: str, query_repo: QueryRepository = Depends(get_query_repository)):
+    batch_status = await query_repo.get_batch_status(batch_id)
+    if batch_status is None:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Batch not found"})
+    return JSONResponse(status_code=status.HTTP_200_OK, content=asdict(batch_status))
+
+
+@app.get("/api/health/weaviate", response_model=WeaviateHealth, status_code=status.HTTP_200_OK)
+async def get_weaviate_health():
+    resilience = app.state.weaviate_resilience
+    return JSONResponse(status_code=status.HTTP_200_OK, content=asdict(
+        WeaviateHealth(circuit=resilience.breaker.state, methods=resilience.metrics.snapshot())))
+
+
 @app.get("/api/statistics", response_model=DataStatistics, status_code=status.HTTP_200_OK)
 async def get_data_statistics():
     return JSONResponse(status_code=status.HTTP_200_OK, content=asdict(app.state.data_statistics))
 
 
+@app.post("/api/statistics/refresh", response_model=DataStatistics, status_code=status.HTTP_200_OK)
+async def refresh_data_statistics():
+    # Called after bulk ingestion instead of waiting for the next scheduled update
+    await refresh_statistics()
+    return JSONResponse(status_code=status.HTTP_200_OK, content=asdict(app.state.data_statistics))
+
+
+@app.get("/api/queries", response_model=QueryPage)
+async def list_queries(progress: QueryProgress | None = None, type: QueryType | None = None, topic: str | None = None,
+                       cursor: str | None = None, limit: int = 50, query_repo: QueryRepository = Depends(get_query_repository)):
+    limit = max(1, min(200, limit))
+    try:
+        entries, next_cursor = await query_repo.list_query_summaries(progress, type, topic, cursor, limit)
+    except ValueError:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "Invalid cursor"})
+
+    return JSONResponse(status_code=status.HTTP_200_OK, content=asdict(QueryPage(queries=entries, next_cursor=next_cursor)))
+
+
+def entity_tag(version: int, *variant) -> str:
+    return '"{}"'.format("-".join(str(part) for part in (version, *variant)))
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def cache_headers(progress: QueryProgress, etag: str) -> dict[str, str]:
+    # Finished and failed queries never change again, everything else has to be revalidated
+    immutable = progress in (QueryProgress.FINISHED, QueryProgress.FAILED)
+    return {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable" if immutable else "no-cache"
+    }
+
+
+async def not_modified(query_repo: QueryRepository, query_id: str, if_none_match: str | None, *variant) -> Response | None:
+    # Only the version is looked up, so revalidating a large query costs a primary key lookup
+    if if_none_match is None:
+        return None
+    version = await query_repo.get_query_version(query_id)
+    if version is None:
+        return None
+    etag = entity_tag(version[0], *variant)
+    if not etag_matches(if_none_match, etag):
+        return None
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers(version[1], etag))
+
+
 @app.get("/api/queries/{query_id}", response_model=QueryEntry)
-async def get_query(query_id: str, query_repo: QueryRepository = Depends(get_query_repository)):
-    entry = await query_repo.get_query_entry(query_id)
-    if entry is None:
+async def get_query(query_id: str, fields: str | None = None, if_none_match: str | None = Header(None),
+                    query_repo: QueryRepository = Depends(get_query_repository)):
+    try:
+        paths = parse_fields(fields) if fields is not None else None
+    except ValueError as e:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": str(e)})
+
+    variant = [",".join(".".join(path) for path in paths)] if paths else []
+    if (response := await not_modified(query_repo, query_id, if_none_match, *variant)) is not None:
+        return response
+
+    result = await (query_repo.get_query_fields_json(query_id, paths) if paths else query_repo.get_query_entry_json(query_id))
+    if result is None:
         return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Query not found"})
-    return JSONResponse(status_code=status.HTTP_200_OK, content=asdict(entry))
+    entry, body = result
+    return Response(content=body, media_type="application/json",
+                    headers=cache_headers(entry.progress, entity_tag(entry.version, *variant)))
 
 
 @app.get("/api/queries/{query_id}/summary", response_model=QueryEntry)
-async def get_query_summary(query_id: str, query_repo: QueryRepository = Depends(get_query_repository)):
+async def get_query_summary(query_id: str, if_none_match: str | None = Header(None),
+                            query_repo: QueryRepository = Depends(get_query_repository)):
+    # The queue position is not versioned, so it is part of the tag
+    queue_position = query_scheduler.queue_position(query_id)
+    if (response := await not_modified(query_repo, query_id, if_none_match, "summary", queue_position)) is not None:
+        return response
+
+    entry = await query_repo.get_query_summary(query_id)
+    if entry is None:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Query not found"})
+    entry.queue_position = queue_position
+    return Response(content=dumps(entry), media_type="application/json",
+                    headers=cache_headers(entry.progress, entity_tag(entry.version, "summary", queue_position)))
+
+
+@app.get("/api/queries/{query_id}/citations", response_model=CitationPage)
+async def get_citations(query_id: str, cursor: str | None = None, limit: int = 20, sort: str = "relevance",
+                        query_repo: QueryRepository = Depends(get_query_repository),
+                        weaviate_accessor: WeaviateAccessor = Depends(get_weaviate_accessor)):
+    entry = await query_repo.get_query_summary(query_id)
+    if entry is None:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Query not found"})
+
+    offset = 0
+    try:
+        if cursor is not None:
+            sort, offset = decode_cursor(cursor)
+    except ValueError:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "Invalid cursor"})
+
+    if sort not in SORT_ORDERS:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "Unknown sort order"})
+    limit = max(1, min(100, limit))
+
+    publications, total = await run_in_threadpool(
+        lambda: weaviate_accessor.get_citation_page(
+            entry.topics, entry.start_year, entry.end_year, entry.min_citations, offset, limit, sort)
+    )
+
+    page = CitationPage(
+        publications=publications,
+        total=total,
+        next_cursor=encode_cursor(
+            sort, offset + limit) if offset + limit < total else None
+    )
+    return JSONResponse(status_code=status.HTTP_200_OK, content=asdict(page))
+
+
+async def load_topic_artifacts(query_id: str, query_repo: QueryRepository) -> TopicArtifacts | None:
+    if app.state.topic_artifacts is None:
+        return None
+    entry = await query_repo.get_query_summary(query_id)
+    if entry is None:
+        return None
+    # Entries reusing warm results share the artifacts of the warm entry
+    return await run_in_threadpool(lambda: app.state.topic_artifacts.load(entry.source_uuid or entry.uuid))
+
+
+def topic_artifacts_missing() -> JSONResponse:
+    return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "No topic model stored for this query"})
+
+
+@app.get("/api/queries/{query_id}/topics/{topic_id}/documents", response_model=TopicDocuments)
+async def get_topic_documents(query_id: str, topic_id: int, offset: int = 0, limit: int = 20,
+                              query_repo: QueryRepository = Depends(get_query_repository),
+                              weaviate_accessor: WeaviateAccessor = Depends(get_weaviate_accessor)):
+    artifacts = await load_topic_artifacts(query_id, query_repo)
+    if artifacts is None:
+        return topic_artifacts_missing()
+
+    limit = max(1, min(100, limit))
+    members = artifacts.documents(topic_id)
+    page = members[max(0, offset):max(0, offset) + limit]
+
+    ids = [str(artifacts.doc_ids[i]) for i in page]
+    objects = await run_in_threadpool(lambda: weaviate_accessor.get_publications_by_ids(ids))
+
+    publications = [publication_from_object(objects[id], 1 - float(artifacts.similarities[i]))
+                    for id, i in zip(ids, page) if id in objects]
+
+    return JSONResponse(status_code=status.HTTP_200_OK, content=asdict(
+        TopicDocuments(topic_id=topic_id, publications=publications, total=len(members))))
+
+
+@app.post("/api/queries/{query_id}/topics/merge", response_model=TopicDiscoveryResults)
+async def merge_query_topics(query_id: str, merge_request: TopicMergeRequest,
+                             query_repo: QueryRepository = Depends(get_query_repository)):
+    artifacts = await load_topic_artifacts(query_id, query_repo)
+    if artifacts is None:
+        return topic_artifacts_missing()
+    if any(topic < 0 for group in merge_request.groups for topic in group):
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "Outliers cannot be merged"})
+
+    results = await run_in_threadpool(lambda: merge_topics(artifacts, merge_request.groups))
+    return Response(content=dumps(results), media_type="application/json")
+
+
+@app.post("/api/queries/{query_id}/topics/reduce", response_model=TopicDiscoveryResults)
+async def reduce_query_topics(query_id: str, reduce_request: TopicReduceRequest,
+                              query_repo: QueryRepository = Depends(get_query_repository)):
+    artifacts = await load_topic_artifacts(query_id, query_repo)
+    if artifacts is None:
+        return topic_artifacts_missing()
+    if reduce_request.nr_topics < 1:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "nr_topics must be positive"})
+
+    results = await run_in_threadpool(lambda: reduce_topics(artifacts, reduce_request.nr_topics))
+    return Response(content=dumps(results), media_type="application/json")
+
+
+@app.post("/api/queries/{query_id}/topics/split", response_model=TopicDiscoveryResults)
+async def split_query_topic(query_id: str, split_request: TopicSplitRequest,
+                            query_repo: QueryRepository = Depends(get_query_repository)):
+    artifacts = await load_topic_artifacts(query_id, query_repo)
+    if artifacts is None:
+        return topic_artifacts_missing()
+    if split_request.topic < 0:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"message": "Outliers cannot be split"})
+    if split_request.nr_topics < 2 or (artifacts.topic_labels == split_request.topic).sum() < split_request.nr_topics:
+        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST,
+                            content={"message": "nr_topics must be at least 2 and at most the topic's size"})
+
+    results = await run_in_threadpool(lambda: split_topic(artifacts, split_request.topic, split_request.nr_topics))
+    return Response(content=dumps(results), media_type="application/json")
+
+
+@app.get("/api/queries/{query_id}/description/stream")
+async def stream_trend_description(query_id: str, query_repo: QueryRepository = Depends(get_query_repository)):
+    entry = await query_repo.get_query_summary(query_id)
+    if entry is None:
+        return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Query not found"})
+    if not entry.type & QueryType.TREND_ANALYSIS:
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+    stream = description_streams.get(query_id)
+    if stream is None and not entry.completed_stages & QueryStage.TREND_DESCRIPTION \
+            and query_scheduler.scheduled(query_id):
+        stream = description_streams.open(query_id)
+
+    if stream is not None:
+        subscription = stream.subscribe()
+    else:
+        # Nothing is generated here anymore, send the stored description in one go if there is one
+        full_entry = await query_repo.get_query_entry(query_id)
+        trend_results = (full_entry.results or {}).get("trend_results") or {}
+        if not trend_results.get("trend_description"):
+            return Response(status_code=status.HTTP_204_NO_CONTENT)
+        events = [("replace", trend_results["trend_description"]), ("done", "")]
+
+        async def stored_events():
+            for event in events:
+                yield event
+        subscription = stored_events()
+
+    async def server_sent_events():
+        async for event, data in subscription:
+            yield "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+    return StreamingResponse(server_sent_events(), media_type="text/event-stream")
+
+
+@app.delete("/api/queries/{query_id}")
+async def delete_query(query_id: str, query_repo: QueryRepository = Depends(get_query_repository)):
     entry = await query_repo.get_query_summary(query_id)
     if entry is None:
         return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Query not found"})
-    return JSONResponse(status_code=status.HTTP_200_OK, content=asdict(entry))
+
+    # Precomputed results are shared with the entries reusing them through source_uuid
+    if await query_repo.is_warm_query_entry(query_id):
+        return JSONResponse(status_code=status.HTTP_409_CONFLICT,
+                            content={"message": "Precomputed query results cannot be deleted"})
+
+    # Queued or running queries are cancelled and kept so pollers see the final state, everything else is removed
+    if query_scheduler.cancel(query_id):
+        await query_repo.update_query_progress(query_id, QueryProgress.CANCELLED)
+        # A query cancelled before it started never runs its pipeline
+        description_streams.finish(query_id)
+        return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={"message": "Query cancelled"})
+
+    await query_repo.delete_query_entry(query_id)
+    if app.state.topic_artifacts is not None:
+        app.state.topic_artifacts.delete(query_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+CHART_FIELDS = parse_fields(
+    "search_results.adjusted,trend_results.sub_trends,trend_results.breakpoints")
 
 
 @app.head("/api/queries/{query_id}/chart")
 @app.get("/api/queries/{query_id}/chart")
-async def get_trend_chart(query_id: str, query_repo: QueryRepository = Depends(get_query_repository), format: str = "svg"):
-    entry = await query_repo.get_query_entry(query_id)
+async def get_trend_chart(query_id: str, query_repo: QueryRepository = Depends(get_query_repository), format: str = "svg",
+                          if_none_match: str | None = Header(None)):
+    if (response := await not_modified(query_repo, query_id, if_none_match, "chart", format)) is not None:
+        return response
+
+    entry = await query_repo.get_query_fields(query_id, CHART_FIELDS)
     if entry is None:
         return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content={"message": "Query not found"})
 
@@ -166,9 +842,8 @@ async def get_trend_chart(query_id: str, query_repo: QueryRepository = Depends(g
 
     headers = {
         "Content-Type": "image/png" if format == "png" else "image/svg+xml",
-        "Cache-Control": "public,max-age=3600",
         "Accept-Ranges": "bytes",
-        "etag": "1",
+        **cache_headers(entry.progress, entity_tag(entry.version, "chart", format))
     }
 
     return Response(content=content, headers=headers, media_type=headers["Content-Type"])
@@ -19,6 +19,15 @@ class QueryProgress(int, Enum):
     TOPICS_OVER_TIME = 7
     FINISHED = 8
     FAILED = 9
+    CANCELLED = 10
+
+
+class QueryStage(int, Enum):
+    DATA_RETRIEVAL = 1
+    TREND_ANALYSIS = 2
+    TREND_DESCRIPTION = 4
+    CITATION_RETRIEVAL = 8
+    TOPIC_DISCOVERY = 16
 
 
 class TrendType(int, Enum):
@@ -45,6 +54,29 @@ class QueryRequest(BaseModel):
     min_citations: int = 0
 
 
+class QueryBatchRequest(BaseModel):
+    queries: list[QueryRequest]
+
+
+class QueryDeriveRequest(BaseModel):
+    start_year: int
+    end_year: int
+    cutoff: float | None = None
+
+
+class TopicMergeRequest(BaseModel):
+    groups: list[list[int]]
+
+
+class TopicReduceRequest(BaseModel):
+    nr_topics: int
+
+
+class TopicSplitRequest(BaseModel):
+    topic: int
+    nr_topics: int = 2
+
+
 @dataclass
 class SearchResults:
     raw: list[float]
@@ -52,6 +84,10 @@ class SearchResults:
     adjusted: list[float]
     pub_types: dict[str, int]
     adjusted_cutoff: float | None = None
+    # 95% confidence half-widths of the per-year estimates, only with adaptive sampling
+    raw_errors: list[float | None] | None = None
+    adjusted_errors: list[float | None] | None = None
+    pub_types_per_year: dict[int, dict[str, int]] | None = None
 
 
 @dataclass
@@ -111,6 +147,20 @@ class CitationRecommendationResults:
     publications: list[Publication]
 
 
+@dataclass
+class CitationPage:
+    publications: list[Publication]
+    total: int
+    next_cursor: str | None = None
+
+
+@dataclass
+class TopicDocuments:
+    topic_id: int
+    publications: list[Publication]
+    total: int
+
+
 @dataclass
 class AnalysisResults:
     search_results: SearchResults | None = None
@@ -130,9 +180,68 @@ class QueryEntry:
     cutoff: float
     min_citations: int
     results: None | AnalysisResults | CitationRecommendationResults
+    queue_position: int | None = None
+    batch_id: str | None = None
+    created_at: str | None = None
+    finished_at: str | None = None
+    version: int = 0
+    parent_uuid: str | None = None
+    completed_stages: int = 0
+    attempts: int = 0
+    source_uuid: str | None = None
+
+
+@dataclass
+class QueryPage:
+    queries: list[QueryEntry]
+    next_cursor: str | None = None
+
+
+@dataclass
+class QueryBatch:
+    batch_id: str
+    uuids: list[str]
+
+
+@dataclass
+class QueryBatchStatus:
+    batch_id: str
+    total: int
+    finished: int
+    failed: int
+    cancelled: int
+    queries: dict[str, QueryProgress]
+
+
+@dataclass
+class YearSample:
+    similarities: list[float]
+    types: list[str]
+    # Estimated by adaptive sampling, otherwise the mean of the similarities
+    mean: float | None = None
+    error: float | None = None
 
 
 @dataclass
 class DataStatistics:
     total_publications: int
     publications_per_year: dict[int, int]
+    version: int = 0
+
+
+@dataclass
+class MethodMetrics:
+    calls: int
+    errors: int
+    retries: int
+    hedges: int
+    timeouts: int
+    p50_ms: float | None = None
+    p95_ms: float | None = None
+    p99_ms: float | None = None
+
+
+@dataclass
+class WeaviateHealth:
+    circuit: str
+    methods: dict[str, MethodMetrics]
@@ -1,53 +1,86 @@
+import gc
 import numpy as np
 from fastapi.concurrency import run_in_threadpool
 
+from data.index.term_index import TermIndex
 from data.process.query_repository import QueryRepository
+from data.process.serialization import results_from_dict
 from data.weaviate.weaviate_data_provider import WeaviateAccessor
 
-from models.models import AnalysisResults, CitationRecommendationResults, DataStatistics, Publication, QueryEntry, QueryProgress, QueryType, SearchResults, TopicDiscoveryResults, TrendResults
+from models.models import AnalysisResults, CitationRecommendationResults, DataStatistics, QueryEntry, QueryProgress, QueryStage, QueryType, SearchResults, TrendResults
 
+from scheduling.cancellation import CancellationToken, QueryCancelledError
+from scheduling.memory_budget import MemoryBudget
+from scheduling.process_pool import CpuStagePool, SharedArray
 from trend.descriptor.base_descriptor import BaseTrendDescriptor
+from trend.descriptor.description_stream import description_streams
 from trend.analysis.trend_analyser import TrendAnalyser
-from trend.discovery.topic_discoverer import TopicDiscoverer
+from trend.discovery.discovery_stage import discover_topics
+from trend.discovery.topic_artifacts import TopicArtifacts, TopicArtifactStore, topic_discovery_results
 
 
 async def process_query(uuid: str, query_repo: QueryRepository,
                         weaviate_accessor: WeaviateAccessor, trend_analyser: TrendAnalyser,
-                        trend_descriptor: BaseTrendDescriptor, data_statistics: DataStatistics):
+                        trend_descriptor: BaseTrendDescriptor, data_statistics: DataStatistics,
+                        cancellation: CancellationToken | None = None, term_index: TermIndex | None = None,
+                        artifact_store: TopicArtifactStore | None = None, parent: QueryEntry | None = None,
+                        memory_budget: MemoryBudget | None = None, cpu_stages: CpuStagePool | None = None):
+
+    cancellation = cancellation or CancellationToken()
+    cpu_stages = cpu_stages or CpuStagePool(0)
 
     entry = await query_repo.get_query_entry(uuid)
-    entry.results = AnalysisResults()
+    # An interrupted query continues on the stored results of its completed stages
+    completed = entry.completed_stages
+    entry.results = results_from_dict(entry.results) if completed else AnalysisResults()
+    await query_repo.start_query_attempt(uuid)
 
-    if entry.type & QueryType.TREND_ANALYSIS:
-        try:
+    try:
+        if entry.type & QueryType.TREND_ANALYSIS:
+            cancellation.raise_if_cancelled()
             await __analyse_trends(query_repo, entry, trend_analyser,
-                                   trend_descriptor, weaviate_accessor, data_statistics)
-        except Exception as e:
-            await query_repo.update_query_progress(entry.uuid, QueryProgress.FAILED)
-            raise e
+                                   trend_descriptor, weaviate_accessor, data_statistics, cancellation, cpu_stages,
+                                   completed, parent)
 
-    if entry.type & QueryType.CITATION_RECOMMENDATION:
-        try:
+        if entry.type & QueryType.CITATION_RECOMMENDATION and not completed & QueryStage.CITATION_RETRIEVAL:
+            cancellation.raise_if_cancelled()
             await __fetch_citation_recommendations(query_repo, entry, weaviate_accessor)
-        except Exception as e:
-            await query_repo.update_query_progress(entry.uuid, QueryProgress.FAILED)
-            raise e
 
-    if entry.type & QueryType.TREND_ANALYSIS:
-        try:
-            await __discover_topics(query_repo, entry, weaviate_accessor)
-        except Exception as e:
-            await query_repo.update_query_progress(entry.uuid, QueryProgress.FAILED)
-            raise e
+        if entry.type & QueryType.TREND_ANALYSIS and not completed & QueryStage.TOPIC_DISCOVERY:
+            cancellation.raise_if_cancelled()
+            # The parent's topic model only covers its own years, wider ranges are fitted again
+            parent_artifacts = await run_in_threadpool(
+                lambda: artifact_store.load(parent.source_uuid or parent.uuid)) if parent is not None and artifact_store is not None \
+                and parent.start_year <= entry.start_year and entry.end_year <= parent.end_year else None
+            if parent_artifacts is not None:
+                await __derive_topics(query_repo, entry, parent_artifacts, artifact_store)
+            else:
+                await __discover_topics(query_repo, entry, weaviate_accessor, cancellation, term_index, artifact_store,
+                                        memory_budget, cpu_stages)
+    except QueryCancelledError:
+        if cancellation.interrupted:
+            print("Query {} interrupted".format(entry.uuid))
+            return
+        print("Query {} cancelled".format(entry.uuid))
+        await query_repo.update_query_progress(entry.uuid, QueryProgress.CANCELLED)
+        # Drop the intermediate results of the abandoned query right away
+        entry.results = None
+        gc.collect()
+        return
+    except Exception as e:
+        await query_repo.update_query_progress(entry.uuid, QueryProgress.FAILED)
+        raise e
 
     await query_repo.update_query_progress(entry.uuid, QueryProgress.FINISHED)
 
 
-async def __fetch_data(query_repo: QueryRepository, entry: QueryEntry, weaviate_accessor: WeaviateAccessor, data_statistics: DataStatistics):
+async def __fetch_data(query_repo: QueryRepository, entry: QueryEntry, weaviate_accessor: WeaviateAccessor, data_statistics: DataStatistics,
+                       cancellation: CancellationToken):
     num_pubs_found = 0
     adjusted_cutoff = entry.cutoff
 
     while num_pubs_found < 500:
+        cancellation.raise_if_cancelled()
         per_year = await run_in_threadpool(
             lambda: weaviate_accessor.get_publications_per_year(
                 entry.topics, adjusted_cutoff, entry.start_year, entry.end_year)
@@ -59,150 +92,261 @@ async def __fetch_data(query_repo: QueryRepository, entry: QueryEntry, weaviate_
             print("Adjusting cutoff to ", adjusted_cutoff)
 
     await query_repo.update_query_entry(entry)
+    cancellation.raise_if_cancelled()
+
+    year_values = await __fetch_year_values(
+        entry, weaviate_accessor, data_statistics, entry.start_year, entry.end_year)
+
+    entry.results.search_results = __search_results(
+        entry, per_year, year_values, adjusted_cutoff)
+
+    # Return entry here since we updates properties
+    return entry
+
+
+async def __derive_data(query_repo: QueryRepository, entry: QueryEntry, parent: QueryEntry, weaviate_accessor: WeaviateAccessor,
+                        data_statistics: DataStatistics, cancellation: CancellationToken):
+    parent_results = parent.results["search_results"]
+    parent_years = range(parent.start_year, parent.end_year + 1)
+
+    # The parent's effective cutoff is kept, the counts only depend on it
+    same_cutoff = entry.cutoff == parent.cutoff
+    adjusted_cutoff = (parent_results["adjusted_cutoff"] or parent.cutoff) if same_cutoff else entry.cutoff
+
+    per_year, year_values = {}, {}
+    for i, year in enumerate(parent_years):
+        if entry.start_year <= year <= entry.end_year:
+            types = (parent_results.get("pub_types_per_year") or {}).get(str(year), {})
+            errors = parent_results.get("raw_errors") or []
+            year_values[year] = (parent_results["raw"][i], errors[i] if i < len(errors) else None, types)
+            if same_cutoff:
+                per_year[year] = parent_results["raw_per_year"][i]
+
+    # Only the years outside of the parent's range are retrieved
+    for start, end in __missing_ranges(entry.start_year, entry.end_year, set(year_values)):
+        cancellation.raise_if_cancelled()
+        year_values.update(await __fetch_year_values(entry, weaviate_accessor, data_statistics, start, end))
+
+    for start, end in __missing_ranges(entry.start_year, entry.end_year, set(per_year)):
+        cancellation.raise_if_cancelled()
+        per_year.update(await run_in_threadpool(
+            lambda: weaviate_accessor.get_publications_per_year(
+                entry.topics, adjusted_cutoff, start, end)
+        ))
+
+    entry.results.search_results = __search_results(
+        entry, per_year, year_values, adjusted_cutoff)
+    return entry
 
-    pub_objects = await run_in_threadpool(
+
+def __missing_ranges(start_year: int, end_year: int, known: set[int]) -> list[tuple[int, int]]:
+    ranges = []
+    for year in range(start_year, end_year + 1):
+        if year in known:
+            continue
+        if len(ranges) > 0 and ranges[-1][1] == year - 1:
+            ranges[-1] = (ranges[-1][0], year)
+        else:
+            ranges.append((year, year))
+    return ranges
+
+
+async def __fetch_year_values(entry: QueryEntry, weaviate_accessor: WeaviateAccessor, data_statistics: DataStatistics,
+                              start_year: int, end_year: int) -> dict[int, tuple[float, float | None, dict[str, int]]]:
+    year_samples = await run_in_threadpool(
         lambda: weaviate_accessor.get_publications_per_year_adjusted(
-            entry.topics, data_statistics.publications_per_year, entry.start_year, entry.end_year)
+            entry.topics, data_statistics.publications_per_year, start_year, end_year)
     )
 
-    year_value_pairs = {year: []
-                        for year in range(entry.start_year, entry.end_year + 1)}
-    pub_type_count = {}
+    year_values = {}
+    for year in range(start_year, end_year + 1):
+        sample = year_samples[year]
+        types = {}
+        for pub_type in sample.types:
+            types[pub_type] = types.get(pub_type, 0) + 1
+        mean = sample.mean if sample.mean is not None else np.mean(sample.similarities)
+        year_values[year] = (mean, sample.error, types)
+    return year_values
 
-    for pub_object in pub_objects:
-        year_value_pairs[int(pub_object.properties["year"])].append(
-            (1 - pub_object.metadata.distance))
-        pub_type = pub_object.properties["type"].lower()
-        pub_type_count[pub_type] = (
-            pub_type_count[pub_type] if pub_type in pub_type_count else 0) + 1
 
-    raw_values = [
-        np.mean(year_value_pairs[year]) for year in range(entry.start_year, entry.end_year + 1)
-    ]
+def __search_results(entry: QueryEntry, per_year: dict[int, int], year_values: dict[int, tuple[float, float | None, dict[str, int]]],
+                     adjusted_cutoff: float) -> SearchResults:
+    years = range(entry.start_year, entry.end_year + 1)
+
+    pub_type_count = {}
+    for year in years:
+        for pub_type, count in year_values[year][2].items():
+            pub_type_count[pub_type] = pub_type_count.get(pub_type, 0) + count
+
+    raw_values = [year_values[year][0] for year in years]
+    raw_errors = [year_values[year][1] for year in years]
 
     clamped_values = np.maximum(raw_values, adjusted_cutoff)
 
     if np.max(clamped_values) > np.min(clamped_values):
         adjusted_values = np.round(100 * (np.array(clamped_values) - np.min(clamped_values)) / (
             np.max(clamped_values) - np.min(clamped_values))).tolist()
+        adjusted_errors = [None if error is None else 100 * error / (np.max(clamped_values) - np.min(clamped_values))
+                           for error in raw_errors]
     else:
-        adjusted_values = [0 for _ in range(
-            entry.start_year, entry.end_year + 1)]
+        adjusted_values = [0 for _ in years]
+        adjusted_errors = [None for _ in raw_errors]
 
-    per_year_values = [per_year[year]
-                       for year in range(entry.start_year, entry.end_year + 1)]
-
-    entry.results.search_results = SearchResults(
+    return SearchResults(
         raw=raw_values,
-        raw_per_year=per_year_values,
+        raw_per_year=[per_year[year] for year in years],
         adjusted=adjusted_values,
         pub_types=pub_type_count,
-        adjusted_cutoff=adjusted_cutoff if adjusted_cutoff != entry.cutoff else None
+        adjusted_cutoff=adjusted_cutoff if adjusted_cutoff != entry.cutoff else None,
+        raw_errors=raw_errors,
+        adjusted_errors=adjusted_errors,
+        pub_types_per_year={year: year_values[year][2] for year in years}
     )
 
-    # Return entry here since we updates properties
-    return entry
-
 
 async def __analyse_trends(query_repo: QueryRepository, entry: QueryEntry, trend_analyser: TrendAnalyser,
                            trend_descriptor: BaseTrendDescriptor, weaviate_accessor: WeaviateAccessor,
-                           data_statistics: DataStatistics):
-
-    entry.progress = QueryProgress.DATA_RETRIEVAL
-    await query_repo.update_query_entry(entry)
-
-    try:
-        entry = await __fetch_data(query_repo, entry, weaviate_accessor, data_statistics)
-    except Exception as e:
-        await query_repo.update_query_progress(entry.uuid, QueryProgress.FAILED)
-        raise e
-
-    entry.progress = QueryProgress.ANALYSING_TRENDS
-    await query_repo.update_query_entry(entry)
-
-    years = list(range(entry.start_year, entry.end_year + 1))
-    breakpoints, trends = await run_in_threadpool(lambda: trend_analyser.analyse(years, entry.results.search_results.adjusted))
-
-    entry.results.trend_results = TrendResults(
-        breakpoints=breakpoints,
-        global_trend=trends[0],
-        sub_trends=trends[1:]
-    )
-    entry.progress = QueryProgress.GENERATING_DESCRIPTION
-    await query_repo.update_query_entry(entry)
+                           data_statistics: DataStatistics, cancellation: CancellationToken, cpu_stages: CpuStagePool,
+                           completed: int = 0, parent: QueryEntry | None = None):
+
+    if not completed & QueryStage.DATA_RETRIEVAL:
+        entry.progress = QueryProgress.DATA_RETRIEVAL
+        await query_repo.update_query_entry(entry)
+
+        if parent is not None:
+            entry = await __derive_data(query_repo, entry, parent, weaviate_accessor, data_statistics, cancellation)
+        else:
+            entry = await __fetch_data(query_repo, entry, weaviate_accessor, data_statistics, cancellation)
+
+        cancellation.raise_if_cancelled()
+        entry.progress = QueryProgress.ANALYSING_TRENDS
+        await query_repo.update_query_entry(entry, QueryStage.DATA_RETRIEVAL)
+
+    if not completed & QueryStage.TREND_ANALYSIS:
+        years = list(range(entry.start_year, entry.end_year + 1))
+        breakpoints, trends = await cpu_stages.run(trend_analyser.analyse, years, entry.results.search_results.adjusted,
+                                                   cancellation=cancellation)
+
+        entry.results.trend_results = TrendResults(
+            breakpoints=breakpoints,
+            global_trend=trends[0],
+            sub_trends=trends[1:]
+        )
+        cancellation.raise_if_cancelled()
+        entry.progress = QueryProgress.GENERATING_DESCRIPTION
+        await query_repo.update_query_entry(entry, QueryStage.TREND_ANALYSIS)
 
-    entry.results.trend_results.trend_description = await run_in_threadpool(
-        lambda: trend_descriptor.generate_description(
+    if not completed & QueryStage.TREND_DESCRIPTION:
+        entry.results.trend_results.trend_description = await trend_descriptor.describe(
             entry.topics,
             entry.start_year,
             entry.end_year,
             entry.results.search_results.adjusted,
             entry.results.trend_results.global_trend,
-            entry.results.trend_results.sub_trends
+            entry.results.trend_results.sub_trends,
+            description_streams.open(entry.uuid)
         )
-    )
 
-    await query_repo.update_query_entry(entry)
+        await query_repo.update_query_entry(entry, QueryStage.TREND_DESCRIPTION)
+        # Subscribers do not have to wait for the topic discovery
+        description_streams.finish(entry.uuid)
 
 
-async def __discover_topics(query_repo: QueryRepository, entry: QueryEntry, weaviate_accessor: WeaviateAccessor):
+async def __discover_topics(query_repo: QueryRepository, entry: QueryEntry, weaviate_accessor: WeaviateAccessor,
+                            cancellation: CancellationToken, term_index: TermIndex | None = None,
+                            artifact_store: TopicArtifactStore | None = None, memory_budget: MemoryBudget | None = None,
+                            cpu_stages: CpuStagePool | None = None):
     await query_repo.update_query_progress(entry.uuid, QueryProgress.CLUSTERING_TOPICS)
 
     max_documents = 6500
 
-    matching_pubs = weaviate_accessor.get_matching_publications_with_vector(
-        entry.topics, entry.start_year, entry.end_year, max_documents
+    if memory_budget is None:
+        await __run_topic_discovery(query_repo, entry, weaviate_accessor, cancellation, cpu_stages, max_documents,
+                                    term_index, artifact_store)
+        return
+
+    # Waits for or shrinks to the memory left by the other running discoveries
+    with await memory_budget.acquire(max_documents, cancellation) as reservation:
+        reservation.observe(await __run_topic_discovery(query_repo, entry, weaviate_accessor, cancellation, cpu_stages,
+                                                        reservation.documents, term_index, artifact_store))
+
+
+async def __run_topic_discovery(query_repo: QueryRepository, entry: QueryEntry, weaviate_accessor: WeaviateAccessor,
+                                cancellation: CancellationToken, cpu_stages: CpuStagePool, max_documents: int,
+                                term_index: TermIndex | None = None, artifact_store: TopicArtifactStore | None = None) -> int | None:
+    # With a term index only the ids are needed, the term counts are sliced from the index
+    matching_pubs = await run_in_threadpool(
+        lambda: weaviate_accessor.get_matching_publications_with_vector(
+            entry.topics, entry.start_year, entry.end_year, max_documents, with_text=term_index is None)
     )
 
-    docs = [
-        f"{x.properties['title']}: {x.properties['abstract']}" for x in matching_pubs]
     years = [x.properties["year"] for x in matching_pubs]
-    vectors = [x.vector for x in matching_pubs]
+    ids = [str(x.uuid) for x in matching_pubs]
+    similarities = [1 - x.metadata.distance for x in matching_pubs]
 
-    topic_discoverer = TopicDiscoverer(docs, years, vectors)
+    docs, doc_term_matrix, vocabulary = None, None, None
+    if term_index is not None:
+        def fetch_properties(missing: list[str]) -> list[dict]:
+            objects = weaviate_accessor.get_publications_by_ids(missing)
+            return [objects[id].properties if id in objects else {"title": "", "abstract": ""} for id in missing]
 
-    topics = await run_in_threadpool(
-        lambda: topic_discoverer.init_model()
-    )
+        doc_term_matrix = await run_in_threadpool(
+            lambda: term_index.document_terms_for(ids, fetch_properties)
+        )
+        vocabulary = term_index.vocabulary
+    else:
+        docs = [
+            f"{x.properties['title']}: {x.properties['abstract']}" for x in matching_pubs]
+
+    vectors = np.array([x.vector for x in matching_pubs], dtype=np.float32)
+    del matching_pubs
+
+    # Worker processes attach to the embedding matrix instead of receiving a pickled copy
+    shared_vectors = SharedArray.create(vectors) if cpu_stages.workers > 0 else None
+    try:
+        discovery_results, artifacts, growth = await cpu_stages.run(
+            discover_topics, docs, years, shared_vectors or vectors, ids, similarities, doc_term_matrix, vocabulary,
+            cancellation=cancellation)
+    finally:
+        if shared_vectors is not None:
+            shared_vectors.unlink()
 
-    discovery_results = TopicDiscoveryResults(
-        topics, None, None)
+    # Kept for drill-down requests, which would otherwise need a refit
+    if artifact_store is not None:
+        await run_in_threadpool(lambda: artifact_store.save(entry.uuid, artifacts))
 
     entry.results.topic_discovery_results = discovery_results
+    await query_repo.update_query_entry(entry, QueryStage.TOPIC_DISCOVERY)
 
-    discovery_results.clusters = await run_in_threadpool(
-        lambda: topic_discoverer.cluster_documents()
-    )
+    return growth
 
-    entry.progress = QueryProgress.TOPICS_OVER_TIME
-    await query_repo.update_query_entry(entry)
 
-    discovery_results.topics_over_time = await run_in_threadpool(
-        lambda: topic_discoverer.topics_over_time()
+async def __derive_topics(query_repo: QueryRepository, entry: QueryEntry, parent_artifacts: TopicArtifacts,
+                          artifact_store: TopicArtifactStore):
+    await query_repo.update_query_progress(entry.uuid, QueryProgress.CLUSTERING_TOPICS)
+
+    # The parent's topic model restricted to the documents of the narrower range, no refit
+    artifacts = parent_artifacts.subset(
+        (parent_artifacts.years >= entry.start_year) & (parent_artifacts.years <= entry.end_year))
+    entry.results.topic_discovery_results = await run_in_threadpool(
+        lambda: topic_discovery_results(artifacts, artifacts.topic_labels)
     )
+    await run_in_threadpool(lambda: artifact_store.save(entry.uuid, artifacts))
 
-    await query_repo.update_query_entry(entry)
+    await query_repo.update_query_entry(entry, QueryStage.TOPIC_DISCOVERY)
 
 
 async def __fetch_citation_recommendations(query_repo: QueryRepository, entry: QueryEntry, weaviate_accessor: WeaviateAccessor):
     await query_repo.update_query_progress(entry.uuid, QueryProgress.CITATION_RETRIEVAL)
 
-    publications = await run_in_threadpool(
-        lambda: weaviate_accessor.get_matching_publications(
-            entry.topics, entry.start_year, entry.end_year, 20, entry.min_citations)
+    # First page of the cached candidate list, further pages are served by the citations endpoint
+    publications, _ = await run_in_threadpool(
+        lambda: weaviate_accessor.get_citation_page(
+            entry.topics, entry.start_year, entry.end_year, entry.min_citations, 0, 20)
     )
 
     entry.results.citation_results = CitationRecommendationResults(
-        publications=[Publication(
-            title=x.properties["title"],
-            doi=x.properties["doi"],
-            authors=x.properties["authors"],
-            year=x.properties["year"],
-            type=x.properties["type"],
-            abstract=x.properties["abstract"],
-            similarity=1-x.metadata.distance,
-            citations=x.properties["n_citations"] if "n_citations" in x.properties else None
-        ) for x in publications]
+        publications=publications
     )
 
-    await query_repo.update_query_entry(entry)
+    await query_repo.update_query_entry(entry, QueryStage.CITATION_RETRIEVAL)
@@ -0,0 +1,28 @@
+import threading
+
+
+class QueryCancelledError(Exception):
+    pass
+
+
+class CancellationToken:
+    def __init__(self):
+        # Checked from worker threads, so a plain flag is not enough
+        self.__event = threading.Event()
+        self.interrupted = False
+
+    def cancel(self):
+        self.__event.set()
+
+    def interrupt(self):
+        # Stops the query like a cancellation, but it stays unfinished so it is resumed on the next start
+        self.interrupted = True
+        self.__event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.__event.is_set()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise QueryCancelledError()
@@ -0,0 +1,147 @@
+import asyncio
+import os
+import threading
+
+from scheduling.cancellation import CancellationToken
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_rss() -> int | None:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class PeakRssSampler:
+    """Samples the resident set size in a background thread, peak is relative to the start."""
+
+    def __init__(self, interval: float = 0.2):
+        self.interval = interval
+        self.baseline = None
+        self.peak = None
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def __enter__(self):
+        self.baseline = current_rss()
+        if self.baseline is not None:
+            self.peak = self.baseline
+            self.__thread = threading.Thread(target=self.__sample, daemon=True)
+            self.__thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def growth(self) -> int | None:
+        if self.baseline is None:
+            return None
+        return self.peak - self.baseline
+
+    def __sample(self):
+        while not self.__stop.wait(self.interval):
+            rss = current_rss()
+            if rss is not None and rss > self.peak:
+                self.peak = rss
+
+
+class MemoryReservation:
+    def __init__(self, budget, documents: int, estimate: int, correction: float):
+        self.budget = budget
+        self.documents = documents
+        self.estimate = estimate
+        self.correction = correction
+        self.sampler = PeakRssSampler()
+        self.observed = None
+
+    def __enter__(self):
+        self.sampler.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        self.sampler.__exit__(*args)
+        # Work done in another process does not show up in this one's RSS
+        growths = [growth for growth in (self.sampler.growth(), self.observed) if growth is not None]
+        self.budget.release(self, max(growths) if len(growths) > 0 else None)
+
+    def observe(self, growth: int | None):
+        self.observed = growth
+
+
+class MemoryBudget:
+    """Admits topic discovery jobs while their estimated peak memory fits the budget.
+
+    The estimate is linear in documents and vector dimension and is scaled by the ratio of observed to
+    estimated peaks of finished jobs. Jobs that do not fit are shrunk down to min_documents or wait."""
+
+    def __init__(self, budget_bytes: int, min_documents: int = 1000, dimension: int = 768,
+                 base_bytes: int = 256 * 1024 * 1024, text_bytes: int = 16 * 1024):
+        self.budget_bytes = budget_bytes
+        self.min_documents = min_documents
+        self.dimension = dimension
+        self.base_bytes = base_bytes
+        self.text_bytes = text_bytes
+
+        # Observed peak over estimate, exponentially weighted
+        self.correction = 1.0
+        self.reserved = 0
+        self.running = 0
+        self.__changed = asyncio.Condition()
+
+    def document_bytes(self, dimension: int | None = None) -> float:
+        # Vectors arrive as lists of Python floats and are copied into float64 arrays for UMAP
+        return self.correction * ((dimension or self.dimension) * 48 + self.text_bytes)
+
+    def estimate(self, documents: int, dimension: int | None = None) -> int:
+        return int(self.correction * self.base_bytes + documents * self.document_bytes(dimension))
+
+    def documents_within(self, available: int, dimension: int | None = None) -> int:
+        return max(0, int((available - self.correction * self.base_bytes) / self.document_bytes(dimension)))
+
+    async def acquire(self, documents: int, cancellation: CancellationToken | None = None,
+                      dimension: int | None = None) -> MemoryReservation:
+        async with self.__changed:
+            while True:
+                if cancellation is not None:
+                    cancellation.raise_if_cancelled()
+
+                available = self.budget_bytes - self.reserved
+                admitted = min(documents, self.documents_within(available, dimension))
+                if admitted >= min(documents, self.min_documents) or self.running == 0:
+                    # Alone on an undersized budget a job still runs with the minimum
+                    admitted = max(admitted, min(documents, self.min_documents))
+                    if admitted < documents:
+                        print("Degrading topic discovery from {} to {} documents to fit the memory budget".format(
+                            documents, admitted))
+                    reservation = MemoryReservation(self, admitted, self.estimate(admitted, dimension), self.correction)
+                    self.reserved += reservation.estimate
+                    self.running += 1
+                    return reservation
+
+                # Woken up on release, the timeout only serves the cancellation check
+                try:
+                    await asyncio.wait_for(self.__changed.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+
+    def release(self, reservation: MemoryReservation, observed: int | None):
+        self.reserved -= reservation.estimate
+        self.running -= 1
+
+        if observed is not None and observed > 0 and reservation.estimate > 0:
+            # Concurrent jobs inflate the process-wide growth, so the correction errs on the safe side
+            ratio = observed / (reservation.estimate / reservation.correction)
+            self.correction = min(4.0, max(0.25, 0.8 * self.correction + 0.2 * ratio))
+            print("Topic discovery with {} documents peaked at {:.0f} MB (estimated {:.0f} MB)".format(
+                reservation.documents, observed / 1024 / 1024, reservation.estimate / 1024 / 1024))
+
+        asyncio.get_running_loop().create_task(self.__notify())
+
+    async def __notify(self):
+        async with self.__changed:
+            self.__changed.notify_all()
@@ -0,0 +1,159 @@
+import asyncio
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+
+from scheduling.cancellation import CancellationToken, QueryCancelledError
+
+
+class SharedArray:
+    """NumPy array in shared memory, pickles to its name so workers attach instead of copying it."""
+
+    def __init__(self, name: str, shape: tuple, dtype: str):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.__memory = None
+
+    @staticmethod
+    def create(array: np.ndarray):
+        memory = SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, array.dtype, buffer=memory.buf)[:] = array
+        shared = SharedArray(memory.name, array.shape, array.dtype.str)
+        shared.__memory = memory
+        return shared
+
+    def unlink(self):
+        if self.__memory is not None:
+            self.__memory.close()
+            self.__memory.unlink()
+            self.__memory = None
+
+    def __getstate__(self):
+        return {"name": self.name, "shape": self.shape, "dtype": self.dtype}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+@contextmanager
+def attach(array: np.ndarray | SharedArray):
+    # Stages run on plain arrays in threads and on shared ones in worker processes
+    if isinstance(array, np.ndarray):
+        yield array
+        return
+
+    # Spawned workers share the parent's resource tracker, so attaching does not take over the unlink
+    memory = SharedMemory(name=array.name)
+    try:
+        yield np.ndarray(array.shape, np.dtype(array.dtype), buffer=memory.buf)
+    finally:
+        memory.close()
+
+
+def warm_up(modules: list[str]):
+    # Modules can define their own warm_up, e.g. to trigger JIT compilation before the first task
+    for module in modules:
+        hook = getattr(importlib.import_module(module), "warm_up", None)
+        if hook is not None:
+            hook()
+
+
+def ready() -> bool:
+    return True
+
+
+class CpuStagePool:
+    """Runs CPU bound stages in worker processes, or in the thread pool without workers.
+
+    Every worker is an executor with a single process, so the worker of a cancelled stage can be terminated and
+    replaced without affecting the stages on the other workers. Workers import the given modules on start and are
+    replaced after max_tasks_per_worker tasks, which returns fragmented memory to the system."""
+
+    def __init__(self, workers: int, max_tasks_per_worker: int = 20, modules: list[str] | None = None):
+        self.workers = workers
+        self.max_tasks = max_tasks_per_worker
+        self.modules = modules or []
+        self.executors = [self.__start() for _ in range(workers)]
+        self.tasks = [0] * workers
+        self.idle = list(range(workers))
+        self.__available = asyncio.Semaphore(workers)
+
+    async def run(self, fn: Callable, *args, cancellation: CancellationToken | None = None):
+        if cancellation is not None:
+            cancellation.raise_if_cancelled()
+
+        if self.workers == 0:
+            return await run_in_threadpool(fn, *args, cancellation=cancellation)
+
+        async with self.__available:
+            worker = self.idle.pop()
+            try:
+                result = await self.__run_on(worker, fn, args, cancellation)
+            finally:
+                self.idle.append(worker)
+
+        if cancellation is not None:
+            cancellation.raise_if_cancelled()
+        return result
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.executors = []
+
+    async def __run_on(self, worker: int, fn: Callable, args: tuple, cancellation: CancellationToken | None):
+        executor = self.__executor(worker)
+        future = asyncio.wrap_future(executor.submit(fn, *args))
+        try:
+            if cancellation is None:
+                return await future
+
+            while not future.done():
+                await asyncio.wait([future], timeout=0.5)
+                if not future.done() and cancellation.cancelled:
+                    # The fit does not check the token, so the worker is terminated to stop it and the slot, memory
+                    # reservation and lane of the query are released right away instead of once the worker has died
+                    future.cancel()
+                    self.__replace(worker, terminate=True)
+                    raise QueryCancelledError()
+            return await future
+        except BrokenProcessPool:
+            if cancellation is not None and cancellation.cancelled:
+                raise QueryCancelledError()
+            # The worker died (e.g. killed for memory), the next stage gets a fresh one
+            if self.executors[worker] is executor:
+                self.__replace(worker)
+            raise
+
+    def __executor(self, worker: int) -> ProcessPoolExecutor:
+        self.tasks[worker] += 1
+        if self.tasks[worker] > self.max_tasks:
+            # The worker is idle, its process exits once the executor is shut down
+            self.__replace(worker)
+            self.tasks[worker] = 1
+        return self.executors[worker]
+
+    def __replace(self, worker: int, terminate: bool = False):
+        executor = self.executors[worker]
+        if terminate:
+            # Executors have no public way to stop a running task, terminating its process breaks the executor
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.executors[worker] = self.__start()
+        self.tasks[worker] = 0
+
+    def __start(self) -> ProcessPoolExecutor:
+        # Forking would copy the event loop, client connections and their threads
+        executor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=warm_up, initargs=(self.modules,))
+        executor.submit(ready)
+        return executor
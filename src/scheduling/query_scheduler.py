@@ -0,0 +1,157 @@
+import asyncio
+import math
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+from models.models import QueryType
+from scheduling.cancellation import CancellationToken
+
+
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Query queue is full")
+        self.retry_after = retry_after
+
+
+@dataclass
+class ScheduledJob:
+    uuid: str
+    type: QueryType
+    run: Callable[[CancellationToken], Awaitable[None]]
+    cancellation: CancellationToken
+
+
+class QueryLane:
+    def __init__(self, name: str, concurrency: int, max_queued: int, type_limits: dict[QueryType, int] | None = None):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queued = max_queued
+        self.type_limits = type_limits or {}
+
+        self.pending: deque[ScheduledJob] = deque()
+        self.running: dict[str, tuple[ScheduledJob, asyncio.Task]] = {}
+
+        # Exponentially weighted average of the job duration in seconds, used for Retry-After
+        self.average_duration = 30.0
+
+    def free_slots(self) -> int:
+        return self.concurrency - len(self.running) + self.max_queued - len(self.pending)
+
+    def retry_after(self) -> int:
+        waves = (len(self.pending) + 1) / self.concurrency
+        return max(1, math.ceil(waves * self.average_duration))
+
+    def next_job(self) -> ScheduledJob | None:
+        if len(self.running) >= self.concurrency:
+            return None
+
+        running_per_type = {}
+        for job, _ in self.running.values():
+            running_per_type[job.type] = running_per_type.get(job.type, 0) + 1
+
+        for job in self.pending:
+            if running_per_type.get(job.type, 0) < self.type_limits.get(job.type, self.concurrency):
+                self.pending.remove(job)
+                return job
+
+        return None
+
+    def record_duration(self, duration: float):
+        self.average_duration = 0.8 * self.average_duration + 0.2 * duration
+
+
+class QueryScheduler:
+    def __init__(self, fast_concurrency: int = 8, heavy_concurrency: int = 2, max_queued: int = 50,
+                 heavy_type_limits: dict[QueryType, int] | None = None):
+        # Citation-only queries are a single vector search, everything else runs the full analysis
+        self.fast_lane = QueryLane("fast", fast_concurrency, max_queued)
+        self.heavy_lane = QueryLane(
+            "heavy", heavy_concurrency, max_queued, heavy_type_limits)
+
+    def lane_for(self, query_type: QueryType) -> QueryLane:
+        if query_type == QueryType.CITATION_RECOMMENDATION:
+            return self.fast_lane
+        return self.heavy_lane
+
+    def check_capacity(self, query_type: QueryType, count: int = 1):
+        lane = self.lane_for(query_type)
+        if lane.free_slots() < count:
+            raise QueueFullError(lane.retry_after())
+
+    def submit(self, uuid: str, query_type: QueryType, run: Callable[[CancellationToken], Awaitable[None]]):
+        self.check_capacity(query_type)
+
+        lane = self.lane_for(query_type)
+        lane.pending.append(ScheduledJob(
+            uuid, query_type, run, CancellationToken()))
+        self.__dispatch(lane)
+
+    def check_batch_capacity(self, query_types: list[QueryType]):
+        for lane in (self.fast_lane, self.heavy_lane):
+            needed = sum(1 for query_type in query_types if self.lane_for(query_type) is lane)
+            if needed > 0 and lane.free_slots() < needed:
+                raise QueueFullError(lane.retry_after())
+
+    def submit_batch(self, jobs: list[tuple[str, QueryType, Callable[[CancellationToken], Awaitable[None]]]]):
+        # Either the whole batch fits into the lanes or nothing is queued
+        self.check_batch_capacity([query_type for _, query_type, _ in jobs])
+
+        for uuid, query_type, run in jobs:
+            self.lane_for(query_type).pending.append(
+                ScheduledJob(uuid, query_type, run, CancellationToken()))
+
+        for lane in (self.fast_lane, self.heavy_lane):
+            self.__dispatch(lane)
+
+    def cancel(self, uuid: str) -> bool:
+        for lane in (self.fast_lane, self.heavy_lane):
+            for job in lane.pending:
+                if job.uuid == uuid:
+                    lane.pending.remove(job)
+                    return True
+            if uuid in lane.running:
+                job, _ = lane.running[uuid]
+                job.cancellation.cancel()
+                return True
+        return False
+
+    def idle(self, query_type: QueryType) -> bool:
+        # Nothing waiting and a slot left over for the next interactive query
+        lane = self.lane_for(query_type)
+        return len(lane.pending) == 0 and len(lane.running) < max(1, lane.concurrency - 1)
+
+    def scheduled(self, uuid: str) -> bool:
+        return any(uuid in lane.running or any(job.uuid == uuid for job in lane.pending)
+                   for lane in (self.fast_lane, self.heavy_lane))
+
+    def queue_position(self, uuid: str) -> int | None:
+        for lane in (self.fast_lane, self.heavy_lane):
+            for i, job in enumerate(lane.pending):
+                if job.uuid == uuid:
+                    return i + 1
+        return None
+
+    def shutdown(self):
+        for lane in (self.fast_lane, self.heavy_lane):
+            lane.pending.clear()
+            for job, task in lane.running.values():
+                job.cancellation.interrupt()
+                task.cancel()
+
+    def __dispatch(self, lane: QueryLane):
+        while (job := lane.next_job()) is not None:
+            task = asyncio.create_task(self.__run(lane, job))
+            lane.running[job.uuid] = (job, task)
+
+    async def __run(self, lane: QueryLane, job: ScheduledJob):
+        start = time.monotonic()
+        try:
+            await job.run(job.cancellation)
+        except Exception as e:
+            print("Query {} failed: {}".format(job.uuid, e))
+        finally:
+            lane.record_duration(time.monotonic() - start)
+            lane.running.pop(job.uuid, None)
+            self.__dispatch(lane)
@@ -3,6 +3,7 @@ import signal
 import piecewise_regression
 import numpy as np
 
+from scheduling.cancellation import CancellationToken, QueryCancelledError
 from trend.analysis.base_time_series_segmenter import BaseTimeSeriesSegmenter
 
 
@@ -10,7 +11,7 @@ class MlrTimeSeriesSegmenter(BaseTimeSeriesSegmenter):
     def __init__(self, min_segment_length: int = 4):
         super().__init__(min_segment_length)
 
-    def segment(self, x, y: list[float] | list[int]) -> list[int]:
+    def segment(self, x, y: list[float] | list[int], cancellation: CancellationToken | None = None) -> list[int]:
         if all(val == 0 for val in y):
             return []
 
@@ -23,7 +24,7 @@ class MlrTimeSeriesSegmenter(BaseTimeSeriesSegmenter):
 
         breakpoints = []
         segments = self.find_best_models(
-            x_copy, y_adjusted, list(range(1, 11)), top_n=1, fit_repetitions=2, n_boot=500)
+            x_copy, y_adjusted, list(range(1, 11)), top_n=1, fit_repetitions=2, n_boot=500, cancellation=cancellation)
 
         if all(len(x) == 3 for x in segments):
             print("No breakpoints found")
@@ -63,9 +64,19 @@ class MlrTimeSeriesSegmenter(BaseTimeSeriesSegmenter):
 
         return n_breakpoints, min_score, breakpoints, best_results["bic"]
 
-    def find_best_models(self, x, y, n_breakpoints: list[int], top_n: int = 4, fit_repetitions: int = 5, n_boot: int = 50, max_processes: int = 4) -> list[tuple]:
+    def find_best_models(self, x, y, n_breakpoints: list[int], top_n: int = 4, fit_repetitions: int = 5, n_boot: int = 50, max_processes: int = 4,
+                         cancellation: CancellationToken | None = None) -> list[tuple]:
         with multiprocessing.Pool(processes=max_processes) as pool:
-            results = pool.starmap(
+            async_results = pool.starmap_async(
                 self.fit_model, [(x, y, n, fit_repetitions, n_boot) for n in n_breakpoints])
 
+            # Poll instead of blocking so a cancelled query kills its workers right away
+            while not async_results.ready():
+                if cancellation is not None and cancellation.cancelled:
+                    pool.terminate()
+                    raise QueryCancelledError()
+                async_results.wait(0.5)
+
+            results = async_results.get()
+
         return sorted(results, key=lambda x: x[1])[:top_n]
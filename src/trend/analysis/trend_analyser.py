@@ -4,6 +4,7 @@ import numpy as np
 
 from trend.analysis.mlr_time_series_segmenter import MlrTimeSeriesSegmenter
 from models.models import Trend, TrendType
+from scheduling.cancellation import CancellationToken
 
 
 def get_trend_analyser():
@@ -11,14 +12,14 @@ def get_trend_analyser():
 
 
 class TrendAnalyser:
-    def analyse(self, x, y) -> (list[int], list[Trend]):
+    def analyse(self, x, y, cancellation: CancellationToken | None = None) -> (list[int], list[Trend]):
         time_series_segmenter = MlrTimeSeriesSegmenter(min_segment_length=4)
 
         if all(val == 0 for val in y):
             return [], self.__get_trends_for_segments(x, y, [(0, len(x) - 1)])
 
         y_adjusted = (y / np.max(y)) * 100
-        cuts = time_series_segmenter.segment(x, y)
+        cuts = time_series_segmenter.segment(x, y, cancellation)
 
         if len(cuts) == 0:
             return [], self.__get_trends_for_segments(x, y_adjusted, [(0, len(x) - 1)])
@@ -1,4 +1,7 @@
+from fastapi.concurrency import run_in_threadpool
+
 from models.models import Trend
+from trend.descriptor.description_stream import DescriptionStream
 
 
 class BaseTrendDescriptor:
@@ -6,3 +9,13 @@ class BaseTrendDescriptor:
                              end_year: int, values: list[int],
                              global_trend: Trend, sub_trends: list[Trend]) -> str:
         raise NotImplementedError
+
+    async def describe(self, topics: list[str], start_year: int,
+                       end_year: int, values: list[int],
+                       global_trend: Trend, sub_trends: list[Trend],
+                       stream: DescriptionStream | None = None) -> str:
+        description = await run_in_threadpool(
+            lambda: self.generate_description(topics, start_year, end_year, values, global_trend, sub_trends))
+        if stream is not None:
+            stream.replace(description)
+        return description
@@ -0,0 +1,74 @@
+import asyncio
+from collections import OrderedDict
+
+
+class DescriptionStream:
+    def __init__(self):
+        self.text = ""
+        self.finished = False
+        self.subscribers: list[asyncio.Queue] = []
+
+    def publish(self, token: str):
+        self.text += token
+        self.__send(("token", token))
+
+    def replace(self, text: str):
+        # Used when a partially streamed description is swapped for the fallback
+        self.text = text
+        self.__send(("replace", text))
+
+    def finish(self):
+        self.finished = True
+        self.__send(("done", ""))
+
+    async def subscribe(self):
+        queue = asyncio.Queue()
+        self.subscribers.append(queue)
+        try:
+            if self.text:
+                yield "replace", self.text
+            if self.finished:
+                yield "done", ""
+                return
+            while True:
+                event = await queue.get()
+                yield event
+                if event[0] == "done":
+                    return
+        finally:
+            self.subscribers.remove(queue)
+
+    def __send(self, event: tuple[str, str]):
+        for queue in self.subscribers:
+            queue.put_nowait(event)
+
+
+class DescriptionStreams:
+    def __init__(self, max_finished: int = 1000):
+        self.max_finished = max_finished
+        self.__streams: dict[str, DescriptionStream] = {}
+        # Finished streams stay around for a while so late subscribers still get the text
+        self.__finished: OrderedDict[str, DescriptionStream] = OrderedDict()
+
+    def get(self, uuid: str) -> DescriptionStream | None:
+        return self.__streams.get(uuid) or self.__finished.get(uuid)
+
+    def open(self, uuid: str) -> DescriptionStream:
+        # Only for queries whose pipeline is queued or running, it finishes the stream however it ends
+        stream = self.get(uuid)
+        if stream is None:
+            stream = self.__streams[uuid] = DescriptionStream()
+        return stream
+
+    def finish(self, uuid: str):
+        if uuid in self.__finished and uuid not in self.__streams:
+            return
+        stream = self.__streams.pop(uuid, None) or DescriptionStream()
+        stream.finish()
+
+        self.__finished[uuid] = stream
+        if len(self.__finished) > self.max_finished:
+            self.__finished.popitem(last=False)
+
+
+description_streams = DescriptionStreams()
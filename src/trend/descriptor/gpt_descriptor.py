@@ -1,25 +1,92 @@
-import openai
+import asyncio
+import hashlib
+import json
 import os
+from collections import OrderedDict
+from dataclasses import asdict
+
+import httpx
+import openai
 
 from models.models import Trend
 from trend.descriptor.base_descriptor import BaseTrendDescriptor
+from trend.descriptor.description_stream import DescriptionStream
+from trend.descriptor.rule_based_descriptor import RuleBasedDescriptor
 
-openai.api_key = os.getenv("OPENAI_API_KEY", None)
-openai.base_url = os.getenv("OPENAI_API_BASE", "http://localhost:8002/v1")
+api_key = os.getenv("OPENAI_API_KEY", None)
+base_url = os.getenv("OPENAI_API_BASE", "http://localhost:8002/v1")
 
 model = os.getenv("OPENAI_MODEL", "gpt4")
 
+connect_timeout = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+read_timeout = float(os.getenv("OPENAI_READ_TIMEOUT", "30"))
+total_timeout = float(os.getenv("OPENAI_TOTAL_TIMEOUT", "90"))
+max_concurrency = int(os.getenv("OPENAI_MAX_CONCURRENCY", "4"))
+max_cached = int(os.getenv("OPENAI_CACHE_SIZE", "1024"))
+
+gpt_descriptor = None
+
 
 def get_gpt_descriptor():
-    return GPTDescriptor()
+    # Shared so the cache and the concurrency limit apply across queries
+    global gpt_descriptor
+    if gpt_descriptor is None:
+        gpt_descriptor = GPTDescriptor()
+    return gpt_descriptor
+
+
+def description_key(topics: list[str], start_year: int, end_year: int, trends: list[Trend]) -> str:
+    canonical = json.dumps({
+        "model": model,
+        "topics": sorted(topic.strip().lower() for topic in topics),
+        "years": [start_year, end_year],
+        "trends": [{**asdict(trend), "slope": round(trend.slope, 6), "line": [round(x, 6) for x in trend.line]}
+                   for trend in trends]
+    }, sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
 
 
 class GPTDescriptor(BaseTrendDescriptor):
-    def generate_description(self, topics: list[str], start_year: int,
-                             end_year: int, values: list[int],
-                             global_trend: Trend, sub_trends: list[Trend]) -> str:
+    def __init__(self):
+        self.client = openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            max_retries=0
+        )
+        self.fallback = RuleBasedDescriptor()
+        self.cache: OrderedDict[str, str] = OrderedDict()
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def describe(self, topics: list[str], start_year: int,
+                       end_year: int, values: list[int],
+                       global_trend: Trend, sub_trends: list[Trend],
+                       stream: DescriptionStream | None = None) -> str:
+        trends = [global_trend] + sub_trends
+        key = description_key(topics, start_year, end_year, trends)
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            if stream is not None:
+                stream.replace(self.cache[key])
+            return self.cache[key]
+
+        try:
+            async with self.semaphore:
+                description = await asyncio.wait_for(self.__stream(trends, stream), total_timeout)
+        except (asyncio.TimeoutError, openai.APIError, httpx.TransportError) as e:
+            print("GPT description failed, falling back to rule based description: {}".format(e))
+            # Replaces whatever was streamed before the timeout
+            return await self.fallback.describe(topics, start_year, end_year, values, global_trend, sub_trends, stream)
 
-        response = openai.ChatCompletion.create(
+        self.cache[key] = description
+        if len(self.cache) > max_cached:
+            self.cache.popitem(last=False)
+
+        return description
+
+    async def __stream(self, trends: list[Trend], stream: DescriptionStream | None) -> str:
+        chunks = await self.client.chat.completions.create(
             model=model,
             messages=[
                 {
@@ -28,13 +95,22 @@ class GPTDescriptor(BaseTrendDescriptor):
                 },
                 {
                     "role": "user",
-                    "content": """trends={}""".format(topics, range(start_year, end_year + 1), values, [global_trend] + sub_trends)
+                    "content": """trends={}""".format(trends)
                 }
             ],
             max_tokens=1024,
             top_p=1,
             frequency_penalty=1,
-            presence_penalty=0
+            presence_penalty=0,
+            stream=True
         )
 
-        return response.choices[0].message.content
+        parts = []
+        async for chunk in chunks:
+            if len(chunk.choices) == 0 or chunk.choices[0].delta.content is None:
+                continue
+            parts.append(chunk.choices[0].delta.content)
+            if stream is not None:
+                stream.publish(chunk.choices[0].delta.content)
+
+        return "".join(parts)
@@ -0,0 +1,49 @@
+import numpy as np
+import scipy.sparse as sp
+
+from models.models import TopicDiscoveryResults
+from scheduling.cancellation import CancellationToken
+from scheduling.memory_budget import PeakRssSampler
+from scheduling.process_pool import SharedArray, attach
+from trend.discovery.keyword_embedder import get_keyword_embedder
+from trend.discovery.topic_artifacts import TopicArtifacts, topic_artifacts
+from trend.discovery.topic_discoverer import TopicDiscoverer
+
+
+def discover_topics(docs: list[str] | None, years: list[int], vectors: np.ndarray | SharedArray, doc_ids: list[str],
+                    similarities: list[float], doc_term_matrix: sp.csr_matrix | None = None,
+                    vocabulary: np.ndarray | None = None, cancellation: CancellationToken | None = None,
+                    keyword_embeddings: bool = True) -> tuple[TopicDiscoveryResults, TopicArtifacts, int | None]:
+    """Fit, clustering and topics over time in one stateless call, so it can run in a worker process.
+    Also returns the memory growth observed while running."""
+    with PeakRssSampler() as sampler:
+        with attach(vectors) as embeddings:
+            topic_discoverer = TopicDiscoverer(docs, years, embeddings, doc_term_matrix=doc_term_matrix,
+                                               vocabulary=vocabulary,
+                                               keyword_embedder=get_keyword_embedder() if keyword_embeddings else None)
+
+        discovery_results = TopicDiscoveryResults(topic_discoverer.init_model(), None, None)
+
+        if cancellation is not None:
+            cancellation.raise_if_cancelled()
+        discovery_results.clusters = topic_discoverer.cluster_documents()
+
+        if cancellation is not None:
+            cancellation.raise_if_cancelled()
+        discovery_results.topics_over_time = topic_discoverer.topics_over_time()
+
+        artifacts = topic_artifacts(topic_discoverer, doc_ids, similarities, discovery_results.clusters)
+
+    return discovery_results, artifacts, sampler.growth()
+
+
+def warm_up():
+    # Loads the keyword model, the fit below does not embed anything so an unreachable endpoint cannot break the worker
+    get_keyword_embedder()
+
+    # Numba compiles UMAP's and HDBSCAN's kernels on first use, which would otherwise delay the first query
+    rng = np.random.default_rng(42)
+    vectors = np.concatenate([rng.normal(center, 0.1, size=(100, 16)) for center in range(3)]).astype(np.float32)
+    docs = ["topic{} term{}: warm up".format(i % 3, i % 7) for i in range(len(vectors))]
+    discover_topics(docs, [2000 + i % 5 for i in range(len(vectors))], vectors,
+                    [str(i) for i in range(len(vectors))], [1.0] * len(vectors), keyword_embeddings=False)
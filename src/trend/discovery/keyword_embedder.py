@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+from bertopic.backend import BaseEmbedder
+
+from data.weaviate.topic_vectorizer import TopicVectorizer
+
+# A local sentence-transformers model is used without network access, otherwise the transformer inference
+# endpoint embeds the keywords, without either MMR is skipped
+model_path = os.getenv("KEYWORD_EMBEDDING_MODEL_PATH")
+inference_endpoint = os.getenv("TRANSFORMER_INFERENCE_ENDPOINT")
+cache_path = os.getenv("KEYWORD_EMBEDDING_CACHE_PATH")
+max_cached = int(os.getenv("KEYWORD_EMBEDDING_CACHE_SIZE", "100000"))
+endpoint_concurrency = int(os.getenv("KEYWORD_EMBEDDING_ENDPOINT_CONCURRENCY", "8"))
+endpoint_timeout = float(os.getenv("KEYWORD_EMBEDDING_ENDPOINT_TIMEOUT", "10"))
+
+keyword_embedder = None
+
+
+def get_keyword_embedder():
+    # One per process, worker processes load the model once and keep it until they are recycled
+    global keyword_embedder
+    if keyword_embedder is None and (model_path or inference_endpoint):
+        cache = KeywordEmbeddingCache(cache_path) if cache_path else None
+        if model_path:
+            keyword_embedder = KeywordEmbedder(local_model(model_path), model_path, cache, max_cached)
+        else:
+            vectorizer = TopicVectorizer(inference_endpoint, timeout=endpoint_timeout, max_cached=0)
+            keyword_embedder = KeywordEmbedder(endpoint_model(vectorizer.vectorize_concept, endpoint_concurrency),
+                                               inference_endpoint, cache, max_cached)
+    return keyword_embedder
+
+
+def local_model(path: str) -> Callable[[list[str]], np.ndarray]:
+    # Only needed for local models, so not imported with the module
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(path, device="cpu")
+    return lambda words: model.encode(words, convert_to_numpy=True, show_progress_bar=False)
+
+
+def endpoint_model(vectorize: Callable[[str], np.ndarray], concurrency: int) -> Callable[[list[str]], np.ndarray]:
+    # The inference endpoint embeds one text per request, so the requests of a batch are sent concurrently
+    executor = ThreadPoolExecutor(concurrency, thread_name_prefix="keyword-embedding")
+
+    def embed(words: list[str]) -> np.ndarray:
+        futures = [executor.submit(vectorize, word) for word in words]
+        try:
+            return np.array([future.result() for future in futures])
+        finally:
+            # A failed request fails the batch, requests that did not start yet are dropped
+            for future in futures:
+                future.cancel()
+
+    return embed
+
+
+class KeywordEmbeddingCache:
+    """Keyword embeddings in SQLite, shared by all worker processes and kept across restarts."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS keyword_embeddings (
+                    model TEXT NOT NULL,
+                    keyword TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    PRIMARY KEY (model, keyword)
+                )
+            """)
+
+    def get_many(self, model: str, keywords: list[str]) -> dict[str, np.ndarray]:
+        embeddings = {}
+        with self.lock:
+            # Stays below SQLite's default limit of host parameters
+            for start in range(0, len(keywords), 500):
+                chunk = keywords[start:start + 500]
+                rows = self.conn.execute(
+                    "SELECT keyword, embedding FROM keyword_embeddings WHERE model = ? AND keyword IN ({})".format(
+                        ", ".join("?" * len(chunk))), [model, *chunk])
+                for keyword, embedding in rows:
+                    embeddings[keyword] = np.frombuffer(embedding, dtype=np.float32)
+        return embeddings
+
+    def put_many(self, model: str, embeddings: dict[str, np.ndarray]):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO keyword_embeddings (model, keyword, embedding) VALUES (?, ?, ?)", [
+                (model, keyword, np.asarray(embedding, dtype=np.float32).tobytes()) for keyword, embedding in embeddings.items()])
+
+
+class KeywordEmbedder(BaseEmbedder):
+    """Embedding backend for the MMR representation, only keywords that were never seen before are embedded."""
+
+    def __init__(self, embed: Callable[[list[str]], np.ndarray], model: str,
+                 cache: KeywordEmbeddingCache | None = None, max_cached: int = 100000):
+        super().__init__()
+        self.embed_keywords = embed
+        self.model = model
+        self.cache = cache
+        self.max_cached = max_cached
+
+        self.__lock = threading.Lock()
+        self.__embeddings: OrderedDict[str, np.ndarray] = OrderedDict()
+
+    def embed(self, documents: list[str], verbose: bool = False) -> np.ndarray:
+        embeddings = {}
+        with self.__lock:
+            for keyword in documents:
+                if keyword in self.__embeddings:
+                    self.__embeddings.move_to_end(keyword)
+                    embeddings[keyword] = self.__embeddings[keyword]
+
+        missing = list(dict.fromkeys(keyword for keyword in documents if keyword not in embeddings))
+        if len(missing) > 0 and self.cache is not None:
+            embeddings.update(self.cache.get_many(self.model, missing))
+            missing = [keyword for keyword in missing if keyword not in embeddings]
+
+        if len(missing) > 0:
+            computed = dict(zip(missing, np.asarray(self.embed_keywords(missing), dtype=np.float32)))
+            if self.cache is not None:
+                self.cache.put_many(self.model, computed)
+            embeddings.update(computed)
+
+        with self.__lock:
+            for keyword in documents:
+                self.__embeddings[keyword] = embeddings[keyword]
+            while len(self.__embeddings) > self.max_cached:
+                self.__embeddings.popitem(last=False)
+
+        return np.vstack([embeddings[keyword] for keyword in documents])
@@ -0,0 +1,42 @@
+import numpy as np
+import scipy.sparse as sp
+
+
+def document_token(index: int) -> str:
+    return f"d{index}"
+
+
+class PrecomputedTermVectorizer:
+    """Stands in for the CountVectorizer of BERTopic when the document-term matrix is already known.
+
+    Documents are passed to BERTopic as tokens like "d12", joined documents are summed from the matrix
+    rows instead of being tokenized again."""
+
+    def __init__(self, doc_term_matrix: sp.csr_matrix, vocabulary: np.ndarray, min_df: int = 2):
+        self.doc_term_matrix = doc_term_matrix
+        self.vocabulary = vocabulary
+        self.min_df = min_df
+        self.columns = np.arange(len(vocabulary))
+
+    def fit(self, documents: list[str]):
+        # Same as min_df of CountVectorizer, BERTopic fits on one joined document per topic
+        counts = self.__sum_rows(documents)
+        self.columns = np.where(np.asarray((counts > 0).sum(axis=0)).ravel() >= self.min_df)[0]
+        return self
+
+    def transform(self, documents: list[str]) -> sp.csr_matrix:
+        return self.__sum_rows(documents)[:, self.columns]
+
+    def fit_transform(self, documents: list[str]) -> sp.csr_matrix:
+        return self.fit(documents).transform(documents)
+
+    def get_feature_names_out(self) -> np.ndarray:
+        return self.vocabulary[self.columns]
+
+    def __sum_rows(self, documents: list[str]) -> sp.csr_matrix:
+        tokens = [[int(token[1:]) for token in document.split()] for document in documents]
+        rows = np.repeat(np.arange(len(tokens)), [len(document) for document in tokens])
+        columns = np.fromiter((index for document in tokens for index in document), dtype=np.int64, count=len(rows))
+        indicator = sp.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, columns)),
+                                  shape=(len(documents), self.doc_term_matrix.shape[0]))
+        return (indicator @ self.doc_term_matrix).tocsr()
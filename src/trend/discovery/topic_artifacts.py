@@ -0,0 +1,221 @@
+import os
+import threading
+from dataclasses import dataclass
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.cluster import AgglomerativeClustering
+from sklearn.preprocessing import normalize
+
+from models.models import ClusteringResults, TopicDiscoveryResults
+from trend.discovery.topic_discoverer import TopicDiscoverer, topics_over_time
+
+
+@dataclass
+class TopicArtifacts:
+    doc_ids: np.ndarray
+    similarities: np.ndarray
+    years: np.ndarray
+    topic_labels: np.ndarray
+    points: np.ndarray
+    reduced_embeddings: np.ndarray
+    doc_term_matrix: sp.csr_matrix
+    words: np.ndarray
+    idf: np.ndarray
+    reduce_frequent_words: bool = True
+
+    def topic_term_counts(self, labels: np.ndarray) -> tuple[np.ndarray, sp.csr_matrix]:
+        topics = np.unique(labels[labels >= 0])
+        indicator = sp.csr_matrix((np.ones(np.count_nonzero(labels >= 0)),
+                                   (np.searchsorted(topics, labels[labels >= 0]), np.where(labels >= 0)[0])),
+                                  shape=(len(topics), len(labels)))
+        return topics, (indicator @ self.doc_term_matrix).tocsr()
+
+    def c_tf_idf(self, term_counts: sp.csr_matrix) -> sp.csr_matrix:
+        c_tf_idf = normalize(term_counts, axis=1, norm="l1")
+        if self.reduce_frequent_words:
+            c_tf_idf.data = np.sqrt(c_tf_idf.data)
+        return normalize(c_tf_idf @ sp.diags(self.idf), axis=1, norm="l1").tocsr()
+
+    def subset(self, mask: np.ndarray):
+        return TopicArtifacts(
+            doc_ids=self.doc_ids[mask],
+            similarities=self.similarities[mask],
+            years=self.years[mask],
+            topic_labels=self.topic_labels[mask],
+            points=self.points[mask],
+            reduced_embeddings=self.reduced_embeddings[mask],
+            doc_term_matrix=self.doc_term_matrix[np.where(mask)[0]],
+            words=self.words,
+            idf=self.idf,
+            reduce_frequent_words=self.reduce_frequent_words
+        )
+
+    def documents(self, topic: int) -> np.ndarray:
+        # Closest to the query first
+        members = np.where(self.topic_labels == topic)[0]
+        return members[np.argsort(-self.similarities[members], kind="stable")]
+
+
+def topic_artifacts(topic_discoverer: TopicDiscoverer, doc_ids: list[str], similarities: list[float],
+                    clusters: ClusteringResults) -> TopicArtifacts:
+    topic_model = topic_discoverer.topic_model
+    return TopicArtifacts(
+        doc_ids=np.asarray(doc_ids),
+        similarities=np.asarray(similarities, dtype=np.float32),
+        years=np.asarray(topic_discoverer.years),
+        topic_labels=np.asarray(topic_discoverer.topics),
+        points=np.column_stack(
+            [clusters.points_x, clusters.points_y, clusters.points_z]),
+        reduced_embeddings=topic_discoverer.reduced_embeddings,
+        doc_term_matrix=topic_discoverer.doc_term_matrix,
+        words=np.asarray(topic_model.vectorizer_model.get_feature_names_out(), dtype=object),
+        idf=topic_model.ctfidf_model._idf_diag.diagonal(),
+        reduce_frequent_words=topic_model.ctfidf_model.reduce_frequent_words
+    )
+
+
+def merge_topics(artifacts: TopicArtifacts, groups: list[list[int]]) -> TopicDiscoveryResults:
+    """Merges each group of topics into one, topics are renumbered by size like BERTopic does."""
+    labels = artifacts.topic_labels.copy()
+    for group in groups:
+        labels[np.isin(labels, group)] = min(group)
+
+    return topic_discovery_results(artifacts, renumbered(labels))
+
+
+def reduce_topics(artifacts: TopicArtifacts, nr_topics: int) -> TopicDiscoveryResults:
+    topics, term_counts = artifacts.topic_term_counts(artifacts.topic_labels)
+    if nr_topics >= len(topics):
+        return topic_discovery_results(artifacts, artifacts.topic_labels)
+
+    # Topics with similar c-TF-IDF representations are merged, as in BERTopic.reduce_topics
+    clusters = AgglomerativeClustering(n_clusters=nr_topics, metric="cosine", linkage="average").fit_predict(
+        artifacts.c_tf_idf(term_counts).toarray())
+    groups = [topics[clusters == cluster].tolist() for cluster in range(nr_topics)]
+    return merge_topics(artifacts, groups)
+
+
+def split_topic(artifacts: TopicArtifacts, topic: int, nr_topics: int) -> TopicDiscoveryResults:
+    """Splits a topic by clustering its documents' reduced embeddings, the space HDBSCAN found it in."""
+    members = np.where(artifacts.topic_labels == topic)[0]
+    clusters = AgglomerativeClustering(n_clusters=nr_topics, linkage="ward").fit_predict(
+        artifacts.reduced_embeddings[members])
+
+    labels = artifacts.topic_labels.copy()
+    labels[members] = np.where(clusters == 0, topic, labels.max() + clusters)
+    return topic_discovery_results(artifacts, renumbered(labels))
+
+
+def renumbered(labels: np.ndarray) -> np.ndarray:
+    # Largest topic first like BERTopic, outliers stay -1
+    sizes = np.bincount(labels[labels >= 0])
+    order = [topic for topic in np.argsort(-sizes, kind="stable") if sizes[topic] > 0]
+    mapping = np.full(len(sizes), -1)
+    mapping[order] = np.arange(len(order))
+    return np.where(labels >= 0, mapping[np.maximum(labels, 0)], -1)
+
+
+def topic_discovery_results(artifacts: TopicArtifacts, labels: np.ndarray) -> TopicDiscoveryResults:
+    # The API process loads no keyword model, so the per-year words of edited topics skip the MMR representation
+    topics, term_counts = artifacts.topic_term_counts(labels)
+    c_tf_idf = artifacts.c_tf_idf(term_counts)
+    selected_topics = topics[:10].tolist()
+
+    readable_topic_labels = []
+    for row, topic in enumerate(selected_topics):
+        start, end = c_tf_idf.indptr[row], c_tf_idf.indptr[row + 1]
+        top = c_tf_idf.indices[start:end][np.argsort(-c_tf_idf.data[start:end], kind="stable")[:4]]
+        readable_topic_labels.append(f"{topic}. {', '.join(artifacts.words[top])}")
+
+    return TopicDiscoveryResults(
+        topics=readable_topic_labels,
+        clusters=ClusteringResults(
+            points_x=artifacts.points[:, 0].tolist(),
+            points_y=artifacts.points[:, 1].tolist(),
+            points_z=artifacts.points[:, 2].tolist(),
+            topic_labels=labels.tolist()
+        ),
+        topics_over_time=topics_over_time(artifacts.doc_term_matrix, labels, artifacts.years, selected_topics,
+                                          artifacts.words, artifacts.idf, c_tf_idf[:len(selected_topics)],
+                                          artifacts.reduce_frequent_words)
+    )
+
+
+class TopicArtifactStore:
+    """Per-query topic artifacts as compressed npz files, least recently used ones are removed above max_bytes."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, uuid: str, artifacts: TopicArtifacts):
+        path = self.__path(uuid)
+        np.savez_compressed(
+            path + ".tmp.npz",
+            doc_ids=artifacts.doc_ids.astype("S36"),
+            similarities=artifacts.similarities.astype(np.float32),
+            years=artifacts.years.astype(np.int16),
+            topic_labels=artifacts.topic_labels.astype(np.int32),
+            points=artifacts.points.astype(np.float32),
+            reduced_embeddings=artifacts.reduced_embeddings.astype(np.float32),
+            dtm_data=artifacts.doc_term_matrix.data.astype(np.int32),
+            dtm_indices=artifacts.doc_term_matrix.indices.astype(np.int32),
+            dtm_indptr=artifacts.doc_term_matrix.indptr.astype(np.int64),
+            dtm_shape=np.array(artifacts.doc_term_matrix.shape),
+            words=artifacts.words.astype(str),
+            idf=artifacts.idf.astype(np.float64),
+            reduce_frequent_words=np.array(artifacts.reduce_frequent_words)
+        )
+        os.replace(path + ".tmp.npz", path)
+        self.__evict()
+
+    def load(self, uuid: str) -> TopicArtifacts | None:
+        path = self.__path(uuid)
+        try:
+            with np.load(path) as f:
+                artifacts = TopicArtifacts(
+                    doc_ids=f["doc_ids"].astype(str),
+                    similarities=f["similarities"],
+                    years=f["years"].astype(int),
+                    topic_labels=f["topic_labels"].astype(int),
+                    points=f["points"],
+                    reduced_embeddings=f["reduced_embeddings"],
+                    doc_term_matrix=sp.csr_matrix((f["dtm_data"], f["dtm_indices"], f["dtm_indptr"]),
+                                                  shape=tuple(f["dtm_shape"])),
+                    words=f["words"].astype(object),
+                    idf=f["idf"],
+                    reduce_frequent_words=bool(f["reduce_frequent_words"])
+                )
+        except FileNotFoundError:
+            return None
+
+        # The modification time doubles as the last access for the LRU
+        os.utime(path)
+        return artifacts
+
+    def delete(self, uuid: str):
+        try:
+            os.remove(self.__path(uuid))
+        except FileNotFoundError:
+            pass
+
+    def __evict(self):
+        with self.lock:
+            files = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".npz") and not name.endswith(".tmp.npz"):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    files.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in files)
+            for _, size, name in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+
+    def __path(self, uuid: str) -> str:
+        return os.path.join(self.directory, f"{uuid}.npz")
@@ -1,36 +1,145 @@
+import os
+from typing import Callable
+
 import numpy as np
+import scipy.sparse as sp
 from models.models import ClusteringResults, DiscoveredTopic
+from trend.discovery.keyword_embedder import KeywordEmbedder
+from trend.discovery.precomputed_vectorizer import PrecomputedTermVectorizer, document_token
 from bertopic import BERTopic
 from bertopic.vectorizers import ClassTfidfTransformer
 from bertopic.representation import MaximalMarginalRelevance
 from umap import UMAP
 from sklearn.feature_extraction.text import CountVectorizer
-from hdbscan import HDBSCAN
+from hdbscan import HDBSCAN, approximate_predict
 from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+from sklearn.preprocessing import normalize
 
 additional_stopwords = ["et", "al", "jats", "pp"]
 all_stopwords = list(ENGLISH_STOP_WORDS.union(additional_stopwords))
 
+# Fit on at most this many documents and assign the rest afterwards, 0 fits on all of them
+default_sample_size = int(os.getenv("TOPIC_DISCOVERY_SAMPLE_SIZE", "0"))
+
+
+def stratified_sample(years, size: int, seed: int = 42) -> np.ndarray:
+    # Proportional allocation per year, every year keeps at least one document
+    years = np.asarray(years)
+    rng = np.random.default_rng(seed)
+    unique_years, counts = np.unique(years, return_counts=True)
+    allocation = np.maximum(1, np.floor(counts * size / len(years))).astype(int)
+
+    indices = [rng.choice(np.where(years == year)[0], size=min(allocated, count), replace=False)
+               for year, count, allocated in zip(unique_years, counts, allocation)]
+    return np.sort(np.concatenate(indices))
+
+
+def topics_over_time(doc_term_matrix: sp.csr_matrix, topics, years, selected_topics: list[int], words,
+                     idf: np.ndarray, global_c_tf_idf: sp.csr_matrix, reduce_frequent_words: bool = True,
+                     top_n_words: int = 5,
+                     representation: Callable[[dict[int, list[tuple[str, float]]]], dict[int, list[tuple[str, float]]]] | None = None
+                     ) -> list[DiscoveredTopic]:
+    """Per year keywords and frequencies of the selected topics, same as BERTopic's topics_over_time with global tuning.
+
+    global_c_tf_idf holds the l1 normalised c-TF-IDF row of each selected topic, in the same order. Like BERTopic,
+    the representation (e.g. MMR) picks the keywords of every topic and year among its top 30 c-TF-IDF words,
+    without one the top c-TF-IDF words are used. Words with equal scores are ordered by vocabulary position, where
+    BERTopic's order depends on its sparse layout."""
+    topics, years = np.asarray(topics), np.asarray(years)
+    mask = np.isin(topics, selected_topics)
+    topic_index = np.searchsorted(selected_topics, topics[mask])
+    timestamps, year_index = np.unique(years[mask], return_inverse=True)
+
+    # One row per (topic, year), summed with a sparse indicator matrix instead of joining documents
+    groups = topic_index * len(timestamps) + year_index
+    n_groups = len(selected_topics) * len(timestamps)
+    indicator = sp.csr_matrix((np.ones(len(groups)), (groups, np.arange(len(groups)))),
+                              shape=(n_groups, len(groups)))
+    term_counts = indicator @ doc_term_matrix[np.where(mask)[0]]
+    frequencies = np.bincount(groups, minlength=n_groups)
+
+    c_tf_idf = normalize(term_counts, axis=1, norm="l1")
+    if reduce_frequent_words:
+        c_tf_idf.data = np.sqrt(c_tf_idf.data)
+    c_tf_idf = normalize(c_tf_idf @ sp.diags(idf), axis=1, norm="l1")
+    c_tf_idf = sp.csr_matrix((c_tf_idf + global_c_tf_idf[np.repeat(np.arange(len(selected_topics)), len(timestamps))]) / 2.0)
+
+    rows_per_topic = [[i * len(timestamps) + j for j in range(len(timestamps)) if frequencies[i * len(timestamps) + j] > 0]
+                      for i in range(len(selected_topics))]
+    candidates = {row: top_scored_words(c_tf_idf, row, words) for rows in rows_per_topic for row in rows}
+    if representation is not None:
+        # All topics and years in one call, so the representation can batch its work
+        candidates.update(representation(candidates))
+
+    results = []
+    for topic, rows in zip(selected_topics, rows_per_topic):
+        results.append(DiscoveredTopic(
+            id=topic,
+            words=[[word for word, _ in candidates[row][:top_n_words] if word != ""] for row in rows],
+            frequencies=[int(frequencies[row]) for row in rows],
+            timestamps=[int(timestamps[row % len(timestamps)]) for row in rows]
+        ))
+    return results
+
+
+def top_scored_words(matrix: sp.csr_matrix, row: int, words, n: int = 30) -> list[tuple[str, float]]:
+    # Padded to n like BERTopic's candidates, ties are ordered by column so results are reproducible
+    start, end = matrix.indptr[row], matrix.indptr[row + 1]
+    scores, indices = matrix.data[start:end], matrix.indices[start:end]
+    top = np.argsort(-scores, kind="stable")[:n]
+    scored = [(words[indices[i]], float(scores[i])) for i in top if scores[i] > 0]
+    return scored + [("", 0.00001)] * (n - len(scored))
+
 
 class TopicDiscoverer:
-    def __init__(self, docs, years, vectors) -> None:
-        self.docs = docs
+    def __init__(self, docs, years, vectors, sample_size: int = default_sample_size,
+                 doc_term_matrix: sp.csr_matrix | None = None, vocabulary: np.ndarray | None = None,
+                 keyword_embedder: KeywordEmbedder | None = None) -> None:
         self.years = years
-        self.embeddings = np.array([np.array(vector) for vector in vectors])
+        self.keyword_embedder = keyword_embedder
+        self.embeddings = np.array(vectors)
+        self.sample_size = sample_size
+        self.vocabulary = vocabulary
+        self.precomputed_terms = doc_term_matrix
+
+        # With a precomputed matrix BERTopic only ever sees row tokens
+        self.docs = docs if doc_term_matrix is None else [
+            document_token(i) for i in range(doc_term_matrix.shape[0])]
 
     def init_model(self):
-        vectorizer_model = CountVectorizer(
-            stop_words=all_stopwords, min_df=2, ngram_range=(1, 2))
-        umap_model = UMAP(n_neighbors=15, n_components=6,
-                          min_dist=0.0, metric='cosine', random_state=42)
+        if self.precomputed_terms is not None:
+            vectorizer_model = PrecomputedTermVectorizer(
+                self.precomputed_terms, self.vocabulary, min_df=2)
+        else:
+            vectorizer_model = CountVectorizer(
+                stop_words=all_stopwords, min_df=2, ngram_range=(1, 2))
+        sampled = self.sample_size > 0 and len(self.docs) > self.sample_size
+
+        # Small fits skip the nearest neighbour index, which makes transforming the rest quadratic
+        umap_model = UMAP(n_neighbors=15, n_components=6, min_dist=0.0, metric='cosine', random_state=42,
+                          force_approximation_algorithm=sampled)
         ctfidf_model = ClassTfidfTransformer(reduce_frequent_words=True)
         hdbscan_model = HDBSCAN(min_cluster_size=10,
                                 metric='euclidean', prediction_data=True)
-        representation_model = MaximalMarginalRelevance(diversity=0.4)
+        # The documents come with their embeddings, the embedding model is only needed for MMR's keywords
+        representation_model = MaximalMarginalRelevance(
+            diversity=0.4) if self.keyword_embedder is not None else None
 
         self.topic_model = BERTopic(min_topic_size=15, ctfidf_model=ctfidf_model, vectorizer_model=vectorizer_model,
-                                    umap_model=umap_model, hdbscan_model=hdbscan_model, representation_model=representation_model)
-        self.topic_model.fit(self.docs, self.embeddings)
+                                    umap_model=umap_model, hdbscan_model=hdbscan_model, representation_model=representation_model,
+                                    embedding_model=self.keyword_embedder)
+
+        if sampled:
+            self.topics = self.__fit_sampled()
+        else:
+            self.topic_model.fit(self.docs, self.embeddings)
+            self.topics = list(self.topic_model.topics_)
+            # UMAP returns its training embedding for the fitted documents, which is what HDBSCAN clustered
+            self.reduced_embeddings = np.nan_to_num(self.topic_model.umap_model.embedding_)
+
+        # Tokenized once with the fitted vocabulary (or sliced from the precomputed one), every later stage works on this matrix
+        self.doc_term_matrix = self.topic_model.vectorizer_model.transform(
+            self.topic_model._preprocess_text(np.asarray(self.docs)))
 
         readable_topic_labels = []
         self.num_topics = len(self.topic_model.topic_labels_.keys()) + \
@@ -42,37 +151,49 @@ class TopicDiscoverer:
 
         return readable_topic_labels
 
+    def __fit_sampled(self) -> list[int]:
+        sample = stratified_sample(self.years, self.sample_size)
+        rest = np.setdiff1d(np.arange(len(self.docs)), sample)
+
+        self.topic_model.fit([self.docs[i] for i in sample], self.embeddings[sample])
+
+        # The remaining documents go through the fitted UMAP and HDBSCAN's approximate_predict, as in BERTopic.transform
+        reduced_rest = np.nan_to_num(self.topic_model.umap_model.transform(self.embeddings[rest]))
+        rest_topics, _ = approximate_predict(self.topic_model.hdbscan_model, reduced_rest)
+
+        self.reduced_embeddings = np.empty((len(self.docs), reduced_rest.shape[1]), dtype=np.float32)
+        self.reduced_embeddings[sample] = np.nan_to_num(self.topic_model.umap_model.embedding_)
+        self.reduced_embeddings[rest] = reduced_rest
+
+        topics = np.empty(len(self.docs), dtype=int)
+        topics[sample] = self.topic_model.topics_
+        topics[rest] = self.topic_model._map_predictions(rest_topics)
+        return topics.tolist()
+
     def topics_over_time(self) -> list[DiscoveredTopic]:
         selected_topics = list(range(0, min(self.num_topics, 10)))
-        docs = [doc for doc, topic in zip(
-            self.docs, self.topic_model.topics_) if topic in selected_topics]
-        years = [year for year, topic in zip(
-            self.years, self.topic_model.topics_) if topic in selected_topics]
-        doc_topics = list(
-            filter(lambda x: x in selected_topics, self.topic_model.topics_))
-
-        topics_over_time = self.topic_model.topics_over_time(
-            docs, years, doc_topics)
 
-        df = topics_over_time.loc[topics_over_time.Topic.isin(
-            selected_topics), :]
-        df = df.groupby("Topic")
+        ctfidf_model = self.topic_model.ctfidf_model
+        global_c_tf_idf = normalize(self.topic_model.c_tf_idf_, axis=1, norm="l1")
+        outliers = self.topic_model._outliers
 
-        grouped_dict = df.agg(lambda x: list(x))[
-            ["Words", "Frequency", "Timestamp"]].to_dict()
+        return topics_over_time(self.doc_term_matrix, self.topics, self.years, selected_topics,
+                                self.topic_model.vectorizer_model.get_feature_names_out(),
+                                ctfidf_model._idf_diag.diagonal(), global_c_tf_idf[[topic + outliers for topic in selected_topics]],
+                                ctfidf_model.reduce_frequent_words,
+                                representation=self.__represent if self.topic_model.representation_model is not None else None)
 
-        results = [DiscoveredTopic(
-            words=[word_str.split(", ")
-                   for word_str in grouped_dict["Words"][i]],
-            frequencies=grouped_dict["Frequency"][i],
-            timestamps=grouped_dict["Timestamp"][i],
-            id=i
-        ) for i in selected_topics]
+    def __represent(self, candidates: dict[int, list[tuple[str, float]]]) -> dict[int, list[tuple[str, float]]]:
+        # Embedded in one batch up front, MMR then finds the keywords and topic strings in the embedder's cache
+        keywords = [word for scored in candidates.values() for word, _ in scored]
+        topic_strings = [" ".join(word for word, _ in scored) for scored in candidates.values()]
+        if len(keywords) > 0:
+            self.keyword_embedder.embed(list(dict.fromkeys(keywords + topic_strings)))
 
-        return results
+        return self.topic_model.representation_model.extract_topics(self.topic_model, None, None, candidates)
 
     def cluster_documents(self, sample: float = None) -> ClusteringResults:
-        topic_per_doc = self.topic_model.topics_
+        topic_per_doc = self.topics
 
         # Sample data if required
         if sample is not None and sample < 1:
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Modules are imported from src like the app does, e.g. "from data.weaviate.resilience import ..."
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
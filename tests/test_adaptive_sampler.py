@@ -0,0 +1,75 @@
+import numpy as np
+
+from data.sampling.adaptive_sampler import AdaptiveSampler, estimate_mean
+from models.models import YearSample
+
+# Nearest publications first, the similarities of 2000 are flat while those of 2001 keep dropping
+SIMILARITIES = {2000: [0.8] * 100, 2001: list(np.linspace(0.9, 0.3, 100)), 2002: [0.5] * 100}
+
+
+class Fetches:
+    def __init__(self):
+        self.nearest = []
+        self.ranks = []
+
+    def fetch_nearest(self, sizes):
+        self.nearest.append(dict(sizes))
+        return {year: YearSample(similarities=SIMILARITIES[year][:size], types=["article"] * size)
+                for year, size in sizes.items()}
+
+    def fetch_ranks(self, ranks):
+        self.ranks.append({year: list(year_ranks) for year, year_ranks in ranks.items()})
+        return {year: YearSample(similarities=[SIMILARITIES[year][rank] for rank in year_ranks],
+                                 types=["article"] * len(year_ranks))
+                for year, year_ranks in ranks.items()}
+
+    def fetched(self) -> int:
+        return sum(sum(sizes.values()) for sizes in self.nearest) + \
+            sum(len(year_ranks) for ranks in self.ranks for year_ranks in ranks.values())
+
+
+def test_only_new_ranks_are_fetched_within_the_default_budget():
+    fetches = Fetches()
+    sizes = {2000: 60, 2001: 60}
+    AdaptiveSampler(tolerance=0).sample(fetches.fetch_nearest, fetches.fetch_ranks, sizes)
+
+    assert fetches.nearest == [{2000: 10, 2001: 10}]
+    for year in sizes:
+        drawn = [rank for ranks in fetches.ranks for rank in ranks.get(year, [])]
+        assert len(drawn) == len(set(drawn))
+        assert all(10 <= rank < 60 for rank in drawn)
+    assert fetches.fetched() <= sum(sizes.values()) // 2
+
+
+def test_estimates_the_mean_of_the_fixed_size():
+    fetches = Fetches()
+    samples = AdaptiveSampler(budget=200, tolerance=0.001).sample(
+        fetches.fetch_nearest, fetches.fetch_ranks, {2000: 60, 2001: 60}, seed=1)
+
+    assert samples[2000].mean == 0.8 and samples[2000].error <= 1e-9
+    exact = np.mean(SIMILARITIES[2001][:60])
+    assert abs(samples[2001].mean - exact) <= samples[2001].error
+
+
+def test_small_years_are_fetched_completely():
+    fetches = Fetches()
+    samples = AdaptiveSampler().sample(fetches.fetch_nearest, fetches.fetch_ranks, {2001: 12, 2002: 0})
+
+    assert fetches.ranks == []
+    assert samples[2001].mean == np.mean(SIMILARITIES[2001][:12]) and samples[2001].error == 0
+    assert samples[2002].similarities == []
+
+
+def test_same_seed_draws_the_same_ranks():
+    first, second = Fetches(), Fetches()
+    AdaptiveSampler().sample(first.fetch_nearest, first.fetch_ranks, {2001: 60}, seed=7)
+    AdaptiveSampler().sample(second.fetch_nearest, second.fetch_ranks, {2001: 60}, seed=7)
+
+    assert first.ranks == second.ranks
+
+
+def test_error_vanishes_once_every_rank_is_drawn():
+    head, tail = [0.9, 0.8], [0.5, 0.4, 0.3]
+    assert estimate_mean(head, tail, 5) == (np.mean(head + tail), 0.0)
+    assert estimate_mean(head, tail[:2], 5)[1] > 0
+    assert estimate_mean(head, tail[:1], 5)[1] is None
@@ -0,0 +1,37 @@
+import asyncio
+
+from trend.descriptor.description_stream import DescriptionStreams
+
+
+async def collect(subscription) -> list[tuple[str, str]]:
+    return [event async for event in subscription]
+
+
+def test_get_does_not_open_streams():
+    streams = DescriptionStreams()
+
+    assert streams.get("unknown") is None
+    assert streams.get("unknown") is None
+
+
+def test_finish_ends_open_subscriptions():
+    async def run():
+        streams = DescriptionStreams()
+        subscription = asyncio.ensure_future(collect(streams.open("query").subscribe()))
+        await asyncio.sleep(0)
+        streams.get("query").publish("rising")
+        streams.finish("query")
+        return await asyncio.wait_for(subscription, 1)
+
+    assert asyncio.run(run()) == [("token", "rising"), ("done", "")]
+
+
+def test_finishing_twice_keeps_the_text():
+    async def run():
+        streams = DescriptionStreams()
+        streams.open("query").replace("stable")
+        streams.finish("query")
+        streams.finish("query")
+        return await asyncio.wait_for(collect(streams.open("query").subscribe()), 1)
+
+    assert asyncio.run(run()) == [("replace", "stable"), ("done", "")]
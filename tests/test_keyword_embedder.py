@@ -0,0 +1,38 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from trend.discovery.keyword_embedder import endpoint_model
+
+
+def test_endpoint_model_embeds_concurrently_in_order():
+    running, peak = 0, 0
+    lock = threading.Lock()
+
+    def vectorize(word: str) -> np.ndarray:
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+        return np.array([float(word)])
+
+    embed = endpoint_model(vectorize, concurrency=4)
+    words = [str(i) for i in range(12)]
+
+    assert embed(words)[:, 0].tolist() == list(range(12))
+    assert peak == 4
+
+
+def test_endpoint_model_fails_the_batch():
+    def vectorize(word: str) -> np.ndarray:
+        if word == "timeout":
+            raise TimeoutError(word)
+        return np.zeros(1)
+
+    with pytest.raises(TimeoutError):
+        endpoint_model(vectorize, concurrency=2)(["a", "timeout", "b"])
@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+import pytest
+
+from models.models import QueryType
+from scheduling.cancellation import CancellationToken, QueryCancelledError
+from scheduling.memory_budget import MemoryBudget
+from scheduling.process_pool import CpuStagePool
+from scheduling.query_scheduler import QueryScheduler
+
+
+def wait_for_cancellation(seconds: float, cancellation=None) -> float:
+    started = time.monotonic()
+    while time.monotonic() - started < seconds:
+        if cancellation is not None:
+            cancellation.raise_if_cancelled()
+        time.sleep(0.05)
+    return seconds
+
+
+def ignore_cancellation(seconds: float) -> float:
+    # Like a model fit, nothing in here checks for cancellation
+    time.sleep(seconds)
+    return seconds
+
+
+@pytest.fixture
+def pool():
+    pool = CpuStagePool(2)
+    yield pool
+    pool.shutdown()
+
+
+def test_cancelled_stage_is_terminated(pool):
+    async def run():
+        cancellation = CancellationToken()
+        asyncio.get_running_loop().call_later(1, cancellation.cancel)
+        started = time.monotonic()
+        with pytest.raises(QueryCancelledError):
+            await pool.run(ignore_cancellation, 60, cancellation=cancellation)
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) < 10
+
+
+def test_other_workers_keep_running(pool):
+    async def run():
+        cancellation = CancellationToken()
+        asyncio.get_running_loop().call_later(1, cancellation.cancel)
+        other = asyncio.create_task(pool.run(ignore_cancellation, 3, cancellation=CancellationToken()))
+        with pytest.raises(QueryCancelledError):
+            await pool.run(ignore_cancellation, 60, cancellation=cancellation)
+
+        # The terminated worker is replaced, so the pool keeps both workers
+        assert await other == 3
+        return await asyncio.gather(*[pool.run(ignore_cancellation, 0.1) for _ in range(2)])
+
+    assert asyncio.run(run()) == [0.1, 0.1]
+
+
+def test_stage_without_cancellation_finishes(pool):
+    assert asyncio.run(pool.run(wait_for_cancellation, 0.1, cancellation=CancellationToken())) == 0.1
+
+
+def test_cancelled_query_releases_its_lane_and_memory(pool):
+    async def run():
+        scheduler = QueryScheduler(heavy_concurrency=1)
+        budget = MemoryBudget(1024 ** 3)
+
+        async def discover(cancellation):
+            with await budget.acquire(1000, cancellation):
+                await pool.run(ignore_cancellation, 60, cancellation=cancellation)
+
+        scheduler.submit("running", QueryType.TREND_ANALYSIS, discover)
+        await asyncio.sleep(1)
+        assert budget.reserved > 0
+        scheduler.cancel("running")
+
+        started = time.monotonic()
+        while len(scheduler.heavy_lane.running) > 0 and time.monotonic() - started < 10:
+            await asyncio.sleep(0.1)
+        return scheduler, budget
+
+    scheduler, budget = asyncio.run(run())
+    assert len(scheduler.heavy_lane.running) == 0
+    assert budget.reserved == 0 and budget.running == 0
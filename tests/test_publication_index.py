@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+import pytest
+
+from data.index.publication_index import LocalPublicationIndex, export_publication_index
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    objects = [SimpleNamespace(properties={"year": year, "type": "Article"}, vector=[1.0, float(i)])
+               for i, year in enumerate([2001, 2002, 2002, 2005])]
+    return export_publication_index(objects, str(tmp_path))
+
+
+def test_covers_checks_both_ends(snapshot):
+    index = LocalPublicationIndex(snapshot)
+
+    assert index.covers(2001, 2005)
+    assert not index.covers(1990, 2005)
+    assert not index.covers(2001, 2006)
+
+
+def test_refreshed_index_reuses_the_executor(snapshot):
+    previous = LocalPublicationIndex(snapshot)
+    index = LocalPublicationIndex(snapshot, executor=previous.executor)
+
+    assert index.executor is previous.executor
+    assert index.count_per_year([1.0, 0.0], 0.0, 2001, 2003) == {2001: 1, 2002: 2, 2003: 0}
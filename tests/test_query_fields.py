@@ -0,0 +1,118 @@
+import asyncio
+import datetime
+import json
+import re
+
+import pytest
+
+import main
+from data.process.compression import compress_results
+from data.process.query_repository import QueryRepository, fields_tree, parse_fields, project_results
+from data.process.serialization import dumps
+from models.models import AnalysisResults, QueryProgress, QueryType, SearchResults, Trend, TrendResults, TrendType
+
+RESULTS = json.loads(dumps(AnalysisResults(
+    search_results=SearchResults(raw=[1.0, 2.0], raw_per_year=[0.5, 1.0], adjusted=[0.1, 0.2],
+                                 pub_types={"article": 3}, adjusted_cutoff=0.9),
+    trend_results=TrendResults(breakpoints=[2001], global_trend=Trend(2000, 2001, TrendType.INCREASING, 0.1, [0.1, 0.2]),
+                               sub_trends=[], trend_description="Rising")
+)))
+
+ROW = {"uuid": "query", "type": QueryType.TREND_ANALYSIS, "progress": QueryProgress.FINISHED, "topics": ["topic"],
+       "start_year": 2000, "end_year": 2001, "cutoff": 0.89, "min_citations": 0, "batch_id": None,
+       "created_at": datetime.datetime(2024, 1, 1), "finished_at": None, "version": 3, "parent_uuid": None,
+       "completed_stages": 3, "attempts": 1, "source_uuid": None}
+
+
+def evaluate(sql: str, params: list, results: dict):
+    # The subset of Postgres the projection is built from, json_build_object over results #> paths
+    def parameter(match):
+        return params[int(match.group(1)) - 1]
+
+    def expression(position: int):
+        assert sql.startswith("json_build_object(", position)
+        position += len("json_build_object(")
+        built = {}
+        while sql[position] != ")":
+            key = re.compile(r"\$(\d+)::text, ").match(sql, position)
+            position = key.end()
+            path = re.compile(r"results #> \$(\d+)::text\[\]").match(sql, position)
+            if path is not None:
+                value = results
+                for segment in parameter(path):
+                    value = value.get(segment) if isinstance(value, dict) else None
+                position = path.end()
+            else:
+                value, position = expression(position)
+            built[parameter(key)] = value
+            if sql.startswith(", ", position):
+                position += 2
+        return built, position + 1
+
+    value, position = expression(0)
+    assert position == len(sql)
+    return value
+
+
+class Connection:
+    # Evaluates the projection like Postgres would, or serves the compressed results of an archived row
+    def __init__(self, compressed: bool):
+        self.compressed = compressed
+
+    async def fetchrow(self, query: str, uuid: str, *params):
+        if self.compressed:
+            return {**ROW, "results": None, "results_compressed": compress_results(json.dumps(RESULTS))}
+        projection = re.search(r"ELSE (json_build_object\(.*\))::text END", query).group(1)
+        return {**ROW, "results": json.dumps(evaluate(projection, [uuid, *params], RESULTS)), "results_compressed": None}
+
+
+def projected(fields: str, compressed: bool) -> dict:
+    repository = QueryRepository(Connection(compressed))
+    _, body = asyncio.run(repository.get_query_fields_json("query", parse_fields(fields)))
+    return json.loads(body)
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_projection_is_a_slice_of_the_full_response(compressed):
+    entry = projected("search_results.adjusted,trend_results,search_results.adjusted_cutoff", compressed)
+
+    assert entry["uuid"] == "query" and entry["version"] == 3
+    assert entry["results"] == {
+        "search_results": {"adjusted": RESULTS["search_results"]["adjusted"],
+                           "adjusted_cutoff": RESULTS["search_results"]["adjusted_cutoff"]},
+        "trend_results": RESULTS["trend_results"]
+    }
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_missing_results_project_to_null(compressed):
+    entry = projected("topic_discovery_results.clusters,trend_results.global_trend.line", compressed)
+
+    assert entry["results"] == {"topic_discovery_results": {"clusters": None},
+                                "trend_results": {"global_trend": {"line": RESULTS["trend_results"]["global_trend"]["line"]}}}
+
+
+def test_projection_passes_field_names_as_parameters():
+    params = []
+    sql = QueryRepository(None)._QueryRepository__projection(
+        fields_tree([["trend_results"], ["search_results", "raw"]]), [], params)
+
+    assert sql == "json_build_object($2::text, results #> $3::text[], " \
+                  "$4::text, json_build_object($5::text, results #> $6::text[]))"
+    assert params == ["trend_results", ["trend_results"], "search_results", "raw", ["search_results", "raw"]]
+
+
+def test_prefix_selects_the_whole_subtree():
+    tree = fields_tree([["search_results", "raw"], ["search_results"]])
+
+    assert tree == {"search_results": None}
+    assert project_results(RESULTS, tree) == {"search_results": RESULTS["search_results"]}
+
+
+@pytest.mark.parametrize("fields", ["unknown", "search_results.raw;drop", "search_results..raw", "uuid"])
+def test_unknown_fields_are_rejected(fields):
+    with pytest.raises(ValueError):
+        parse_fields(fields)
+
+    response = asyncio.run(main.get_query("query", fields=fields, if_none_match=None, query_repo=None))
+    assert response.status_code == 400
@@ -0,0 +1,132 @@
+import asyncio
+import json
+
+import pytest
+
+from data.process.serialization import dumps, dumps_entry, results_from_dict
+from models.models import AnalysisResults, CitationRecommendationResults, ClusteringResults, DiscoveredTopic, \
+    Publication, QueryEntry, QueryProgress, QueryStage, QueryType, SearchResults, TopicDiscoveryResults, Trend, \
+    TrendResults, TrendType
+from query_worker import process_query
+from scheduling.cancellation import CancellationToken, QueryCancelledError
+
+SEARCH_RESULTS = SearchResults(raw=[0.8, 0.9, 0.85], raw_per_year=[10, 20, 15], adjusted=[0.0, 100.0, 50.0],
+                               pub_types={"article": 9}, adjusted_cutoff=0.88, raw_errors=[0.01, None, 0.0],
+                               adjusted_errors=[10.0, None, 0.0],
+                               pub_types_per_year={2000: {"article": 3}, 2001: {"article": 3}, 2002: {"article": 3}})
+TREND_RESULTS = TrendResults(breakpoints=[2001], global_trend=Trend(2000, 2002, TrendType.INCREASING, 25.0, [0, 25, 50]),
+                             sub_trends=[Trend(2000, 2001, TrendType.INCREASING, 100.0, [0, 100]),
+                                         Trend(2001, 2002, TrendType.DECREASING, -50.0, [100, 50])],
+                             trend_description="Rising")
+RESULTS = AnalysisResults(
+    search_results=SEARCH_RESULTS,
+    trend_results=TREND_RESULTS,
+    topic_discovery_results=TopicDiscoveryResults(
+        topics={"0": "alpha"},
+        clusters=ClusteringResults(points_x=[0.1], points_y=[0.2], points_z=[0.3], topic_labels=[0]),
+        topics_over_time=[DiscoveredTopic(id=0, words=[["alpha"]], frequencies=[1], timestamps=[2000])]),
+    citation_results=CitationRecommendationResults(publications=[
+        Publication(title="Title", doi="10.1/x", authors=["A"], year=2001, type="article", similarity=0.9,
+                    abstract="Abstract", citations=3)])
+)
+
+
+class Repository:
+    # Stores entries like Postgres, as JSON with the completed stages as a bitmask
+    def __init__(self, results: AnalysisResults, completed: int, cancellation: CancellationToken):
+        self.results = json.loads(dumps(results))
+        self.completed = completed
+        self.cancellation = cancellation
+        self.stages = []
+
+    async def get_query_entry(self, uuid: str) -> QueryEntry:
+        return QueryEntry(uuid=uuid, type=QueryType.COMPLETE, progress=QueryProgress.ANALYSING_TRENDS, topics=["topic"],
+                          start_year=2000, end_year=2002, cutoff=0.89, min_citations=0, results=self.results,
+                          completed_stages=self.completed)
+
+    async def start_query_attempt(self, uuid: str):
+        pass
+
+    async def update_query_entry(self, entry: QueryEntry, completed_stage: QueryStage | None = None):
+        self.results = json.loads(dumps(entry.results))
+        if completed_stage is not None:
+            self.stages.append(completed_stage)
+            self.completed |= completed_stage
+
+    async def update_query_progress(self, uuid: str, progress: QueryProgress):
+        # The service shuts down once the topic discovery starts
+        if progress == QueryProgress.CLUSTERING_TOPICS:
+            self.cancellation.interrupt()
+            raise QueryCancelledError()
+
+
+class Accessor:
+    def get_citation_page(self, concepts, start_year, end_year, min_citation_count, offset=0, limit=20):
+        return RESULTS.citation_results.publications, 1
+
+    def __getattr__(self, name):
+        raise AssertionError("Completed data retrieval ran again")
+
+
+class Analyser:
+    def __init__(self):
+        self.calls = 0
+
+    def analyse(self, x, y, cancellation=None):
+        self.calls += 1
+        return TREND_RESULTS.breakpoints, [TREND_RESULTS.global_trend, *TREND_RESULTS.sub_trends]
+
+
+class Descriptor:
+    def __init__(self):
+        self.calls = 0
+
+    async def describe(self, topics, start_year, end_year, values, global_trend, sub_trends, stream=None):
+        self.calls += 1
+        return TREND_RESULTS.trend_description
+
+
+@pytest.mark.parametrize("stored, completed, stages", [
+    (AnalysisResults(search_results=SEARCH_RESULTS), QueryStage.DATA_RETRIEVAL,
+     [QueryStage.TREND_ANALYSIS, QueryStage.TREND_DESCRIPTION, QueryStage.CITATION_RETRIEVAL]),
+    (AnalysisResults(search_results=SEARCH_RESULTS, trend_results=TREND_RESULTS),
+     QueryStage.DATA_RETRIEVAL | QueryStage.TREND_ANALYSIS | QueryStage.TREND_DESCRIPTION,
+     [QueryStage.CITATION_RETRIEVAL]),
+    (AnalysisResults(search_results=SEARCH_RESULTS, trend_results=TREND_RESULTS,
+                     citation_results=RESULTS.citation_results),
+     QueryStage.DATA_RETRIEVAL | QueryStage.TREND_ANALYSIS | QueryStage.CITATION_RETRIEVAL,
+     [QueryStage.TREND_DESCRIPTION])
+])
+def test_interrupted_query_resumes_after_its_completed_stages(stored, completed, stages):
+    cancellation = CancellationToken()
+    repository = Repository(stored, completed, cancellation)
+    analyser, descriptor = Analyser(), Descriptor()
+
+    asyncio.run(process_query("query", repository, Accessor(), analyser, descriptor, None, cancellation))
+
+    assert repository.stages == stages
+    assert analyser.calls == int(QueryStage.TREND_ANALYSIS in stages)
+    assert descriptor.calls == int(QueryStage.TREND_DESCRIPTION in stages)
+    # Interrupted again at the topic discovery, everything before it is stored
+    assert repository.completed == QueryStage.DATA_RETRIEVAL | QueryStage.TREND_ANALYSIS | \
+        QueryStage.TREND_DESCRIPTION | QueryStage.CITATION_RETRIEVAL
+    assert repository.results == json.loads(dumps(AnalysisResults(
+        SEARCH_RESULTS, TREND_RESULTS, None, RESULTS.citation_results)))
+
+
+def test_results_round_trip_through_storage():
+    stored = json.loads(dumps(RESULTS))
+
+    assert results_from_dict(stored) == RESULTS
+    assert results_from_dict(None) == AnalysisResults()
+    assert dumps(results_from_dict(stored)) == dumps(RESULTS)
+
+
+def test_spliced_entry_equals_the_serialised_entry():
+    entry = QueryEntry(uuid="query", type=QueryType.COMPLETE, progress=QueryProgress.FINISHED, topics=["topic"],
+                       start_year=2000, end_year=2002, cutoff=0.89, min_citations=0, results=RESULTS, version=4,
+                       completed_stages=31, source_uuid="source")
+
+    assert json.loads(dumps_entry(entry, dumps(RESULTS))) == json.loads(dumps(entry))
+    entry.results = None
+    assert json.loads(dumps_entry(entry, None)) == json.loads(dumps(entry))
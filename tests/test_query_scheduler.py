@@ -0,0 +1,171 @@
+import asyncio
+
+import pytest
+
+from models.models import QueryType
+from scheduling.cancellation import QueryCancelledError
+from scheduling.query_scheduler import QueryScheduler, QueueFullError
+
+
+class Jobs:
+    # Jobs run until they are released
+    def __init__(self):
+        self.started = []
+        self.finished = []
+        self.cancelled = []
+        self.releases = {}
+
+    def job(self, uuid: str):
+        self.releases[uuid] = asyncio.Event()
+
+        async def run(cancellation):
+            self.started.append(uuid)
+            while not self.releases[uuid].is_set():
+                try:
+                    cancellation.raise_if_cancelled()
+                except QueryCancelledError:
+                    self.cancelled.append(uuid)
+                    raise
+                await asyncio.sleep(0.01)
+            self.finished.append(uuid)
+
+        return run
+
+    async def release(self, uuid: str):
+        self.releases[uuid].set()
+        await settle()
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0.02)
+
+
+def test_lanes_run_up_to_their_concurrency():
+    async def run():
+        scheduler = QueryScheduler(fast_concurrency=2, heavy_concurrency=1)
+        jobs = Jobs()
+        for uuid in ("fast-1", "fast-2", "fast-3"):
+            scheduler.submit(uuid, QueryType.CITATION_RECOMMENDATION, jobs.job(uuid))
+        for uuid in ("heavy-1", "heavy-2"):
+            scheduler.submit(uuid, QueryType.TREND_ANALYSIS, jobs.job(uuid))
+        await settle()
+        assert jobs.started == ["fast-1", "fast-2", "heavy-1"]
+
+        # A finished job hands its slot to the next queued one of the same lane
+        await jobs.release("heavy-1")
+        assert jobs.finished == ["heavy-1"]
+        assert jobs.started == ["fast-1", "fast-2", "heavy-1", "heavy-2"]
+        scheduler.shutdown()
+
+    asyncio.run(run())
+
+
+def test_type_limits_let_other_types_pass():
+    async def run():
+        scheduler = QueryScheduler(heavy_concurrency=2, heavy_type_limits={QueryType.COMPLETE: 1})
+        jobs = Jobs()
+        scheduler.submit("complete-1", QueryType.COMPLETE, jobs.job("complete-1"))
+        scheduler.submit("complete-2", QueryType.COMPLETE, jobs.job("complete-2"))
+        scheduler.submit("trend", QueryType.TREND_ANALYSIS, jobs.job("trend"))
+        await settle()
+
+        assert jobs.started == ["complete-1", "trend"]
+        assert scheduler.queue_position("complete-2") == 1
+        scheduler.shutdown()
+
+    asyncio.run(run())
+
+
+def test_queue_position_counts_within_the_lane():
+    async def run():
+        scheduler = QueryScheduler(fast_concurrency=1, heavy_concurrency=1)
+        jobs = Jobs()
+        for uuid in ("heavy-1", "heavy-2", "heavy-3"):
+            scheduler.submit(uuid, QueryType.TREND_ANALYSIS, jobs.job(uuid))
+        scheduler.submit("fast-1", QueryType.CITATION_RECOMMENDATION, jobs.job("fast-1"))
+        scheduler.submit("fast-2", QueryType.CITATION_RECOMMENDATION, jobs.job("fast-2"))
+        await settle()
+
+        assert scheduler.queue_position("heavy-1") is None
+        assert scheduler.queue_position("heavy-2") == 1 and scheduler.queue_position("heavy-3") == 2
+        assert scheduler.queue_position("fast-2") == 1
+
+        await jobs.release("heavy-1")
+        assert scheduler.queue_position("heavy-2") is None and scheduler.queue_position("heavy-3") == 1
+        scheduler.shutdown()
+
+    asyncio.run(run())
+
+
+def test_full_lane_rejects_with_retry_after():
+    async def run():
+        scheduler = QueryScheduler(fast_concurrency=1, heavy_concurrency=1, max_queued=2)
+        jobs = Jobs()
+        for uuid in ("heavy-1", "heavy-2", "heavy-3"):
+            scheduler.submit(uuid, QueryType.TREND_ANALYSIS, jobs.job(uuid))
+
+        with pytest.raises(QueueFullError) as error:
+            scheduler.submit("heavy-4", QueryType.TREND_ANALYSIS, jobs.job("heavy-4"))
+        assert error.value.retry_after >= 1
+        assert not scheduler.scheduled("heavy-4")
+
+        # The other lane is not affected
+        scheduler.submit("fast-1", QueryType.CITATION_RECOMMENDATION, jobs.job("fast-1"))
+        scheduler.shutdown()
+
+    asyncio.run(run())
+
+
+def test_batch_is_queued_completely_or_not_at_all():
+    async def run():
+        scheduler = QueryScheduler(fast_concurrency=1, heavy_concurrency=1, max_queued=1)
+        jobs = Jobs()
+        with pytest.raises(QueueFullError):
+            scheduler.submit_batch([(uuid, QueryType.TREND_ANALYSIS, jobs.job(uuid))
+                                    for uuid in ("heavy-1", "heavy-2", "heavy-3")])
+        assert not any(scheduler.scheduled(uuid) for uuid in ("heavy-1", "heavy-2", "heavy-3"))
+
+        scheduler.submit_batch([("heavy-1", QueryType.TREND_ANALYSIS, jobs.job("heavy-1")),
+                                ("fast-1", QueryType.CITATION_RECOMMENDATION, jobs.job("fast-1"))])
+        await settle()
+        assert sorted(jobs.started) == ["fast-1", "heavy-1"]
+        scheduler.shutdown()
+
+    asyncio.run(run())
+
+
+def test_cancelled_queued_job_never_runs():
+    async def run():
+        scheduler = QueryScheduler(heavy_concurrency=1)
+        jobs = Jobs()
+        scheduler.submit("running", QueryType.TREND_ANALYSIS, jobs.job("running"))
+        scheduler.submit("queued", QueryType.TREND_ANALYSIS, jobs.job("queued"))
+        await settle()
+
+        assert scheduler.cancel("queued")
+        assert not scheduler.scheduled("queued")
+        await jobs.release("running")
+        assert jobs.started == ["running"]
+        assert not scheduler.cancel("queued")
+        scheduler.shutdown()
+
+    asyncio.run(run())
+
+
+def test_cancelled_running_job_frees_its_slot():
+    async def run():
+        scheduler = QueryScheduler(heavy_concurrency=1)
+        jobs = Jobs()
+        scheduler.submit("running", QueryType.TREND_ANALYSIS, jobs.job("running"))
+        scheduler.submit("queued", QueryType.TREND_ANALYSIS, jobs.job("queued"))
+        await settle()
+
+        assert scheduler.cancel("running")
+        await settle()
+        assert jobs.cancelled == ["running"]
+        assert jobs.started == ["running", "queued"]
+        assert "running" not in scheduler.heavy_lane.running
+        scheduler.shutdown()
+
+    asyncio.run(run())
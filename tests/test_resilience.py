@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+from data.weaviate.resilience import CircuitBreaker, CircuitOpenError, ResilientCaller
+
+
+def open_breaker(caller: ResilientCaller):
+    def unavailable():
+        raise ConnectionError("down")
+
+    with pytest.raises(ConnectionError):
+        caller.call("test", unavailable)
+    assert caller.breaker.state == "open"
+    time.sleep(caller.breaker.reset_after)
+
+
+@pytest.fixture
+def caller():
+    caller = ResilientCaller(deadline=1, retries=0, breaker=CircuitBreaker(failure_threshold=1, reset_after=0.05))
+    yield caller
+    caller.shutdown()
+
+
+def test_non_transient_trial_error_closes_the_breaker(caller):
+    open_breaker(caller)
+
+    def invalid():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        caller.call("test", invalid)
+
+    assert caller.breaker.state == "closed"
+    assert not caller.breaker.trial_running
+    assert caller.call("test", lambda: 42) == 42
+
+
+def test_transient_trial_error_reopens_the_breaker(caller):
+    open_breaker(caller)
+
+    with pytest.raises(ConnectionError):
+        caller.call("test", lambda: (_ for _ in ()).throw(ConnectionError("still down")))
+
+    assert caller.breaker.state == "open"
+    assert not caller.breaker.trial_running
+    with pytest.raises(CircuitOpenError):
+        caller.call("test", lambda: 42)
+
+
+def test_interrupted_trial_frees_the_trial_slot(caller):
+    open_breaker(caller)
+
+    class Interrupted(BaseException):
+        pass
+
+    def interrupted():
+        raise Interrupted()
+
+    with pytest.raises(Interrupted):
+        caller.call("test", interrupted)
+
+    assert not caller.breaker.trial_running
+    assert caller.call("test", lambda: 42) == 42
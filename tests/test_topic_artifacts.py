@@ -0,0 +1,38 @@
+import numpy as np
+import scipy.sparse as sp
+
+from trend.discovery.topic_artifacts import TopicArtifacts, merge_topics, split_topic
+
+
+def artifacts() -> TopicArtifacts:
+    # Topic 0 consists of two separate groups of 20 documents in the reduced space, topic 1 of 10 documents
+    rng = np.random.default_rng(0)
+    reduced = np.concatenate([rng.normal(0, 0.1, (20, 6)), rng.normal(5, 0.1, (20, 6)), rng.normal(-5, 0.1, (10, 6))])
+    labels = np.array([0] * 40 + [1] * 10)
+    terms = np.array([0] * 20 + [1] * 20 + [2] * 10)
+    return TopicArtifacts(
+        doc_ids=np.array([str(i) for i in range(50)]),
+        similarities=np.linspace(1, 0.5, 50).astype(np.float32),
+        years=np.array([2000 + i % 3 for i in range(50)]),
+        topic_labels=labels,
+        points=reduced[:, :3],
+        reduced_embeddings=reduced.astype(np.float32),
+        doc_term_matrix=sp.csr_matrix((np.ones(50, dtype=np.int32), (np.arange(50), terms)), shape=(50, 3)),
+        words=np.array(["alpha", "beta", "gamma"], dtype=object),
+        idf=np.ones(3)
+    )
+
+
+def test_split_separates_the_groups_of_a_topic():
+    results = split_topic(artifacts(), 0, 2)
+
+    labels = np.array(results.clusters.topic_labels)
+    assert len(set(labels[:20])) == 1 and len(set(labels[20:40])) == 1
+    assert labels[0] != labels[20]
+    assert sorted(np.bincount(labels).tolist()) == [10, 20, 20]
+
+
+def test_merge_renumbers_by_size():
+    results = merge_topics(artifacts(), [[0, 1]])
+
+    assert results.clusters.topic_labels == [0] * 50
@@ -0,0 +1,78 @@
+import numpy as np
+
+from data.weaviate.year_sample_cache import YearSampleCache
+from models.models import YearSample
+
+TOPIC = ("graph neural networks",)
+
+
+class Fetches:
+    def __init__(self):
+        self.samples = []
+        self.counts = []
+
+    def fetch_samples(self, limits):
+        self.samples.append(dict(limits))
+        # Nearest publications first, like a near vector search
+        return {year: YearSample(similarities=np.linspace(0.9, 0.5, 100)[:limit].tolist(),
+                                 types=["article" if i % 2 == 0 else "book" for i in range(limit)])
+                for year, limit in limits.items()}
+
+    def fetch_counts(self, start_year, end_year):
+        self.counts.append((start_year, end_year))
+        return {year: year - 1990 for year in range(start_year, end_year + 1)}
+
+
+def test_cached_sample_serves_smaller_sizes():
+    cache, fetches = YearSampleCache(), Fetches()
+    full = cache.get_samples(TOPIC, 0, {2000: 20}, fetches.fetch_samples)
+    smaller = cache.get_samples(TOPIC, 0, {2000: 5}, fetches.fetch_samples)
+
+    assert fetches.samples == [{2000: 20}]
+    assert smaller[2000].types == full[2000].types[:5]
+    assert np.allclose(smaller[2000].similarities, full[2000].similarities[:5])
+
+
+def test_larger_request_fetches_only_what_is_missing():
+    cache, fetches = YearSampleCache(), Fetches()
+    cache.get_samples(TOPIC, 0, {2000: 10, 2001: 10}, fetches.fetch_samples)
+    samples = cache.get_samples(TOPIC, 0, {2000: 10, 2001: 30, 2002: 10}, fetches.fetch_samples)
+
+    assert fetches.samples[1] == {2001: 30, 2002: 10}
+    assert [len(samples[year].similarities) for year in (2000, 2001, 2002)] == [10, 30, 10]
+
+    # The larger sample replaces the smaller one
+    cache.get_samples(TOPIC, 0, {2001: 20}, fetches.fetch_samples)
+    assert len(fetches.samples) == 2
+
+
+def test_counts_fetch_the_missing_ranges():
+    cache, fetches = YearSampleCache(), Fetches()
+    cache.get_counts(TOPIC, 0, 0.89, 2003, 2005, fetches.fetch_counts)
+    counts = cache.get_counts(TOPIC, 0, 0.89, 2000, 2008, fetches.fetch_counts)
+
+    assert fetches.counts == [(2003, 2005), (2000, 2002), (2006, 2008)]
+    assert counts == {year: year - 1990 for year in range(2000, 2009)}
+
+
+def test_new_data_version_invalidates_entries():
+    cache, fetches = YearSampleCache(), Fetches()
+    cache.get_samples(TOPIC, 0, {2000: 10}, fetches.fetch_samples)
+    cache.get_counts(TOPIC, 0, 0.89, 2000, 2001, fetches.fetch_counts)
+    cache.get_samples(TOPIC, 1, {2000: 10}, fetches.fetch_samples)
+    cache.get_counts(TOPIC, 1, 0.89, 2000, 2001, fetches.fetch_counts)
+
+    assert fetches.samples == [{2000: 10}, {2000: 10}]
+    assert fetches.counts == [(2000, 2001), (2000, 2001)]
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache, fetches = YearSampleCache(max_bytes=700), Fetches()
+    cache.get_samples(TOPIC, 0, {2000: 10}, fetches.fetch_samples)
+    cache.get_samples(TOPIC, 0, {2001: 10}, fetches.fetch_samples)
+    cache.get_samples(TOPIC, 0, {2000: 10}, fetches.fetch_samples)
+    cache.get_samples(TOPIC, 0, {2002: 10}, fetches.fetch_samples)
+
+    assert cache.size <= 700
+    cache.get_samples(TOPIC, 0, {2000: 10, 2001: 10}, fetches.fetch_samples)
+    assert fetches.samples[-1] == {2001: 10}